@@ -0,0 +1 @@
+# Makes the packages of the repository (techniques, llm_inference) importable from the tests in tests/
@@ -2,10 +2,12 @@ import os
 import pandas as pd
 import matplotlib.pyplot as plt
 
-from plot_data import calculate_accuracy
+from plot_data import calculate_accuracy, calculate_billed_prompt_tokens, is_result_file
 
 def calculate_mean_tokens_usage(df):
-    return (df['prompt_tokens'].mean() + df['completion_tokens'].mean())/2.0
+    # Prompt tokens served from the provider's prompt cache count with their discounted price, responses served
+    # by the response cache count like sent requests, such that the usage does not depend on earlier runs
+    return (calculate_billed_prompt_tokens(df, count_response_cache_hits=True).mean() + df['completion_tokens'].mean())/2.0
 
 def calculate_mean_latency(df):
     return df['latency_in_seconds'].mean()
@@ -13,7 +15,7 @@ def calculate_mean_latency(df):
 def create_dataframe(dataset): 
     results = []   
     for file in os.listdir("data"):
-        if file.endswith(".csv") and dataset in file:
+        if is_result_file(file, dataset):
             df = pd.read_csv(os.path.join("data", file))
             acc = calculate_accuracy(df)
             method_name = file.split("_")[0] + " " + file.split("_")[1]
@@ -7,10 +7,16 @@ import os
 
 
 def read_data(technique_name, few_shot_or_zero_shot, dataset, service, model):
-    assert(dataset in ["arithmetic_100", "wordProblems_100", "geometry_100", "arithmetic_1000", "wordProblems_1000", "geometry_1000"])
+    assert(dataset in ["arithmetic_100", "wordProblems_100", "geometry_100", "arithmetic_1000", "wordProblems_1000", "geometry_1000",
+                       "arithmetic_100_german", "wordProblems_100_german", "geometry_100_german"])
     assert(few_shot_or_zero_shot in ["Few-shot", "Zero-shot"])
     return pd.read_csv(f"data/{technique_name}_{few_shot_or_zero_shot}_{dataset}_{service}_{model}.csv")
 
+def is_result_file(file, dataset):
+    """Whether `file` holds results on `dataset`, e.g. `CoT_Few-shot_arithmetic_100_azure_gpt-35-turbo.csv` for
+    `arithmetic_100`, but not `CoT_Few-shot_arithmetic_100_german_azure_gpt-35-turbo.csv`."""
+    return file.endswith(".csv") and "_".join(file.split("_")[2:-2]) == dataset
+
 def classify(row) -> str:
     """Classifies the answer as Correct Answer, Incorrect Answer, or Error."""
     try:
@@ -74,7 +80,7 @@ def plot_results_grid(dataset, ax=None):
     methods = []
     # Read and classify data for each method
     for file in os.listdir("data"):
-        if file.endswith(".csv") and dataset in file:
+        if is_result_file(file, dataset):
             df = pd.read_csv(os.path.join("data", file))
             df = add_classification(df)
             classifications_per_method.append(df['classification'])
@@ -129,7 +135,7 @@ def plot_accuracy(dataset, ax=None):
 
     techniques, zero_shot, few_shot = [], [], []
     for file in os.listdir("data"):
-        if file.endswith(".csv") and dataset in file:
+        if is_result_file(file, dataset):
             df = pd.read_csv(os.path.join("data", file))
             acc = calculate_accuracy(df)
             method_name = file.split("_")[0]
@@ -183,7 +189,7 @@ def plot_answer_length(dataset, ax = None):
     result = []
     enc = tiktoken.get_encoding("cl100k_base")  # Define encoding
     for file in os.listdir("data"):
-        if file.endswith(".csv") and dataset in file:
+        if is_result_file(file, dataset):
             df = pd.read_csv(os.path.join("data", file))
             df = add_classification(df)
             for index, d in df.iterrows():
@@ -206,6 +212,26 @@ def plot_answer_length(dataset, ax = None):
         plt.show()
             
 
+# Prompt tokens that the provider served from its prompt cache are billed at a discount
+CACHED_PROMPT_TOKENS_DISCOUNT = 0.5
+
+def calculate_billed_prompt_tokens(df, count_response_cache_hits=False):
+    """Returns the prompt tokens of each row, where the tokens served from the prompt cache only count with their discounted price.
+    Requests answered by the response cache (`cache_hit_prompt_tokens`) were not sent and are not billed,
+    unless `count_response_cache_hits` is set (e.g. to compare the token usage of techniques independent of the cache)."""
+    prompt_tokens = df['prompt_tokens']
+    if 'cache_hit_prompt_tokens' in df.columns and not count_response_cache_hits:
+        prompt_tokens = prompt_tokens - df['cache_hit_prompt_tokens'].fillna(0)
+    if 'cached_prompt_tokens' not in df.columns:
+        return prompt_tokens
+    return prompt_tokens - df['cached_prompt_tokens'].fillna(0) * CACHED_PROMPT_TOKENS_DISCOUNT
+
+def calculate_billed_completion_tokens(df):
+    """Returns the completion tokens of each row without the ones of requests answered by the response cache."""
+    if 'cache_hit_completion_tokens' not in df.columns:
+        return df['completion_tokens']
+    return df['completion_tokens'] - df['cache_hit_completion_tokens'].fillna(0)
+
 def calculate_money_used():
     """Calculates the overall money usage for the azure API."""
     # https://azure.microsoft.com/en-us/pricing/details/cognitive-services/openai-service/
@@ -216,8 +242,8 @@ def calculate_money_used():
     for file in os.listdir("data"):
         if file.endswith(".csv") and 'azure' in file:
             df = pd.read_csv(os.path.join("data", file))
-            input_tokens = df['prompt_tokens'].sum()
-            output_tokens = df['completion_tokens'].sum()
+            input_tokens = calculate_billed_prompt_tokens(df).sum()
+            output_tokens = calculate_billed_completion_tokens(df).sum()
             money_used = (input_tokens / 1000 * INPUT_TOKENS_IN_CHF) + (output_tokens / 1000 * OUTPUT_TOKENS_IN_CHF)
             total_money_used += money_used
     return total_money_used
@@ -0,0 +1,62 @@
+import os
+import sys
+import pandas as pd
+
+from plot_data import classify
+
+def is_correct(df, answer_column):
+    """Returns for each row whether the answer in `answer_column` is correct, see `classify`."""
+    if df.empty:
+        return pd.Series(dtype=bool)
+    return df[['correct_answer', answer_column]].rename(columns={answer_column: 'answer'}).apply(classify, axis=1) == 'Correct'
+
+def calculate_selection_tokens(df):
+    return df['selection_prompt_tokens'].fillna(0) + df['selection_completion_tokens'].fillna(0)
+
+def gate_report(df):
+    """
+    Summarizes the selection gate of a ModelSelection run (see `MODEL_SELECTION_GATE` in techniques/README.md).
+    Rows with a `selection_gate` had different CoT and PaL answers; all other values than "escalated" were decided by the gate.
+    """
+    if 'selection_gate' not in df.columns:
+        return None
+    different = df[df['selection_gate'].notna()]
+    gated = different[different['selection_gate'] != 'escalated']
+    escalated = different[different['selection_gate'] == 'escalated']
+    # In shadow mode the selection request was sent for the gated rows as well
+    shadow = 'selection_prompt_tokens' in gated.columns and gated['selection_prompt_tokens'].notna().any()
+    if shadow:
+        tokens_saved = calculate_selection_tokens(gated).sum()
+        accuracy_delta = (is_correct(gated, 'gate_answer').sum() - is_correct(gated, 'answer').sum()) / len(df)
+    else:
+        # The selection request was not sent, hence its tokens are estimated with the escalated rows
+        tokens_saved = len(gated) * calculate_selection_tokens(escalated).mean() if len(escalated) else float('nan')
+        accuracy_delta = float('nan')
+    return {
+        'Mode': 'shadow' if shadow else 'on',
+        'Questions': len(df),
+        'Different answers': len(different),
+        'Selection calls avoided': len(gated),
+        'Gate accuracy': is_correct(gated, 'gate_answer').mean() if len(gated) else float('nan'),
+        'Accuracy delta': accuracy_delta,
+        'Tokens saved': tokens_saved,
+    }
+
+def create_dataframe(directory="data"):
+    results = []
+    for file in sorted(os.listdir(directory)):
+        if file.startswith("ModelSelection_") and file.endswith(".csv"):
+            report = gate_report(pd.read_csv(os.path.join(directory, file)))
+            if report is not None:
+                parts = file.split("_")
+                results.append({'Dataset': "_".join(parts[2:-2]), 'Shot': parts[1], **report})
+    return pd.DataFrame(results)
+
+if __name__ == '__main__':
+    df = create_dataframe(sys.argv[1] if len(sys.argv) > 1 else "data")
+    if df.empty:
+        print("No ModelSelection results with a selection_gate column found")
+    else:
+        print(df.to_string(index=False))
+        print()
+        print(df.groupby('Dataset')[['Questions', 'Different answers', 'Selection calls avoided', 'Tokens saved']].sum().to_string())
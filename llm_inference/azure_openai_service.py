@@ -1,22 +1,31 @@
 import os
-from openai import AzureOpenAI
 from openai.types.chat import ChatCompletionMessageParam
 from typing import List
 
-from .llm_interface import LLMInterface
+from .llm_interface import LLMInterface, record_cached_prompt_tokens
+from .client_registry import get_client, get_async_client
 
 class AzureOpenAIService(LLMInterface):
-    def __init__(self, model_name, temperature, max_tokens):
+    def __init__(self, model_name, temperature, max_tokens, endpoint=None, api_key=None, deployment=None):
+        """
+        The endpoint and key default to `AZURE_OPENAI_ENDPOINT` and `AZURE_OPENAI_KEY`, the deployment to the model name
+        and the API version to `AZURE_OPENAI_API_VERSION` (default: 2024-10-21).
+        Several deployments are combined with `endpoint_pool.py`.
+        """
         super().__init__(model_name, temperature, max_tokens)
-        self.client = AzureOpenAI(
-            api_version="2023-05-15",
-            api_key=os.getenv("AZURE_OPENAI_KEY"),
-            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
-        )
+        self.endpoint = endpoint or os.getenv("AZURE_OPENAI_ENDPOINT")
+        self.api_key = api_key or os.getenv("AZURE_OPENAI_KEY")
+        self.deployment = deployment or model_name
+        # API versions before 2024-10-01 do not report the cached prompt tokens (`prompt_tokens_details`)
+        self.api_version = os.getenv("AZURE_OPENAI_API_VERSION", "2024-10-21")
+        # Timeout of a single attempt in seconds. Retries are handled by `retry.py`, hence the clients do not retry themselves.
+        self.timeout = float(os.getenv("LLM_REQUEST_TIMEOUT", "60"))
+        # The clients are shared by all services of the process (see client_registry.py)
+        self.client = get_client("azure", self.endpoint, self.api_key, api_version=self.api_version, timeout=self.timeout)
 
     def make_request(self, messages: List[ChatCompletionMessageParam]) -> tuple[str, int, int]:
         response = self.client.chat.completions.create(
-            model=self.model_name,
+            model=self.deployment,
             messages=messages,
             max_tokens=self.max_tokens,
             temperature=self.temperature,
@@ -24,4 +33,82 @@ class AzureOpenAIService(LLMInterface):
         response_message = response.choices[0].message.content
         completion_tokens_used = response.usage.completion_tokens
         prompt_tokens_used = response.usage.prompt_tokens
-        return response_message, prompt_tokens_used, completion_tokens_used
\ No newline at end of file
+        record_cached_prompt_tokens(response.usage)
+        return response_message, prompt_tokens_used, completion_tokens_used
+
+    async def make_request_async(self, messages: List[ChatCompletionMessageParam]) -> tuple[str, int, int]:
+        async_client = get_async_client("azure", self.endpoint, self.api_key, api_version=self.api_version, timeout=self.timeout)
+        response = await async_client.chat.completions.create(
+            model=self.deployment,
+            messages=messages,
+            max_tokens=self.max_tokens,
+            temperature=self.temperature,
+        )
+        response_message = response.choices[0].message.content
+        completion_tokens_used = response.usage.completion_tokens
+        prompt_tokens_used = response.usage.prompt_tokens
+        record_cached_prompt_tokens(response.usage)
+        return response_message, prompt_tokens_used, completion_tokens_used
+
+    def make_request_n(self, messages: List[ChatCompletionMessageParam], n: int) -> tuple[list[str], int, int]:
+        response = self.client.chat.completions.create(
+            model=self.deployment,
+            messages=messages,
+            max_tokens=self.max_tokens,
+            temperature=self.temperature,
+            n=n,
+        )
+        record_cached_prompt_tokens(response.usage)
+        return [choice.message.content for choice in response.choices], response.usage.prompt_tokens, response.usage.completion_tokens
+
+    async def make_request_n_async(self, messages: List[ChatCompletionMessageParam], n: int) -> tuple[list[str], int, int]:
+        async_client = get_async_client("azure", self.endpoint, self.api_key, api_version=self.api_version, timeout=self.timeout)
+        response = await async_client.chat.completions.create(
+            model=self.deployment,
+            messages=messages,
+            max_tokens=self.max_tokens,
+            temperature=self.temperature,
+            n=n,
+        )
+        record_cached_prompt_tokens(response.usage)
+        return [choice.message.content for choice in response.choices], response.usage.prompt_tokens, response.usage.completion_tokens
+
+    def stream_request(self, messages: List[ChatCompletionMessageParam]):
+        # The usage of streamed responses is not requested (`stream_options`), it is estimated by make_request_until
+        stream = self.client.chat.completions.create(
+            model=self.deployment,
+            messages=messages,
+            max_tokens=self.max_tokens,
+            temperature=self.temperature,
+            stream=True,
+        )
+        try:
+            for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if getattr(chunk, "usage", None) is not None:
+                    record_cached_prompt_tokens(chunk.usage)
+                    yield delta, chunk.usage.prompt_tokens, chunk.usage.completion_tokens
+                else:
+                    yield delta, None, None
+        finally:
+            stream.close()
+
+    async def stream_request_async(self, messages: List[ChatCompletionMessageParam]):
+        async_client = get_async_client("azure", self.endpoint, self.api_key, api_version=self.api_version, timeout=self.timeout)
+        stream = await async_client.chat.completions.create(
+            model=self.deployment,
+            messages=messages,
+            max_tokens=self.max_tokens,
+            temperature=self.temperature,
+            stream=True,
+        )
+        try:
+            async for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if getattr(chunk, "usage", None) is not None:
+                    record_cached_prompt_tokens(chunk.usage)
+                    yield delta, chunk.usage.prompt_tokens, chunk.usage.completion_tokens
+                else:
+                    yield delta, None, None
+        finally:
+            await stream.close()
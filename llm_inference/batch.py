@@ -0,0 +1,61 @@
+"""
+Helpers for the JSONL format of the (Azure) OpenAI Batch API.
+
+Each line of a request file contains one chat completion request, identified by a `custom_id`.
+The result file returned by the Batch API contains one line per request with the same `custom_id`.
+See https://platform.openai.com/docs/guides/batch for the format.
+"""
+import json
+import os
+
+
+def batch_request_line(custom_id: str, messages: list, service_name: str, model_name: str, temperature: float, max_tokens: int) -> dict:
+    """ Returns one line of a batch request file for a chat completion request. """
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        # Azure addresses the deployment via the model field and does not use the /v1 prefix
+        "url": "/chat/completions" if service_name == "azure" else "/v1/chat/completions",
+        "body": {
+            "model": model_name,
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+        },
+    }
+
+
+def write_batch_requests(path: str, lines: list[dict]):
+    """ Writes the request lines to a JSONL file, which can be uploaded to the Batch API. """
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as file:
+        for line in lines:
+            file.write(json.dumps(line, ensure_ascii=False) + "\n")
+
+
+def read_batch_results(paths: list[str]) -> dict:
+    """
+    Reads one or more result files of the Batch API.
+    
+    Returns:
+        dict: Maps each custom_id to a (response, prompt_tokens, completion_tokens) tuple, like `make_request`.
+        Failed requests are left out, such that they are requested again in the next round.
+    """
+    results = {}
+    for path in paths:
+        with open(path, encoding="utf-8") as file:
+            for raw_line in file:
+                if not raw_line.strip():
+                    continue
+                line = json.loads(raw_line)
+                response = line.get("response") or {}
+                if line.get("error") or response.get("status_code") != 200:
+                    continue
+                body = response["body"]
+                results[line["custom_id"]] = (
+                    body["choices"][0]["message"]["content"],
+                    body["usage"]["prompt_tokens"],
+                    body["usage"]["completion_tokens"],
+                )
+    return results
@@ -0,0 +1,94 @@
+"""
+Process-wide registry of API clients.
+
+Creating an `OpenAI`/`AzureOpenAI` client creates a new HTTP connection pool, so every new client pays for new
+TCP/TLS handshakes. The services therefore get their clients from this registry, which hands out one shared client
+per (service, endpoint, parameters). The synchronous clients are thread-safe. Asynchronous clients are bound to the
+event loop they are used in, hence they are shared per event loop and closed when it ends.
+"""
+import asyncio
+import os
+import threading
+
+import httpx
+from openai import OpenAI, AsyncOpenAI, AzureOpenAI, AsyncAzureOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
+
+_clients = {}
+_async_clients = {}     # event loop -> {key: client}, until the loop ends (see `_close_when_loop_ends`)
+_closing_tasks = {}     # event loop -> task of `_close_when_loop_ends`
+_lock = threading.Lock()
+
+
+def get_connection_limits() -> httpx.Limits:
+    """
+    Returns the connection pool limits of the shared clients, configured with the environment variables
+    `LLM_MAX_CONNECTIONS`, `LLM_MAX_KEEPALIVE_CONNECTIONS` and `LLM_KEEPALIVE_EXPIRY` (in seconds).
+    """
+    return httpx.Limits(
+        max_connections=int(os.getenv("LLM_MAX_CONNECTIONS", "100")),
+        max_keepalive_connections=int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "20")),
+        keepalive_expiry=float(os.getenv("LLM_KEEPALIVE_EXPIRY", "60")),
+    )
+
+
+def _create_client(service_name: str, endpoint: str, api_key: str, api_version: str, timeout: float, asynchronous: bool):
+    # The services retry themselves (see retry.py), hence max_retries=0
+    if asynchronous:
+        http_client = DefaultAsyncHttpxClient(limits=get_connection_limits())
+    else:
+        http_client = DefaultHttpxClient(limits=get_connection_limits())
+    if service_name == "azure":
+        client_class = AsyncAzureOpenAI if asynchronous else AzureOpenAI
+        return client_class(api_version=api_version, api_key=api_key, azure_endpoint=endpoint, timeout=timeout, max_retries=0, http_client=http_client)
+    elif service_name == "openai":
+        client_class = AsyncOpenAI if asynchronous else OpenAI
+        return client_class(api_key=api_key, base_url=endpoint, timeout=timeout, max_retries=0, http_client=http_client)
+    else:
+        raise Exception("Unsupported LLM service type")
+
+
+def get_client(service_name: str, endpoint: str, api_key: str, api_version: str = None, timeout: float = 60.0):
+    """
+    Returns the shared synchronous client for the given service, endpoint and parameters.
+    
+    Parameters:
+        service_name (str): 'azure' or 'openai'.
+        endpoint (str): Endpoint (Azure) or base URL (OpenAI, None for the default).
+        api_key (str): API key of the endpoint.
+        api_version (str): API version (only used by Azure).
+        timeout (float): Timeout of a single request in seconds.
+    """
+    key = (service_name, endpoint, api_key, api_version, timeout)
+    with _lock:
+        if key not in _clients:
+            _clients[key] = _create_client(service_name, endpoint, api_key, api_version, timeout, asynchronous=False)
+        return _clients[key]
+
+
+def get_async_client(service_name: str, endpoint: str, api_key: str, api_version: str = None, timeout: float = 60.0):
+    """ Same as `get_client`, but returns the asynchronous client shared within the running event loop. """
+    key = (service_name, endpoint, api_key, api_version, timeout)
+    loop = asyncio.get_running_loop()
+    with _lock:
+        if loop not in _async_clients:
+            _async_clients[loop] = {}
+            _closing_tasks[loop] = loop.create_task(_close_when_loop_ends(loop))
+        loop_clients = _async_clients[loop]
+        if key not in loop_clients:
+            loop_clients[key] = _create_client(service_name, endpoint, api_key, api_version, timeout, asynchronous=True)
+        return loop_clients[key]
+
+
+async def _close_when_loop_ends(loop: asyncio.AbstractEventLoop):
+    """
+    Waits until the event loop ends and closes its clients with their connection pools. `asyncio.run` cancels the
+    tasks that are still pending before it closes the loop, which runs this task to the end within the loop.
+    """
+    try:
+        await loop.create_future()
+    finally:
+        with _lock:
+            loop_clients = _async_clients.pop(loop, {})
+            _closing_tasks.pop(loop, None)
+        for client in loop_clients.values():
+            await client.close()
@@ -0,0 +1,132 @@
+"""
+Single-flight coalescing of identical requests.
+
+Concurrent callers that send exactly the same request (e.g. the CoT and PaL requests of ModelSelection while the
+standalone CoT and PaL runs of the same sweep are in flight, or duplicate questions of a dataset) wait for the one
+outstanding request and share its response, instead of each paying for their own API call.
+"""
+import asyncio
+import threading
+from concurrent.futures import Future
+
+from .llm_interface import LLMInterface, LLMServiceWrapper
+from .request_stats import add_request_stat, set_request_stat
+from .response_cache import request_key
+
+
+class InFlightRequests:
+    """ The requests of one deployment that are currently in flight, keyed by the hash of the request. """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+
+    def join(self, key) -> tuple[Future, bool]:
+        """
+        Returns the future of the request `key` and whether the caller is the leader, which has to send the request
+        and complete the future (see `complete`). All other callers wait for the future.
+        """
+        with self.lock:
+            if key in self.requests:
+                return self.requests[key], False
+            future = Future()
+            self.requests[key] = future
+            return future, True
+
+    def complete(self, key, future: Future, result=None, exception: BaseException = None):
+        """ Publishes the result (or exception) of the leader to all waiting callers. """
+        with self.lock:
+            del self.requests[key]
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+def get_in_flight_requests(service_name: str, model_name: str) -> InFlightRequests:
+    """ Returns the process-wide in-flight requests of a deployment, such that all services (and all techniques) share them. """
+    with _in_flight_lock:
+        key = (service_name, model_name)
+        if key not in _in_flight:
+            _in_flight[key] = InFlightRequests()
+        return _in_flight[key]
+
+
+class CoalescingLLMService(LLMServiceWrapper):
+    """
+    Lets concurrent identical requests share one call of the wrapped service.
+    
+    The tokens of a shared request are attributed once, to the caller that sent it. The other callers get the response
+    with 0 tokens and the `shared_response` flag in their request stats. Like the response cache, only deterministic
+    requests (temperature 0) are coalesced, since sampled responses are expected to differ between calls.
+    """
+    def __init__(self, service: LLMInterface, in_flight: InFlightRequests):
+        """
+        Parameters:
+            service (LLMInterface): The wrapped service.
+            in_flight (InFlightRequests): The requests in flight, shared by all services of the deployment.
+        """
+        super().__init__(service)
+        self.in_flight = in_flight
+
+    def _request_key(self, messages, variant=None):
+        if self.temperature != 0:
+            return None
+        return request_key(messages, self.model_name, self.temperature, self.max_tokens, variant)
+
+    @staticmethod
+    def _shared(result):
+        response, _, _ = result
+        set_request_stat("shared_response", True)
+        add_request_stat("shared_requests", 1)
+        return response, 0, 0
+
+    def _coalesced_call(self, key, call):
+        if key is None:
+            return call()
+        future, leader = self.in_flight.join(key)
+        if not leader:
+            return self._shared(future.result())
+        try:
+            result = call()
+        except BaseException as e:
+            self.in_flight.complete(key, future, exception=e)
+            raise
+        self.in_flight.complete(key, future, result=result)
+        return result
+
+    async def _coalesced_call_async(self, key, call):
+        if key is None:
+            return await call()
+        future, leader = self.in_flight.join(key)
+        if not leader:
+            return self._shared(await asyncio.wrap_future(future))
+        try:
+            result = await call()
+        except BaseException as e:
+            self.in_flight.complete(key, future, exception=e)
+            raise
+        self.in_flight.complete(key, future, result=result)
+        return result
+
+    def make_request(self, messages):
+        return self._coalesced_call(self._request_key(messages), lambda: self.service.make_request(messages))
+
+    async def make_request_async(self, messages):
+        return await self._coalesced_call_async(self._request_key(messages), lambda: self.service.make_request_async(messages))
+
+    def make_request_n(self, messages, n):
+        return self._coalesced_call(self._request_key(messages, variant=f"n:{n}"), lambda: self.service.make_request_n(messages, n))
+
+    async def make_request_n_async(self, messages, n):
+        return await self._coalesced_call_async(self._request_key(messages, variant=f"n:{n}"), lambda: self.service.make_request_n_async(messages, n))
+
+    def make_request_until(self, messages, stop_condition):
+        key = self._request_key(messages, variant="stream:" + getattr(stop_condition, "__qualname__", ""))
+        return self._coalesced_call(key, lambda: self.service.make_request_until(messages, stop_condition))
+
+    async def make_request_until_async(self, messages, stop_condition):
+        key = self._request_key(messages, variant="stream:" + getattr(stop_condition, "__qualname__", ""))
+        return await self._coalesced_call_async(key, lambda: self.service.make_request_until_async(messages, stop_condition))
@@ -0,0 +1,222 @@
+"""
+Load balancing over several Azure OpenAI deployments, such that the throughput is not capped by the quota of one deployment.
+
+The deployments are configured with the environment variable `AZURE_OPENAI_DEPLOYMENTS`, a JSON list like
+    [{"name": "east", "endpoint": "https://east.openai.azure.com/", "key": "...", "deployment": "gpt-35-turbo",
+      "weight": 2, "requests_per_minute": 720, "tokens_per_minute": 120000}, ...]
+Only `endpoint` is required: `key` defaults to `AZURE_OPENAI_KEY` (or the variable named by `key_env`), `deployment`
+to the model name, `weight` to 1 and the quotas to `LLM_REQUESTS_PER_MINUTE` and `LLM_TOKENS_PER_MINUTE`.
+"""
+import json
+import os
+import threading
+import time
+
+from .llm_interface import LLMInterface
+from .rate_limiter import RateLimiter, RateLimitedLLMService
+from .retry import is_retryable_error
+
+
+class PoolEndpoint:
+    """ One deployment of a pool, with its own rate limiter, health state and statistics. """
+    def __init__(self, name: str, endpoint: str, api_key: str, deployment: str, weight: float, requests_per_minute: float, tokens_per_minute: float):
+        self.name = name
+        self.endpoint = endpoint
+        self.api_key = api_key
+        self.deployment = deployment
+        self.weight = weight
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.latency_in_seconds = 0.0
+        self.ejections = 0
+        self.consecutive_failures = 0
+        self.ejected_until = None   # None if the endpoint is healthy
+        self.ejection_time = None   # Set by the pool
+        self.probing = False
+
+
+class EndpointPool:
+    """
+    Routes each request to one of several deployments.
+    
+    With the `least_loaded` strategy, the endpoint with the fewest requests in flight (relative to its weight) is chosen,
+    with the `quota` strategy the endpoint with the largest available rate limit budget (times its weight).
+    Endpoints that are paused after a 429 response are only chosen if no other endpoint is available.
+    
+    An endpoint is ejected after `failure_threshold` consecutive transient failures. After `ejection_time` seconds,
+    a single probe request is routed to it: if it succeeds the endpoint rejoins the pool, otherwise it is ejected
+    again for twice as long (up to `max_ejection_time`).
+    """
+    def __init__(self, endpoints: list, strategy: str = "least_loaded", failure_threshold: int = 3, ejection_time: float = 10.0, max_ejection_time: float = 120.0):
+        if strategy not in ["least_loaded", "quota"]:
+            raise ValueError(f"Unknown routing strategy {strategy}")
+        self.endpoints = endpoints
+        self.strategy = strategy
+        self.failure_threshold = failure_threshold
+        self.initial_ejection_time = ejection_time
+        self.max_ejection_time = max_ejection_time
+        for endpoint in endpoints:
+            endpoint.ejection_time = ejection_time
+        self._lock = threading.Lock()
+
+    def _score(self, endpoint: PoolEndpoint) -> tuple:
+        """ Lower is better. """
+        available = endpoint.rate_limiter.available_fraction()
+        if self.strategy == "quota":
+            return (available == 0, -available * endpoint.weight, endpoint.in_flight / endpoint.weight)
+        return (available == 0, endpoint.in_flight / endpoint.weight, -available)
+
+    def acquire(self) -> PoolEndpoint:
+        """ Chooses the endpoint for the next request, which has to be passed to `release` once the request is done. """
+        with self._lock:
+            now = time.monotonic()
+            healthy = [endpoint for endpoint in self.endpoints if endpoint.ejected_until is None]
+            probes = [endpoint for endpoint in self.endpoints 
+                      if endpoint.ejected_until is not None and endpoint.ejected_until <= now and not endpoint.probing]
+            if probes:
+                chosen = probes[0]
+                chosen.probing = True
+            elif healthy:
+                chosen = min(healthy, key=self._score)
+            else:
+                # All endpoints are ejected: use the one that recovers first, the circuit breaker (see retry.py) handles total outages
+                chosen = min(self.endpoints, key=lambda endpoint: endpoint.ejected_until)
+            chosen.in_flight += 1
+            return chosen
+
+    def release(self, endpoint: PoolEndpoint, latency_in_seconds: float, exception: Exception = None):
+        """ Records the outcome of a request sent to `endpoint`, ejecting it if it failed repeatedly. """
+        with self._lock:
+            endpoint.in_flight -= 1
+            endpoint.requests += 1
+            endpoint.latency_in_seconds += latency_in_seconds
+            if exception is None:
+                endpoint.consecutive_failures = 0
+                endpoint.ejected_until = None
+                endpoint.probing = False
+                endpoint.ejection_time = self.initial_ejection_time
+                return
+            endpoint.errors += 1
+            # Rate limits are handled by the rate limiter of the endpoint, other non-transient errors say nothing about its health
+            if not is_retryable_error(exception) or getattr(exception, "status_code", None) == 429:
+                endpoint.probing = False
+                return
+            endpoint.consecutive_failures += 1
+            if endpoint.probing:
+                endpoint.ejection_time = min(self.max_ejection_time, endpoint.ejection_time * 2)
+            # Requests that were in flight when the endpoint was ejected do not eject it again
+            if endpoint.probing or (endpoint.ejected_until is None and endpoint.consecutive_failures >= self.failure_threshold):
+                endpoint.ejected_until = time.monotonic() + endpoint.ejection_time
+                endpoint.ejections += 1
+                print(f"Endpoint {endpoint.name} ejected after {endpoint.consecutive_failures} consecutive failures for {endpoint.ejection_time:.1f} seconds.")
+            endpoint.probing = False
+
+    def stats(self) -> list:
+        """ Returns the request, error and latency statistics of every endpoint. """
+        with self._lock:
+            return [{
+                "name": endpoint.name,
+                "requests": endpoint.requests,
+                "errors": endpoint.errors,
+                "in_flight": endpoint.in_flight,
+                "mean_latency_in_seconds": endpoint.latency_in_seconds / endpoint.requests if endpoint.requests else None,
+                "ejections": endpoint.ejections,
+                "ejected": endpoint.ejected_until is not None,
+            } for endpoint in self.endpoints]
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_endpoint_pool(model_name: str) -> EndpointPool:
+    """
+    Returns the process-wide pool of the deployments configured in `AZURE_OPENAI_DEPLOYMENTS` for `model_name`.
+    The routing strategy is read from `AZURE_OPENAI_ROUTING` (`least_loaded` or `quota`).
+    """
+    with _pools_lock:
+        if model_name not in _pools:
+            endpoints = []
+            for index, config in enumerate(json.loads(os.environ["AZURE_OPENAI_DEPLOYMENTS"])):
+                endpoints.append(PoolEndpoint(
+                    name=config.get("name", str(index)),
+                    endpoint=config["endpoint"],
+                    api_key=config.get("key") or os.getenv(config.get("key_env", "AZURE_OPENAI_KEY")),
+                    deployment=config.get("deployment", model_name),
+                    weight=float(config.get("weight", 1)),
+                    requests_per_minute=float(config.get("requests_per_minute", os.getenv("LLM_REQUESTS_PER_MINUTE", "720"))),
+                    tokens_per_minute=float(config.get("tokens_per_minute", os.getenv("LLM_TOKENS_PER_MINUTE", "120000"))),
+                ))
+            _pools[model_name] = EndpointPool(endpoints, strategy=os.getenv("AZURE_OPENAI_ROUTING", "least_loaded"))
+        return _pools[model_name]
+
+def endpoint_statistics() -> dict:
+    """ Returns the statistics of every pool used in this process, keyed by model name. """
+    with _pools_lock:
+        return {model_name: pool.stats() for model_name, pool in _pools.items()}
+
+
+def create_azure_service(model_name, temperature, max_tokens) -> LLMInterface:
+    """ Creates the Azure service, which balances the requests over a pool if `AZURE_OPENAI_DEPLOYMENTS` is set. """
+    if os.getenv("AZURE_OPENAI_DEPLOYMENTS"):
+        return PooledLLMService(model_name, temperature, max_tokens, get_endpoint_pool(model_name))
+    from .azure_openai_service import AzureOpenAIService
+    return AzureOpenAIService(model_name, temperature, max_tokens)
+
+
+class PooledLLMService(LLMInterface):
+    """ Sends each request to one deployment of an `EndpointPool`, each deployment is rate limited individually. """
+    limits_own_rate = True
+
+    def __init__(self, model_name, temperature, max_tokens, pool: EndpointPool):
+        # Imported here, such that the statistics of the pools are available without importing openai
+        from .azure_openai_service import AzureOpenAIService
+        super().__init__(model_name, temperature, max_tokens)
+        self.pool = pool
+        self.services = {
+            endpoint.name: RateLimitedLLMService(
+                AzureOpenAIService(model_name, temperature, max_tokens, endpoint=endpoint.endpoint, api_key=endpoint.api_key, deployment=endpoint.deployment),
+                endpoint.rate_limiter)
+            for endpoint in pool.endpoints
+        }
+
+    def _call_routed(self, call):
+        endpoint = self.pool.acquire()
+        start = time.monotonic()
+        try:
+            result = call(self.services[endpoint.name])
+        except BaseException as e:
+            self.pool.release(endpoint, time.monotonic() - start, e)
+            raise
+        self.pool.release(endpoint, time.monotonic() - start)
+        return result
+
+    async def _call_routed_async(self, call):
+        endpoint = self.pool.acquire()
+        start = time.monotonic()
+        try:
+            result = await call(self.services[endpoint.name])
+        except BaseException as e:     # Including cancellations, which must release the endpoint as well
+            self.pool.release(endpoint, time.monotonic() - start, e)
+            raise
+        self.pool.release(endpoint, time.monotonic() - start)
+        return result
+
+    def make_request(self, messages):
+        return self._call_routed(lambda service: service.make_request(messages))
+
+    async def make_request_async(self, messages):
+        return await self._call_routed_async(lambda service: service.make_request_async(messages))
+
+    def make_request_n(self, messages, n):
+        return self._call_routed(lambda service: service.make_request_n(messages, n))
+
+    async def make_request_n_async(self, messages, n):
+        return await self._call_routed_async(lambda service: service.make_request_n_async(messages, n))
+
+    def make_request_until(self, messages, stop_condition):
+        return self._call_routed(lambda service: service.make_request_until(messages, stop_condition))
+
+    async def make_request_until_async(self, messages, stop_condition):
+        return await self._call_routed_async(lambda service: service.make_request_until_async(messages, stop_condition))
@@ -1,19 +1,43 @@
+import os
 from dotenv import load_dotenv
 
-from .azure_openai_service import AzureOpenAIService
-from .openai_service import OpenAIService
+from .coalescing import CoalescingLLMService, get_in_flight_requests
+from .rate_limiter import RateLimitedLLMService, get_rate_limiter
+from .response_cache import CachedLLMService, get_response_cache
+from .registry import LazyRegistry
+from .retry import RetryingLLMService, get_circuit_breaker, get_retry_policy
 
 load_dotenv()   # Load the environment variables located in the .env file
 
-def get_llm_service(service_name, model_name, temperature, max_tokens):
+# The services are imported on first use (see registry.py), since importing openai is slow.
+# A service is registered with a factory taking (model_name, temperature, max_tokens).
+services = LazyRegistry("service")
+services.register("azure", "llm_inference.endpoint_pool:create_azure_service")
+services.register("openai", "llm_inference.openai_service:OpenAIService")
+services.register("replay", "llm_inference.replay_service:ReplayService.from_environment")
+
+def get_llm_service(service_name, model_name, temperature, max_tokens, use_cache=True):
     """
     Get an instance of a Language Model Service.
+    
+    Transient failures (timeouts, 429, 5xx) are retried with exponential backoff, and a circuit breaker
+    pauses all requests while the endpoint is unhealthy (see `retry.py`).
+    Concurrent identical requests share one call, including its retries (see `coalescing.py`).
+    All requests go through a rate limiter that is shared by every service of the same deployment
+    (see `rate_limiter.py`), configured with `LLM_REQUESTS_PER_MINUTE` and `LLM_TOKENS_PER_MINUTE`.
+    If `AZURE_OPENAI_DEPLOYMENTS` is set, Azure requests are balanced over several deployments (see `endpoint_pool.py`).
+    
+    The returned service is wrapped in a persistent response cache (see `response_cache.py`), such that
+    requests that were already answered in an earlier run are not paid for again. The cache can be
+    configured with the environment variables `LLM_CACHE_PATH`, `LLM_CACHE_MAX_MB` and `LLM_CACHE_BYPASS`.
 
     Parameters:
         service_name (str): Name of the LLM service provider.
         model_name (str): Name of the language model to use.
         temperature (float): Sampling temperature for generating responses.
         max_tokens (int): Maximum number of tokens to generate in each response.
+        use_cache (bool): If False, the service is returned without the response cache (services that are not
+            `cacheable`, like the replay service, never use it).
         
     Returns:
         LLMInterface: Instance of a concrete implementation of LLMInterface.
@@ -21,9 +45,14 @@ def get_llm_service(service_name, model_name, temperature, max_tokens):
     Raises:
         Exception: If the specified LLM service type is unsupported.
     """
-    if service_name == 'azure':
-        return AzureOpenAIService(model_name, temperature, max_tokens)
-    elif service_name == 'openai':
-        return OpenAIService(model_name, temperature, max_tokens)
-    else:
-        raise Exception("Unsupported LLM service type")
\ No newline at end of file
+    if service_name not in services.names():
+        raise Exception("Unsupported LLM service type")
+    service = services.get(service_name)(model_name, temperature, max_tokens)
+    if not service.limits_own_rate:
+        service = RateLimitedLLMService(service, get_rate_limiter(service_name, model_name))
+    service = RetryingLLMService(service, get_retry_policy(), get_circuit_breaker(service_name, model_name))
+    service = CoalescingLLMService(service, get_in_flight_requests(service_name, model_name))
+    if use_cache and service.cacheable:
+        bypass = os.getenv("LLM_CACHE_BYPASS", "0") == "1"
+        service = CachedLLMService(service, get_response_cache(), bypass=bypass)
+    return service
@@ -1,4 +1,25 @@
+import asyncio
+import time
+
+from .request_stats import add_request_stat, set_request_stat
+from .tokens import estimate_prompt_tokens
+
+
+def record_cached_prompt_tokens(usage):
+    """
+    Records how many prompt tokens of a response the provider served from its prompt cache, which are billed at a discount.
+    Providers (and API versions) that do not report it count as 0.
+    """
+    details = getattr(usage, "prompt_tokens_details", None)
+    add_request_stat("cached_prompt_tokens", getattr(details, "cached_tokens", None) or 0)
+
+
 class LLMInterface:
+    # True for services that rate limit their requests themselves (e.g. a pool of deployments with individual quotas)
+    limits_own_rate = False
+    # False for services whose responses must not be stored in the response cache (e.g. replayed responses)
+    cacheable = True
+
     def __init__(self, model_name, temperature, max_tokens):
         """
         Initialize the LLMInterface.
@@ -22,4 +43,156 @@ class LLMInterface:
         Returns:
             str: Generated response from the language model.
         """
-        raise NotImplementedError
\ No newline at end of file
+        raise NotImplementedError
+
+    async def make_request_async(self, messages):
+        """
+        Asynchronous version of `make_request`.
+
+        Services with a native asynchronous client should override this method. The default
+        implementation runs the blocking `make_request` in a worker thread, such that every
+        service can be used by the concurrent scheduler in `run.py`.
+
+        Parameters:
+            messages (list): List of messages formatted for input to the language model.
+
+        Returns:
+            The same result as `make_request`.
+        """
+        return await asyncio.to_thread(self.make_request, messages)
+
+    def make_request_n(self, messages, n):
+        """
+        Samples `n` responses to the same messages.
+
+        Services whose API can return several choices for one request (the `n` parameter) override this method,
+        such that the prompt is sent and paid for once. The default implementation sends `n` requests.
+
+        Parameters:
+            messages (list): List of messages formatted for input to the language model.
+            n (int): Number of responses.
+
+        Returns:
+            tuple[list[str], int, int]: The responses, prompt tokens, and completion tokens of all responses.
+        """
+        results = [self.make_request(messages) for _ in range(n)]
+        return [result[0] for result in results], sum(result[1] for result in results), sum(result[2] for result in results)
+
+    async def make_request_n_async(self, messages, n):
+        """ Asynchronous version of `make_request_n`. The default implementation sends the `n` requests concurrently. """
+        results = await asyncio.gather(*(self.make_request_async(messages) for _ in range(n)))
+        return [result[0] for result in results], sum(result[1] for result in results), sum(result[2] for result in results)
+
+    def stream_request(self, messages):
+        """
+        Streams the response of the language model incrementally.
+        
+        Services that support streaming override this method. The default implementation yields
+        the whole response of `make_request` as a single chunk.
+
+        Parameters:
+            messages (list): List of messages formatted for input to the language model.
+
+        Yields:
+            tuple[str, int, int]: (text, prompt_tokens, completion_tokens). The token counts are None,
+            except for the last chunk if the service reports the usage of the request.
+        """
+        response, prompt_tokens, completion_tokens = self.make_request(messages)
+        yield response, prompt_tokens, completion_tokens
+
+    async def stream_request_async(self, messages):
+        """ Asynchronous version of `stream_request`. """
+        response, prompt_tokens, completion_tokens = await self.make_request_async(messages)
+        yield response, prompt_tokens, completion_tokens
+
+    def make_request_until(self, messages, stop_condition):
+        """
+        Streams the response and closes the stream as soon as `stop_condition` holds for the text received so far,
+        e.g. once the final answer was emitted. This saves the time and completion tokens of the remaining response.
+        
+        The time until the stop condition held and whether the stream was stopped early are recorded as 
+        `time_to_answer_in_seconds` and `stopped_early` (see `request_stats.py`).
+
+        Parameters:
+            messages (list): List of messages formatted for input to the language model.
+            stop_condition (Callable[[str], bool]): Returns True once the response contains everything that is needed.
+
+        Returns:
+            tuple[str, int, int]: The (possibly truncated) response, prompt tokens, and completion tokens.
+        """
+        start = time.monotonic()
+        stream = self.stream_request(messages)
+        text, chunks, usage, stopped_early = "", 0, None, False
+        try:
+            for delta, prompt_tokens, completion_tokens in stream:
+                if prompt_tokens is not None:
+                    usage = prompt_tokens, completion_tokens
+                text += delta or ""
+                chunks += 1 if delta else 0
+                if stop_condition(text):
+                    stopped_early = True
+                    break
+        finally:
+            stream.close()  # Closes the HTTP stream, the server stops generating
+        return self._finish_stream(messages, text, chunks, usage, stopped_early, start)
+
+    async def make_request_until_async(self, messages, stop_condition):
+        """ Asynchronous version of `make_request_until`. """
+        start = time.monotonic()
+        stream = self.stream_request_async(messages)
+        text, chunks, usage, stopped_early = "", 0, None, False
+        try:
+            async for delta, prompt_tokens, completion_tokens in stream:
+                if prompt_tokens is not None:
+                    usage = prompt_tokens, completion_tokens
+                text += delta or ""
+                chunks += 1 if delta else 0
+                if stop_condition(text):
+                    stopped_early = True
+                    break
+        finally:
+            await stream.aclose()
+        return self._finish_stream(messages, text, chunks, usage, stopped_early, start)
+
+    def _finish_stream(self, messages, text, chunks, usage, stopped_early, start):
+        set_request_stat("stopped_early", stopped_early)
+        add_request_stat("time_to_answer_in_seconds", time.monotonic() - start)
+        if usage is not None:
+            return text, usage[0], usage[1]
+        # The usage is only reported at the end of a stream (if at all), estimate it otherwise.
+        # Each chunk of a chat completion stream contains one token.
+        return text, estimate_prompt_tokens(messages), chunks
+
+
+class LLMServiceWrapper(LLMInterface):
+    """
+    Base class for layers that add behaviour (e.g. caching) around another LLM service.
+    By default, every request is forwarded unchanged to the wrapped service.
+    """
+    def __init__(self, service: LLMInterface):
+        """
+        Parameters:
+            service (LLMInterface): The wrapped service, which actually answers the requests.
+        """
+        super().__init__(service.model_name, service.temperature, service.max_tokens)
+        self.service = service
+        self.limits_own_rate = service.limits_own_rate
+        self.cacheable = service.cacheable
+
+    def make_request(self, messages):
+        return self.service.make_request(messages)
+
+    async def make_request_async(self, messages):
+        return await self.service.make_request_async(messages)
+
+    def make_request_n(self, messages, n):
+        return self.service.make_request_n(messages, n)
+
+    async def make_request_n_async(self, messages, n):
+        return await self.service.make_request_n_async(messages, n)
+
+    def make_request_until(self, messages, stop_condition):
+        return self.service.make_request_until(messages, stop_condition)
+
+    async def make_request_until_async(self, messages, stop_condition):
+        return await self.service.make_request_until_async(messages, stop_condition)
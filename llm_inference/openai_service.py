@@ -1,14 +1,17 @@
 import os
-from openai import OpenAI
 from openai.types.chat import ChatCompletionMessageParam
 from typing import List
 
-from .llm_interface import LLMInterface
+from .llm_interface import LLMInterface, record_cached_prompt_tokens
+from .client_registry import get_client, get_async_client
 
 class OpenAIService(LLMInterface):
     def __init__(self, model_name, temperature, max_tokens):
         super().__init__(model_name, temperature, max_tokens)
-        self.client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+        # Timeout of a single attempt in seconds. Retries are handled by `retry.py`, hence the clients do not retry themselves.
+        self.timeout = float(os.getenv("LLM_REQUEST_TIMEOUT", "60"))
+        # The clients are shared by all services of the process (see client_registry.py)
+        self.client = get_client("openai", None, os.environ.get("OPENAI_API_KEY"), timeout=self.timeout)
 
     def make_request(self, messages: List[ChatCompletionMessageParam]) -> tuple[str, int, int]:
         response = self.client.chat.completions.create(
@@ -20,4 +23,83 @@ class OpenAIService(LLMInterface):
         response_message = response.choices[0].message.content
         completion_tokens_used = response.usage.completion_tokens
         prompt_tokens_used = response.usage.prompt_tokens
+        record_cached_prompt_tokens(response.usage)
         return response_message, prompt_tokens_used, completion_tokens_used
+
+    async def make_request_async(self, messages: List[ChatCompletionMessageParam]) -> tuple[str, int, int]:
+        async_client = get_async_client("openai", None, os.environ.get("OPENAI_API_KEY"), timeout=self.timeout)
+        response = await async_client.chat.completions.create(
+            model=self.model_name,
+            messages=messages,
+            max_tokens=self.max_tokens,
+            temperature=self.temperature,
+        )
+        response_message = response.choices[0].message.content
+        completion_tokens_used = response.usage.completion_tokens
+        prompt_tokens_used = response.usage.prompt_tokens
+        record_cached_prompt_tokens(response.usage)
+        return response_message, prompt_tokens_used, completion_tokens_used
+
+    def make_request_n(self, messages: List[ChatCompletionMessageParam], n: int) -> tuple[list[str], int, int]:
+        response = self.client.chat.completions.create(
+            model=self.model_name,
+            messages=messages,
+            max_tokens=self.max_tokens,
+            temperature=self.temperature,
+            n=n,
+        )
+        record_cached_prompt_tokens(response.usage)
+        return [choice.message.content for choice in response.choices], response.usage.prompt_tokens, response.usage.completion_tokens
+
+    async def make_request_n_async(self, messages: List[ChatCompletionMessageParam], n: int) -> tuple[list[str], int, int]:
+        async_client = get_async_client("openai", None, os.environ.get("OPENAI_API_KEY"), timeout=self.timeout)
+        response = await async_client.chat.completions.create(
+            model=self.model_name,
+            messages=messages,
+            max_tokens=self.max_tokens,
+            temperature=self.temperature,
+            n=n,
+        )
+        record_cached_prompt_tokens(response.usage)
+        return [choice.message.content for choice in response.choices], response.usage.prompt_tokens, response.usage.completion_tokens
+
+    def stream_request(self, messages: List[ChatCompletionMessageParam]):
+        stream = self.client.chat.completions.create(
+            model=self.model_name,
+            messages=messages,
+            max_tokens=self.max_tokens,
+            temperature=self.temperature,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        try:
+            for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if getattr(chunk, "usage", None) is not None:
+                    record_cached_prompt_tokens(chunk.usage)
+                    yield delta, chunk.usage.prompt_tokens, chunk.usage.completion_tokens
+                else:
+                    yield delta, None, None
+        finally:
+            stream.close()
+
+    async def stream_request_async(self, messages: List[ChatCompletionMessageParam]):
+        async_client = get_async_client("openai", None, os.environ.get("OPENAI_API_KEY"), timeout=self.timeout)
+        stream = await async_client.chat.completions.create(
+            model=self.model_name,
+            messages=messages,
+            max_tokens=self.max_tokens,
+            temperature=self.temperature,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        try:
+            async for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if getattr(chunk, "usage", None) is not None:
+                    record_cached_prompt_tokens(chunk.usage)
+                    yield delta, chunk.usage.prompt_tokens, chunk.usage.completion_tokens
+                else:
+                    yield delta, None, None
+        finally:
+            await stream.close()
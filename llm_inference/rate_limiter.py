@@ -0,0 +1,207 @@
+import asyncio
+import os
+import threading
+import time
+
+from .llm_interface import LLMInterface, LLMServiceWrapper
+from .tokens import estimate_prompt_tokens
+
+
+def get_retry_after(exception) -> float:
+    """ Returns the delay (in seconds) requested by the `Retry-After` headers of a failed request, or None. """
+    response = getattr(exception, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers.get("retry-after-ms")) / 1000.0
+        if headers.get("retry-after") is not None:
+            return float(headers.get("retry-after"))
+    except ValueError:
+        pass
+    return None
+
+
+def is_rate_limit_error(exception) -> bool:
+    """ Returns True if the exception is a HTTP 429 (Too Many Requests) response. """
+    return getattr(exception, "status_code", None) == 429
+
+
+class RateLimiter:
+    """
+    Token-bucket rate limiter that budgets both requests per minute (RPM) and tokens per minute (TPM).
+    
+    Each request reserves one request and its estimated tokens (prompt estimate + max_tokens) before it is sent.
+    Once the response arrives, the unused part of the token estimate is refunded. The buckets refill continuously
+    and nothing is held while a request is in flight, so capacity left idle by slow requests is used by the next ones.
+    
+    On a 429 response, all requests are paused for the Retry-After period and the limits are reduced. 
+    They recover gradually with every successful request, up to the configured limits.
+    """
+    WINDOW_IN_SECONDS = 10      # Bucket capacity, deployments enforce their per-minute limits over short windows
+    BACKOFF_FACTOR = 0.8        # Multiplicative decrease of the limits on a 429
+    RECOVERY_FRACTION = 0.01    # Additive increase of the limits (relative to the maximum) per successful request
+    MIN_FRACTION = 0.1          # The limits never drop below this fraction of the configured maximum
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        """
+        Parameters:
+            requests_per_minute (float): Maximum number of requests per minute of the deployment.
+            tokens_per_minute (float): Maximum number of (prompt + completion) tokens per minute of the deployment.
+        """
+        self.max_requests_per_minute = requests_per_minute
+        self.max_tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._available_requests = self._request_capacity()
+        self._available_tokens = self._token_capacity()
+        self._paused_until = 0.0
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _request_capacity(self) -> float:
+        return max(1.0, self.requests_per_minute * self.WINDOW_IN_SECONDS / 60.0)
+
+    def _token_capacity(self) -> float:
+        return self.tokens_per_minute * self.WINDOW_IN_SECONDS / 60.0
+
+    def _refill(self, now: float):
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._available_requests = min(self._request_capacity(), self._available_requests + elapsed * self.requests_per_minute / 60.0)
+        self._available_tokens = min(self._token_capacity(), self._available_tokens + elapsed * self.tokens_per_minute / 60.0)
+
+    def _try_acquire(self, tokens: int) -> float:
+        """ Reserves the budget for one request and returns 0, or returns the time to wait before trying again. """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self._paused_until:
+                return self._paused_until - now
+            # A request larger than the whole bucket is admitted once the bucket is full, otherwise it would wait forever
+            tokens = min(tokens, self._token_capacity())
+            if self._available_requests >= 1 and self._available_tokens >= tokens:
+                self._available_requests -= 1
+                self._available_tokens -= tokens
+                return 0.0
+            missing_requests = max(0.0, 1 - self._available_requests) * 60.0 / self.requests_per_minute
+            missing_tokens = max(0.0, tokens - self._available_tokens) * 60.0 / self.tokens_per_minute
+            return max(missing_requests, missing_tokens, 0.001)
+
+    def acquire(self, tokens: int):
+        """ Blocks until the request (with the estimated number of tokens) fits into the budget. """
+        while True:
+            wait = self._try_acquire(tokens)
+            if wait == 0:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens: int):
+        """ Asynchronous version of `acquire`. """
+        while True:
+            wait = self._try_acquire(tokens)
+            if wait == 0:
+                return
+            await asyncio.sleep(wait)
+
+    def available_fraction(self) -> float:
+        """ Returns the fraction of the budget (requests or tokens, whichever is lower) that is available right now. """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self._paused_until:
+                return 0.0
+            return max(0.0, min(self._available_requests / self._request_capacity(), self._available_tokens / self._token_capacity()))
+
+    def settle(self, estimated_tokens: int, used_tokens: int):
+        """ Refunds the part of the estimate that was not used (or charges the excess) and recovers the limits. """
+        with self._lock:
+            self._available_tokens = min(self._token_capacity(), self._available_tokens + estimated_tokens - used_tokens)
+            self.requests_per_minute = min(self.max_requests_per_minute, self.requests_per_minute + self.RECOVERY_FRACTION * self.max_requests_per_minute)
+            self.tokens_per_minute = min(self.max_tokens_per_minute, self.tokens_per_minute + self.RECOVERY_FRACTION * self.max_tokens_per_minute)
+
+    def on_rate_limited(self, retry_after: float = None):
+        """ Pauses all requests for `retry_after` seconds (1 second if unknown) and tightens the limits. """
+        with self._lock:
+            now = time.monotonic()
+            self._paused_until = max(self._paused_until, now + (retry_after if retry_after is not None else 1.0))
+            self.requests_per_minute = max(self.MIN_FRACTION * self.max_requests_per_minute, self.requests_per_minute * self.BACKOFF_FACTOR)
+            self.tokens_per_minute = max(self.MIN_FRACTION * self.max_tokens_per_minute, self.tokens_per_minute * self.BACKOFF_FACTOR)
+            self._available_requests = min(self._available_requests, 0.0)
+            self._available_tokens = min(self._available_tokens, 0.0)
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(service_name: str, model_name: str) -> RateLimiter:
+    """
+    Returns the process-wide rate limiter of a deployment, such that all services (and all techniques) share its budget.
+    The limits are read from the environment variables `LLM_REQUESTS_PER_MINUTE` and `LLM_TOKENS_PER_MINUTE`,
+    the defaults correspond to the default quota of a gpt-35-turbo deployment on Azure.
+    """
+    with _rate_limiters_lock:
+        key = (service_name, model_name)
+        if key not in _rate_limiters:
+            _rate_limiters[key] = RateLimiter(
+                requests_per_minute=float(os.getenv("LLM_REQUESTS_PER_MINUTE", "720")),
+                tokens_per_minute=float(os.getenv("LLM_TOKENS_PER_MINUTE", "120000")),
+            )
+        return _rate_limiters[key]
+
+
+class RateLimitedLLMService(LLMServiceWrapper):
+    """ Sends the requests of the wrapped service only when they fit into the budget of a shared `RateLimiter`. """
+    def __init__(self, service: LLMInterface, rate_limiter: RateLimiter):
+        super().__init__(service)
+        self.rate_limiter = rate_limiter
+
+    def _estimate_tokens(self, messages, n: int = 1) -> int:
+        return estimate_prompt_tokens(messages) + n * self.max_tokens
+
+    def _settle(self, estimated_tokens, result):
+        _, prompt_tokens, completion_tokens = result
+        self.rate_limiter.settle(estimated_tokens, (prompt_tokens or 0) + (completion_tokens or 0))
+
+    def make_request(self, messages):
+        return self._call_limited(messages, lambda: self.service.make_request(messages))
+
+    async def make_request_async(self, messages):
+        return await self._call_limited_async(messages, lambda: self.service.make_request_async(messages))
+
+    def make_request_n(self, messages, n):
+        return self._call_limited(messages, lambda: self.service.make_request_n(messages, n), n)
+
+    async def make_request_n_async(self, messages, n):
+        return await self._call_limited_async(messages, lambda: self.service.make_request_n_async(messages, n), n)
+
+    def make_request_until(self, messages, stop_condition):
+        return self._call_limited(messages, lambda: self.service.make_request_until(messages, stop_condition))
+
+    async def make_request_until_async(self, messages, stop_condition):
+        return await self._call_limited_async(messages, lambda: self.service.make_request_until_async(messages, stop_condition))
+
+    def _call_limited(self, messages, call, n=1):
+        estimated_tokens = self._estimate_tokens(messages, n)
+        self.rate_limiter.acquire(estimated_tokens)
+        try:
+            result = call()
+        except Exception as e:
+            if is_rate_limit_error(e):
+                self.rate_limiter.on_rate_limited(get_retry_after(e))
+            raise
+        self._settle(estimated_tokens, result)
+        return result
+
+    async def _call_limited_async(self, messages, call, n=1):
+        estimated_tokens = self._estimate_tokens(messages, n)
+        await self.rate_limiter.acquire_async(estimated_tokens)
+        try:
+            result = await call()
+        except Exception as e:
+            if is_rate_limit_error(e):
+                self.rate_limiter.on_rate_limited(get_retry_after(e))
+            raise
+        self._settle(estimated_tokens, result)
+        return result
@@ -0,0 +1,61 @@
+"""
+Registries of lazily imported components (LLM services, techniques).
+
+Components are registered by name with the import path of their factory, e.g. "techniques.PaL:PaL", and the module is
+only imported when the component is first requested. Short-lived processes thereby only pay for the imports (openai,
+sympy, ...) of the components they actually use. The time of every such import is recorded, see `import_times`.
+"""
+import importlib
+import threading
+import time
+
+_import_times = {}
+
+
+class LazyRegistry:
+    """ Maps names to objects that are imported on first use. """
+    def __init__(self, kind: str):
+        """
+        Parameters:
+            kind (str): What is registered (e.g. "technique"), used in error messages and import times.
+        """
+        self.kind = kind
+        self._targets = {}
+        self._loaded = {}
+        self._lock = threading.RLock()   # Imported modules may register further objects
+
+    def register(self, name: str, target):
+        """
+        Registers `target` under `name`. The target is either the object itself or its import path
+        "package.module:attribute" (attributes of attributes are separated by dots).
+        """
+        with self._lock:
+            self._targets[name] = target
+            self._loaded.pop(name, None)
+
+    def names(self) -> list:
+        """ Returns the names of all registered objects. """
+        return list(self._targets)
+
+    def get(self, name: str):
+        """ Returns the object registered as `name`, importing it on first use. Raises a ValueError for unknown names. """
+        with self._lock:
+            if name in self._loaded:
+                return self._loaded[name]
+            if name not in self._targets:
+                raise ValueError(f"Unsupported {self.kind} {name}")
+            target = self._targets[name]
+            if isinstance(target, str):
+                start = time.perf_counter()
+                module_name, _, attribute_path = target.partition(":")
+                target = importlib.import_module(module_name)
+                for attribute in attribute_path.split("."):
+                    target = getattr(target, attribute)
+                _import_times[f"{self.kind} {name}"] = time.perf_counter() - start
+            self._loaded[name] = target
+            return target
+
+
+def import_times() -> dict:
+    """ Returns the time (in seconds) spent importing each component loaded so far, keyed by "<kind> <name>". """
+    return dict(_import_times)
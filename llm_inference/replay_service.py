@@ -0,0 +1,165 @@
+import asyncio
+import os
+import random
+import re
+import threading
+import time
+
+import httpx
+import openai
+import pandas as pd
+
+from .llm_interface import LLMInterface
+from .request_stats import get_request_tags
+from .response_cache import get_response_cache, request_key
+
+
+class ReplayMissError(Exception):
+    """ Raised if no recorded response matches a request. """
+
+
+_recorded_responses = {}
+_recorded_responses_lock = threading.Lock()
+
+def load_recorded_responses(data_dir: str) -> dict:
+    """
+    Indexes the recorded results in `data_dir` (the CSV files written by `run.py`) by (technique, few_shot_prompting, question).
+    Results that were themselves produced by the replay service are ignored. The index is built once per directory.
+    
+    Returns:
+        dict: Maps (technique, few_shot_prompting, question) to (response, prompt_tokens, completion_tokens, latency_in_seconds).
+    """
+    with _recorded_responses_lock:
+        if data_dir not in _recorded_responses:
+            index = {}
+            for file in sorted(os.listdir(data_dir)):
+                if not file.endswith(".csv") or "_replay_" in file:
+                    continue
+                df = pd.read_csv(os.path.join(data_dir, file))
+                for row in df.itertuples(index=False):
+                    # Baseline does not record its reasoning, its response is the answer itself
+                    response = row.reasoning if isinstance(row.reasoning, str) else row.answer
+                    if pd.isna(response):
+                        continue
+                    latency = getattr(row, "latency_in_seconds", None)
+                    index[(row.technique, bool(row.few_shot_prompting), str(row.question))] = (
+                        str(response), int(row.prompt_tokens), int(row.completion_tokens), latency)
+            _recorded_responses[data_dir] = index
+        return _recorded_responses[data_dir]
+
+
+class ReplayService(LLMInterface):
+    """
+    Serves recorded responses instead of calling an LLM, for offline and deterministic performance testing.
+    
+    Requests are answered from a response cache file (matched on the exact request, see `response_cache.py`) if one is given,
+    otherwise from the recorded `evaluation/data` CSVs, matched on the technique, shot mode and question the request was
+    tagged with (see `request_stats.tag_requests`). The selection requests of ModelSelection are answered with the choice
+    that was recorded for the question.
+    
+    To load-test the pipeline, the service simulates the latency of the endpoint and injects errors and 429 responses.
+    """
+    cacheable = False   # Replayed responses must not end up in the response cache
+
+    def __init__(self, model_name, temperature, max_tokens, data_dir: str = "evaluation/data", cache_path: str = None,
+                 latency: str = "recorded", error_rate: float = 0.0, rate_limit_rate: float = 0.0, retry_after: float = 1.0, seed: int = None):
+        """
+        Parameters:
+            model_name (str), temperature (float), max_tokens (int): Same as for the other services.
+            data_dir (str): Directory with the recorded results.
+            cache_path (str): Optional response cache file, which is used before the recorded results.
+            latency (str): Synthetic latency of each request: 'none', 'recorded' (latency of the recorded question),
+                'fixed:<seconds>', 'uniform:<min>,<max>' or 'lognormal:<median>,<sigma>'.
+            error_rate (float): Fraction of requests that fail with a 500 response.
+            rate_limit_rate (float): Fraction of requests that fail with a 429 response.
+            retry_after (float): Retry-After (in seconds) of the injected 429 responses.
+            seed (int): Seed for the latency and error injection, for reproducible runs.
+        """
+        super().__init__(model_name, temperature, max_tokens)
+        self.data_dir = data_dir
+        self.cache = get_response_cache(cache_path) if cache_path else None
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+
+    @classmethod
+    def from_environment(cls, model_name, temperature, max_tokens):
+        """ Creates the service with the settings of the `REPLAY_*` environment variables (see README.md). """
+        return cls(
+            model_name, temperature, max_tokens,
+            data_dir=os.getenv("REPLAY_DATA_DIR", "evaluation/data"),
+            cache_path=os.getenv("REPLAY_CACHE_PATH"),
+            latency=os.getenv("REPLAY_LATENCY", "recorded"),
+            error_rate=float(os.getenv("REPLAY_ERROR_RATE", "0")),
+            rate_limit_rate=float(os.getenv("REPLAY_RATE_LIMIT_RATE", "0")),
+            retry_after=float(os.getenv("REPLAY_RETRY_AFTER", "1")),
+            seed=int(os.getenv("REPLAY_SEED")) if os.getenv("REPLAY_SEED") else None,
+        )
+
+    def _lookup(self, messages):
+        """ Returns the recorded (response, prompt_tokens, completion_tokens, latency) of a request. """
+        if self.cache is not None:
+            cached = self.cache.get(request_key(messages, self.model_name, self.temperature, self.max_tokens))
+            if cached is not None:
+                return (*cached, None)
+        recorded = load_recorded_responses(self.data_dir)
+        tags = get_request_tags()
+        if tags.get("request") == "selection":
+            return self._lookup_selection(messages, recorded, tags)
+        key = (tags.get("technique"), tags.get("few_shot_prompting"), tags.get("question"))
+        if key not in recorded:
+            raise ReplayMissError(f"No recorded response for {key}")
+        return recorded[key]
+
+    def _lookup_selection(self, messages, recorded, tags):
+        """ Answers a selection request of ModelSelection with the recorded choice between (A) CoT and (B) PaL. """
+        key = ("ModelSelection", tags.get("few_shot_prompting"), tags.get("question"))
+        if key not in recorded:
+            raise ReplayMissError(f"No recorded response for {key}")
+        reasoning, _, _, latency = recorded[key]
+        candidates = messages[-1]["content"]
+        choice = "(B)" if reasoning in candidates[candidates.rfind("(B)"):] else "(A)"
+        return f"{choice} can correctly answer the math problem.", len(candidates) // 4, 8, latency
+
+    def _sample_latency(self, recorded_latency) -> float:
+        kind, _, arguments = self.latency.partition(":")
+        values = [float(value) for value in arguments.split(",") if value]
+        if kind == "recorded":
+            return 0.0 if recorded_latency is None or pd.isna(recorded_latency) else float(recorded_latency)
+        elif kind == "fixed":
+            return values[0]
+        elif kind == "uniform":
+            return self.random.uniform(values[0], values[1])
+        elif kind == "lognormal":
+            return values[0] * self.random.lognormvariate(0, values[1])
+        return 0.0
+
+    def _injected_error(self):
+        """ Returns an error to raise instead of answering the request, or None. """
+        draw = self.random.random()
+        request = httpx.Request("POST", "https://replay.invalid/chat/completions")
+        if draw < self.rate_limit_rate:
+            response = httpx.Response(429, request=request, headers={"retry-after": str(self.retry_after)})
+            return openai.RateLimitError("Injected rate limit", response=response, body=None)
+        if draw < self.rate_limit_rate + self.error_rate:
+            response = httpx.Response(500, request=request)
+            return openai.InternalServerError("Injected server error", response=response, body=None)
+        return None
+
+    def make_request(self, messages) -> tuple[str, int, int]:
+        response, prompt_tokens, completion_tokens, recorded_latency = self._lookup(messages)
+        time.sleep(self._sample_latency(recorded_latency))
+        error = self._injected_error()
+        if error is not None:
+            raise error
+        return response, prompt_tokens, completion_tokens
+
+    async def make_request_async(self, messages) -> tuple[str, int, int]:
+        response, prompt_tokens, completion_tokens, recorded_latency = self._lookup(messages)
+        await asyncio.sleep(self._sample_latency(recorded_latency))
+        error = self._injected_error()
+        if error is not None:
+            raise error
+        return response, prompt_tokens, completion_tokens
@@ -0,0 +1,68 @@
+"""
+Collects counters (e.g. retries or time spent backing off) of all LLM requests made while answering one question,
+and tags requests with information about where they come from.
+
+The counters and tags are stored in context variables, such that the layers of the LLM services can access them without
+changing the arguments and return values of `make_request`. Context variables are inherited by asyncio tasks and by
+`asyncio.to_thread`, so the counters of concurrently processed questions do not mix. Threads started with
+`contextvars.copy_context().run` (e.g. the branches of ModelSelection) add to the counters of the question as well.
+"""
+import contextvars
+import threading
+from contextlib import contextmanager
+
+_current_stats = contextvars.ContextVar("request_stats", default=None)
+_stats_lock = threading.Lock()     # Counters of one question may be updated from several threads
+
+
+@contextmanager
+def collect_request_stats():
+    """
+    Starts collecting the counters of all requests made inside the `with` block.
+    
+    Yields:
+        dict: The collected counters, filled while the block runs.
+    """
+    stats = {}
+    token = _current_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _current_stats.reset(token)
+
+
+def add_request_stat(name: str, value: float):
+    """ Adds `value` to the counter `name` of the current question (no-op if nothing is being collected). """
+    stats = _current_stats.get()
+    if stats is not None:
+        with _stats_lock:
+            stats[name] = stats.get(name, 0) + value
+
+
+def set_request_stat(name: str, value):
+    """ Sets the value `name` of the current question (no-op if nothing is being collected). """
+    stats = _current_stats.get()
+    if stats is not None:
+        stats[name] = value
+
+
+_current_tags = contextvars.ContextVar("request_tags", default={})
+
+
+@contextmanager
+def tag_requests(**tags):
+    """
+    Attaches tags (e.g. the technique and the question) to all requests made inside the `with` block.
+    Services that need to know where a request comes from (e.g. the replay service) read them with `get_request_tags`.
+    Nested blocks add to and override the tags of the outer blocks.
+    """
+    token = _current_tags.set({**_current_tags.get(), **tags})
+    try:
+        yield
+    finally:
+        _current_tags.reset(token)
+
+
+def get_request_tags() -> dict:
+    """ Returns the tags of the current request. """
+    return _current_tags.get()
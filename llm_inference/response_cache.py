@@ -0,0 +1,222 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from .llm_interface import LLMInterface, LLMServiceWrapper
+from .request_stats import add_request_stat, set_request_stat
+
+
+def request_key(messages, model_name: str, temperature: float, max_tokens: int, variant: str = None) -> str:
+    """
+    Returns a stable hash of everything that determines the response of a request.
+    The same messages sent with the same model, temperature and max_tokens always map to the same key.
+    `variant` separates responses of the same request that were obtained differently (e.g. streams closed early).
+    """
+    payload = json.dumps({
+        "messages": messages,
+        "model": model_name,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        **({"variant": variant} if variant is not None else {}),
+    }, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Persistent, content-addressed store for LLM responses, backed by SQLite.
+    
+    Entries are keyed by `request_key`. If the stored responses exceed `max_size_bytes`, the least
+    recently used entries are evicted. The store is thread-safe, such that it can be shared by all
+    services of a process (see `get_response_cache`).
+    """
+    def __init__(self, path: str, max_size_bytes: int):
+        """
+        Parameters:
+            path (str): Location of the SQLite database, the directory is created if necessary.
+            max_size_bytes (int): Upper bound on the total size of the stored responses.
+        """
+        self.path = path
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT,
+                prompt_tokens INTEGER,
+                completion_tokens INTEGER,
+                size INTEGER,
+                last_access REAL
+            )""")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self._connection.commit()
+        self._size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, key: str):
+        """ Returns the cached (response, prompt_tokens, completion_tokens) tuple, or None on a miss. """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT response, prompt_tokens, completion_tokens FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._connection.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._connection.commit()
+            return row[0], row[1], row[2]
+
+    def put(self, key: str, response: str, prompt_tokens: int, completion_tokens: int):
+        """ Stores a response and evicts the least recently used entries if the cache is too large. """
+        size = len(response.encode("utf-8")) if response is not None else 0
+        with self._lock:
+            previous = self._connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, response, prompt_tokens, completion_tokens, size, time.time()))
+            self._size += size - (previous[0] if previous else 0)
+            if self._size > self.max_size_bytes:
+                self._evict()
+            self._connection.commit()
+
+    def _evict(self):
+        """ Deletes the least recently used entries until the cache is below 90% of its size limit. """
+        target = 0.9 * self.max_size_bytes
+        rows = self._connection.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall()
+        for key, size in rows:
+            if self._size <= target:
+                break
+            self._connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._size -= size
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        """ Returns the hit/miss counters and the current size of the cache. """
+        with self._lock:
+            entries = self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "entries": entries, "size_bytes": self._size}
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_response_cache(path: str = None, max_size_bytes: int = None) -> ResponseCache:
+    """
+    Returns the process-wide cache stored at `path`, such that all services share one store.
+    The defaults are read from the environment variables `LLM_CACHE_PATH` and `LLM_CACHE_MAX_MB`.
+    """
+    path = path or os.getenv("LLM_CACHE_PATH", ".cache/llm_responses.sqlite")
+    if max_size_bytes is None:
+        max_size_bytes = int(float(os.getenv("LLM_CACHE_MAX_MB", "512")) * 1024 * 1024)
+    with _caches_lock:
+        if path not in _caches:
+            _caches[path] = ResponseCache(path, max_size_bytes)
+        return _caches[path]
+
+def cache_statistics() -> dict:
+    """ Returns the statistics of every cache opened in this process, keyed by path. """
+    with _caches_lock:
+        return {path: cache.stats() for path, cache in _caches.items()}
+
+
+class CachedLLMService(LLMServiceWrapper):
+    """
+    Serves repeated requests from a `ResponseCache` instead of sending them to the wrapped service again.
+    
+    Only deterministic requests (temperature 0) are cached by default, since sampled responses 
+    are expected to differ between calls.
+    
+    A hit returns the tokens recorded with the response, such that the token usage of a technique does not depend
+    on the cache. Since the request was not sent (and not billed), the hit is recorded with the `cache_hit` flag and
+    its tokens as `cache_hit_prompt_tokens` and `cache_hit_completion_tokens` (see `request_stats.py`).
+    The asynchronous methods access the SQLite database in a thread, so disk I/O does not block the event loop.
+    """
+    def __init__(self, service: LLMInterface, cache: ResponseCache, bypass: bool = False, cache_sampled_responses: bool = False):
+        """
+        Parameters:
+            service (LLMInterface): The wrapped service.
+            cache (ResponseCache): The store used for the responses.
+            bypass (bool): If True, the cache is neither read nor written.
+            cache_sampled_responses (bool): If True, responses with temperature > 0 are cached as well.
+        """
+        super().__init__(service)
+        self.cache = cache
+        self.bypass = bypass
+        self.cache_sampled_responses = cache_sampled_responses
+
+    def _cache_key(self, messages, variant=None):
+        if self.bypass or (self.temperature != 0 and not self.cache_sampled_responses):
+            return None
+        return request_key(messages, self.model_name, self.temperature, self.max_tokens, variant)
+
+    @staticmethod
+    def _record_hit(cached):
+        set_request_stat("cache_hit", True)
+        add_request_stat("cache_hit_prompt_tokens", cached[1] or 0)
+        add_request_stat("cache_hit_completion_tokens", cached[2] or 0)
+        return cached
+
+    def _cached_call(self, key, call):
+        if key is None:
+            return call()
+        cached = self.cache.get(key)
+        if cached is not None:
+            return self._record_hit(cached)
+        response, prompt_tokens, completion_tokens = call()
+        self.cache.put(key, response, prompt_tokens, completion_tokens)
+        return response, prompt_tokens, completion_tokens
+
+    async def _cached_call_async(self, key, call):
+        if key is None:
+            return await call()
+        cached = await asyncio.to_thread(self.cache.get, key)
+        if cached is not None:
+            return self._record_hit(cached)
+        response, prompt_tokens, completion_tokens = await call()
+        await asyncio.to_thread(self.cache.put, key, response, prompt_tokens, completion_tokens)
+        return response, prompt_tokens, completion_tokens
+
+    def make_request(self, messages):
+        return self._cached_call(self._cache_key(messages), lambda: self.service.make_request(messages))
+
+    async def make_request_async(self, messages):
+        return await self._cached_call_async(self._cache_key(messages), lambda: self.service.make_request_async(messages))
+
+    # The responses of a request with several samples are stored as one JSON list
+
+    def make_request_n(self, messages, n):
+        key = self._cache_key(messages, variant=f"n:{n}")
+        response, prompt_tokens, completion_tokens = self._cached_call(key, lambda: self._serialized(self.service.make_request_n(messages, n)))
+        return json.loads(response), prompt_tokens, completion_tokens
+
+    async def make_request_n_async(self, messages, n):
+        key = self._cache_key(messages, variant=f"n:{n}")
+        async def call():
+            return self._serialized(await self.service.make_request_n_async(messages, n))
+        response, prompt_tokens, completion_tokens = await self._cached_call_async(key, call)
+        return json.loads(response), prompt_tokens, completion_tokens
+
+    @staticmethod
+    def _serialized(result):
+        responses, prompt_tokens, completion_tokens = result
+        return json.dumps(responses, ensure_ascii=False), prompt_tokens, completion_tokens
+
+    # Streamed responses may be truncated by the stop condition, hence they are cached separately from complete responses.
+    # The stop condition of a technique is fixed, so the truncation is deterministic as well.
+
+    def make_request_until(self, messages, stop_condition):
+        key = self._cache_key(messages, variant="stream:" + getattr(stop_condition, "__qualname__", ""))
+        return self._cached_call(key, lambda: self.service.make_request_until(messages, stop_condition))
+
+    async def make_request_until_async(self, messages, stop_condition):
+        key = self._cache_key(messages, variant="stream:" + getattr(stop_condition, "__qualname__", ""))
+        return await self._cached_call_async(key, lambda: self.service.make_request_until_async(messages, stop_condition))
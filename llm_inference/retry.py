@@ -0,0 +1,278 @@
+import asyncio
+import os
+import random
+import threading
+import time
+
+from .llm_interface import LLMInterface, LLMServiceWrapper
+from .rate_limiter import get_retry_after
+from .request_stats import add_request_stat
+
+
+def is_retryable_error(exception) -> bool:
+    """
+    Classifies whether a failed request is worth retrying: timeouts, connection errors, 
+    429 (rate limit), 408/409 and 5xx responses are transient. Everything else (e.g. 400 or 401) is not.
+    """
+    import openai   # Imported here, such that the module can be loaded without the (slow) openai import
+    if isinstance(exception, (openai.APITimeoutError, openai.APIConnectionError, TimeoutError, ConnectionError)):
+        return True
+    status_code = getattr(exception, "status_code", None)
+    if status_code is None:
+        return False
+    return status_code in (408, 409, 429) or status_code >= 500
+
+
+class RetryPolicy:
+    """
+    Capped exponential backoff with full jitter and an overall deadline per call.
+    
+    Attributes:
+        max_retries (int): Maximum number of retries after the first attempt.
+        base_delay (float): Backoff before the first retry (in seconds), doubled for every further retry.
+        max_delay (float): Upper bound for a single backoff (in seconds).
+        deadline (float): Maximum time (in seconds) a call may take including all retries and waits.
+    """
+    def __init__(self, max_retries: int = 6, base_delay: float = 1.0, max_delay: float = 30.0, deadline: float = 300.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def backoff(self, retry: int, retry_after: float = None) -> float:
+        """ Returns the time to wait before the given retry (0-based), honoring the server's Retry-After. """
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retry))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+
+class CircuitOpenError(Exception):
+    """ Raised if the endpoint stays unhealthy until the deadline of a call. """
+
+
+class CallDeadlineExceeded(Exception):
+    """
+    Raised if a call runs out of its overall deadline. This is not a failure of the endpoint (e.g. one slow question
+    used up its own deadline), hence it is neither retried nor counted by the circuit breaker.
+    """
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to an endpoint after `failure_threshold` consecutive transient failures.
+    
+    While the circuit is open, callers wait instead of failing, which pauses the whole sweep until the
+    endpoint recovers. After `reset_timeout` seconds, a single probe request is let through (half-open): 
+    if it succeeds the circuit closes, otherwise it opens again with a doubled timeout (up to `max_reset_timeout`).
+    The caller that sends the probe gets a token from `wait`, only the owner of the probe can fail or release it.
+    """
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 15.0, max_reset_timeout: float = 120.0):
+        self.failure_threshold = failure_threshold
+        self.initial_reset_timeout = reset_timeout
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.consecutive_failures = 0
+        self._opened_until = None   # None if the circuit is closed
+        self._probe = None          # Token of the caller whose probe is in flight
+        self._lock = threading.Lock()
+
+    def _try_pass(self) -> tuple[float, object]:
+        """
+        Returns 0 and the probe token (None if the circuit is closed) if a request may be sent now, otherwise the time
+        to wait before asking again and None.
+        """
+        with self._lock:
+            if self._opened_until is None:
+                return 0.0, None
+            now = time.monotonic()
+            if now < self._opened_until:
+                return self._opened_until - now, None
+            if self._probe is not None:
+                return 0.1, None
+            self._probe = object()   # Half-open: this caller probes the endpoint
+            return 0.0, self._probe
+
+    def wait(self, deadline: float) -> object:
+        """
+        Blocks while the circuit is open. Raises `CircuitOpenError` if it is still open at `deadline` (monotonic time).
+        Returns the probe token if the caller sends the half-open probe, otherwise None.
+        """
+        while (wait_and_probe := self._try_pass())[0] > 0:
+            if time.monotonic() + wait_and_probe[0] > deadline:
+                raise CircuitOpenError("The endpoint is unhealthy, the circuit breaker is open.")
+            time.sleep(wait_and_probe[0])
+        return wait_and_probe[1]
+
+    async def wait_async(self, deadline: float) -> object:
+        """ Asynchronous version of `wait`. """
+        while (wait_and_probe := self._try_pass())[0] > 0:
+            if time.monotonic() + wait_and_probe[0] > deadline:
+                raise CircuitOpenError("The endpoint is unhealthy, the circuit breaker is open.")
+            await asyncio.sleep(wait_and_probe[0])
+        return wait_and_probe[1]
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self._opened_until = None
+            self._probe = None
+            self.reset_timeout = self.initial_reset_timeout
+
+    def record_failure(self, probe: object = None):
+        """
+        Records a transient failure, opens the circuit if the threshold is reached or the probe failed.
+        `probe` is the token returned by `wait`, a request that was sent while the circuit was closed did not probe.
+        """
+        with self._lock:
+            self.consecutive_failures += 1
+            probe_failed = probe is not None and probe is self._probe
+            if probe_failed:
+                self.reset_timeout = min(self.max_reset_timeout, self.reset_timeout * 2)
+                self._probe = None
+            if probe_failed or self.consecutive_failures >= self.failure_threshold:
+                self._opened_until = time.monotonic() + self.reset_timeout
+                print(f"Circuit breaker opened after {self.consecutive_failures} consecutive failures, pausing requests for {self.reset_timeout:.1f} seconds.")
+
+    def release_probe(self, probe: object):
+        """
+        Releases the probe of a request that failed with a non-transient error or ran out of its deadline (which says
+        nothing about the endpoint), if `probe` is the token of the probe in flight.
+        """
+        with self._lock:
+            if probe is not None and probe is self._probe:
+                self._probe = None
+
+
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+def get_circuit_breaker(service_name: str, model_name: str) -> CircuitBreaker:
+    """ Returns the process-wide circuit breaker of a deployment, shared by all services using it. """
+    with _circuit_breakers_lock:
+        key = (service_name, model_name)
+        if key not in _circuit_breakers:
+            _circuit_breakers[key] = CircuitBreaker()
+        return _circuit_breakers[key]
+
+def get_retry_policy() -> RetryPolicy:
+    """ Returns the retry policy configured by the environment variables `LLM_MAX_RETRIES` and `LLM_CALL_DEADLINE`. """
+    return RetryPolicy(
+        max_retries=int(os.getenv("LLM_MAX_RETRIES", "6")),
+        deadline=float(os.getenv("LLM_CALL_DEADLINE", "300")),
+    )
+
+
+class RetryingLLMService(LLMServiceWrapper):
+    """
+    Retries transient failures of the wrapped service according to a `RetryPolicy` and stops sending
+    requests while the shared `CircuitBreaker` is open.
+    
+    The number of retries and the time spent waiting are recorded as `retries` and `backoff_in_seconds`
+    (see `request_stats.py`), such that they end up in the result row of the question.
+    
+    The deadline of a call is enforced differently in the two paths: the asynchronous path cancels an attempt that is
+    still running at the deadline, whereas a synchronous attempt cannot be interrupted and is only bounded by the
+    timeout of the client (`LLM_REQUEST_TIMEOUT`), so the deadline is checked before every attempt. In both paths,
+    running out of the deadline raises `CallDeadlineExceeded` without counting as a failure of the endpoint. An
+    asynchronous attempt that is cut off at the deadline is told apart from one that failed with a timeout of its own,
+    since it is still running then (see `_attempt_async`).
+    """
+    def __init__(self, service: LLMInterface, retry_policy: RetryPolicy, circuit_breaker: CircuitBreaker):
+        super().__init__(service)
+        self.retry_policy = retry_policy
+        self.circuit_breaker = circuit_breaker
+
+    def _handle_failure(self, exception, retry: int, start: float, probe: object) -> float:
+        """ Records the failure and returns the backoff before the next attempt, or re-raises the exception. """
+        if not is_retryable_error(exception):
+            self.circuit_breaker.release_probe(probe)
+            raise exception
+        self.circuit_breaker.record_failure(probe)
+        delay = self.retry_policy.backoff(retry, get_retry_after(exception))
+        if retry >= self.retry_policy.max_retries or time.monotonic() + delay > start + self.retry_policy.deadline:
+            raise exception
+        add_request_stat("retries", 1)
+        add_request_stat("backoff_in_seconds", delay)
+        return delay
+
+    def _remaining(self, start: float, probe: object) -> float:
+        """ Returns the time left until the deadline of a call, or raises `CallDeadlineExceeded` if there is none. """
+        remaining = start + self.retry_policy.deadline - time.monotonic()
+        if remaining <= 0:
+            self._deadline_exceeded(probe)
+        return remaining
+
+    def _deadline_exceeded(self, probe: object):
+        """ Releases the probe of the call (if it sent it) and raises `CallDeadlineExceeded`. """
+        self.circuit_breaker.release_probe(probe)
+        raise CallDeadlineExceeded(f"The call exceeded its deadline of {self.retry_policy.deadline:g} seconds.")
+
+    async def _attempt_async(self, call, remaining: float, probe: object):
+        """ Runs one attempt and cancels it if it is still running after `remaining` seconds, the deadline of the call. """
+        attempt = asyncio.ensure_future(call())
+        try:
+            done, _ = await asyncio.wait({attempt}, timeout=remaining)
+        except asyncio.CancelledError:
+            attempt.cancel()
+            raise
+        if not done:
+            attempt.cancel()
+            await asyncio.gather(attempt, return_exceptions=True)
+            self._deadline_exceeded(probe)
+        return attempt.result()
+
+    def make_request(self, messages):
+        return self._call_with_retries(lambda: self.service.make_request(messages))
+
+    async def make_request_async(self, messages):
+        return await self._call_with_retries_async(lambda: self.service.make_request_async(messages))
+
+    def make_request_n(self, messages, n):
+        return self._call_with_retries(lambda: self.service.make_request_n(messages, n))
+
+    async def make_request_n_async(self, messages, n):
+        return await self._call_with_retries_async(lambda: self.service.make_request_n_async(messages, n))
+
+    def make_request_until(self, messages, stop_condition):
+        return self._call_with_retries(lambda: self.service.make_request_until(messages, stop_condition))
+
+    async def make_request_until_async(self, messages, stop_condition):
+        return await self._call_with_retries_async(lambda: self.service.make_request_until_async(messages, stop_condition))
+
+    def _call_with_retries(self, call):
+        start = time.monotonic()
+        add_request_stat("retries", 0)
+        add_request_stat("backoff_in_seconds", 0.0)
+        for retry in range(self.retry_policy.max_retries + 1):
+            wait_start = time.monotonic()
+            probe = self.circuit_breaker.wait(start + self.retry_policy.deadline)
+            add_request_stat("backoff_in_seconds", time.monotonic() - wait_start)
+            self._remaining(start, probe)
+            try:
+                result = call()
+            except Exception as e:
+                time.sleep(self._handle_failure(e, retry, start, probe))
+                continue
+            self.circuit_breaker.record_success()
+            return result
+
+    async def _call_with_retries_async(self, call):
+        """ Asynchronous version of `_call_with_retries`, `call` returns a new coroutine for every attempt. """
+        start = time.monotonic()
+        add_request_stat("retries", 0)
+        add_request_stat("backoff_in_seconds", 0.0)
+        for retry in range(self.retry_policy.max_retries + 1):
+            wait_start = time.monotonic()
+            probe = await self.circuit_breaker.wait_async(start + self.retry_policy.deadline)
+            add_request_stat("backoff_in_seconds", time.monotonic() - wait_start)
+            remaining = self._remaining(start, probe)
+            try:
+                result = await self._attempt_async(call, remaining, probe)
+            except CallDeadlineExceeded:
+                raise   # The attempt was cut off at the deadline, which says nothing about the endpoint
+            except Exception as e:
+                await asyncio.sleep(self._handle_failure(e, retry, start, probe))
+                continue
+            self.circuit_breaker.record_success()
+            return result
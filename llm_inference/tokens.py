@@ -0,0 +1,37 @@
+from functools import lru_cache
+
+_encoding = None
+_encoding_loaded = False
+
+def _get_encoding():
+    """ Loads the tiktoken encoding on first use, since importing tiktoken is slow. Returns None if it is not installed. """
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:   # tiktoken is optional, fall back to a character based estimate
+            _encoding = None
+        _encoding_loaded = True
+    return _encoding
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(content: str) -> int:
+    """
+    Returns the number of tokens of a text. Cached, since the messages of the prompt prefixes
+    (see `techniques/util.py`) are the same for every request of a technique.
+    """
+    encoding = _get_encoding()
+    return len(encoding.encode(content)) if encoding is not None else len(content) // 4 + 1
+
+
+def estimate_prompt_tokens(messages) -> int:
+    """
+    Estimates the number of prompt tokens of a request before it is sent.
+    Uses tiktoken if it is installed, otherwise assumes ~4 characters per token.
+    """
+    tokens = 3  # Every reply is primed with a few tokens
+    for message in messages:
+        tokens += 4 + count_tokens(message.get("content") or "")
+    return tokens
@@ -1,86 +1,275 @@
+import argparse
+import asyncio
 import pandas as pd
+import sys
 import time
-from time import sleep
 from tqdm import tqdm
 
-from techniques.Baseline import Baseline
-from techniques.PaL import PaL
-from techniques.CoT import CoT
-from techniques.RolePlaying import RolePlaying
-from techniques.DeclarativeSymPy import DeclarativeSymPy
-from techniques.ModelSelection import ModelSelection
+from techniques.registry import get_technique
+from techniques.util import fast_path_statistics
+from techniques.execution_cache import execution_cache_statistics
+from techniques.linear_solver import solver_statistics
+from techniques.arithmetic_router import record_router_result, router_statistics
+from llm_inference.registry import import_times
+from llm_inference.response_cache import cache_statistics
+from llm_inference.endpoint_pool import endpoint_statistics
+from llm_inference.request_stats import collect_request_stats
+from llm_inference.batch import batch_request_line, write_batch_requests, read_batch_results
+
+# SelfConsistency is left out: it samples several responses per question, which costs several times the tokens and is not reproducible
+# Cascade is left out: it repeats the requests of the techniques on its ladder, which are part of the sweep already
+DEFAULT_TECHNIQUES = ["Baseline", "PaL", "CoT", "RolePlaying", "DeclarativeSymPy", "ModelSelection"]
+DATASET_FILES = ["arithmetic_100", "wordProblems_100", "geometry_100", "arithmetic_1000", "wordProblems_1000", "geometry_1000",
+                 "arithmetic_100_german", "wordProblems_100_german", "geometry_100_german"]
 
 def technique_factory(technique_name, few_shot_prompting, dataset, service, model, temperature, max_token):
     """ Factory function to create an instance of a technique based on the input parameters.
-    NOTE: If you add a new technique, you should add a new condition to this function.
+    NOTE: If you add a new technique, you should register it in `techniques/registry.py`.
     """
-    if technique_name == "Baseline":
-        return Baseline(name=technique_name, few_shot_prompting=few_shot_prompting, dataset=dataset, service=service, model=model, temperature=temperature, max_token=max_token)
-    elif technique_name == "PaL":
-        return PaL(name=technique_name, few_shot_prompting=few_shot_prompting, dataset=dataset, service=service, model=model, temperature=temperature, max_token=max_token)
-    elif technique_name == "CoT":
-        return CoT(name=technique_name, few_shot_prompting=few_shot_prompting, dataset=dataset, service=service, model=model, temperature=temperature, max_token=max_token)
-    elif technique_name == "RolePlaying":
-        # if few_shot_prompting:
-        #     raise ValueError("RolePlaying technique does not support few-shot prompting.")
-        return RolePlaying(name=technique_name, few_shot_prompting=few_shot_prompting, dataset=dataset, service=service, model=model, temperature=temperature, max_token=max_token)
-    elif technique_name == "DeclarativeSymPy":
-        return DeclarativeSymPy(name=technique_name, few_shot_prompting=few_shot_prompting, dataset=dataset, service=service, model=model, temperature=temperature, max_token=max_token)
-    elif technique_name == "ModelSelection":
-        return ModelSelection(name=technique_name, few_shot_prompting=few_shot_prompting, dataset=dataset, service=service, model=model, temperature=temperature, max_token=max_token)
-    else:
-        raise ValueError("Unsupported technique name")
-
-
-def run_evaluation(technique_name, few_shot_prompting, dataset, service, model, temperature, max_token):
-    """Executes the evaluation of a specified technique on a given dataset and saves the results as a CSV file."""
-    assert(dataset in ["arithmetic_100", "wordProblems_100", "geometry_100", "arithmetic_1000", "wordProblems_1000", "geometry_1000"])
+    technique_class = get_technique(technique_name)
+    return technique_class(name=technique_name, few_shot_prompting=few_shot_prompting, dataset=dataset, service=service, model=model, temperature=temperature, max_token=max_token)
+
+
+async def evaluate_samples(technique, samples, max_concurrency, packing_factor=1):
+    """
+    Queries the technique for all samples concurrently, with at most `max_concurrency` requests in flight.
+    The request rate is controlled by the rate limiter shared by all LLM services (see `llm_inference/rate_limiter.py`).
+    
+    Args:
+        technique (TechniqueInterface): The technique to evaluate.
+        samples (list[dict]): The rows of the dataset.
+        max_concurrency (int): Maximum number of requests (i.e. questions or packs of questions) that are processed at the same time.
+        packing_factor (int): Number of questions that are packed into one request (see `TechniqueInterface.query_packed_with_detailed_response`).
+    
+    Returns:
+        list[dict]: One result per sample in dataset order. Samples which could not be processed are left out.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+    progress_bar = tqdm(total=len(samples))
+    
+    async def evaluate_group(group):
+        questions, correct_answers, valid_samples = [], [], []
+        for sample in group:
+            question = str(sample['question'])
+            try:
+                correct_answers.append(float(sample['answer']))
+            except Exception as e:
+                print(f"Error parsing the answer to float for question '{question}': {e}")
+                progress_bar.update(1)
+                continue
+            questions.append(question)
+            valid_samples.append(sample)
+        if not questions:
+            return []
+        async with semaphore:
+            try: 
+                start_time = time.time()
+                if len(questions) > 1:
+                    responses = await technique.query_packed_with_detailed_response_async(questions)
+                else:
+                    responses = [await technique.query_with_detailed_response_async(questions[0])]
+                latency = time.time() - start_time
+            except Exception as e:
+                print(f"An error occurred while processing the questions: {questions}")
+                print(f"Error: {e}")
+                progress_bar.update(len(questions))
+                return []
+        for response, sample, correct_answer in zip(responses, valid_samples, correct_answers):
+            response['correct_answer'] = correct_answer  
+            response['category'] = sample.get('category', 'N/A')  
+            response['subcategory'] = sample.get('subcategory', 'N/A')  
+            response['latency_in_seconds'] = latency
+            record_router_result(response['subcategory'], response)
+        progress_bar.update(len(questions))
+        return responses
+    
+    groups = [samples[start:start + packing_factor] for start in range(0, len(samples), packing_factor)]
+    # The first request is sent alone, such that the provider has cached the prompt prefix of the technique
+    # before the other requests, which share it, are sent concurrently.
+    first_results = [await evaluate_group(group) for group in groups[:1]]
+    # gather() returns the results in the order of the samples, independent of the completion order
+    results = first_results + await asyncio.gather(*(evaluate_group(group) for group in groups[1:]))
+    progress_bar.close()
+    return [response for group_results in results for response in group_results]
+
+
+def sweep_order(technique_names, datasets):
+    """
+    Orders the runs of a sweep by dataset and shot mode, with ModelSelection directly after PaL and CoT.
+    
+    The order does not create prompt cache hits between different techniques: their conversations differ from the
+    first message on, so they share no cacheable prefix. Only identical prompts share one, i.e. the questions of a run,
+    which are sent back-to-back anyway, and the CoT and PaL requests of ModelSelection, which repeat the requests of
+    the CoT and PaL runs and are therefore sent while those are recent.
+    
+    Returns:
+        list[tuple]: (dataset, few_shot_prompting, technique_name) of every run.
+    """
+    sharing_prompts = [name for name in ["PaL", "CoT", "ModelSelection"] if name in technique_names]
+    technique_names = [name for name in technique_names if name not in sharing_prompts] + sharing_prompts
+    return [(dataset, few_shot_prompting, technique_name)
+            for dataset in datasets
+            for few_shot_prompting in [True, False]
+            for technique_name in technique_names]
+
+
+def run_evaluation(technique_name, few_shot_prompting, dataset, service, model, temperature, max_token, max_concurrency=8, streaming=False, packing_factor=1):
+    """Executes the evaluation of a specified technique on a given dataset and saves the results as a CSV file.
+    Up to `max_concurrency` questions are processed at the same time (use 1 for the sequential behaviour).
+    If `streaming` is enabled, responses are closed as soon as the technique's answer was emitted.
+    With a `packing_factor` > 1, that many questions are answered per request (only for techniques that `supports_packing`),
+    and the results are saved as technique `<technique_name>-packed<packing_factor>`.
+    With the arithmetic router enabled (`ARITHMETIC_ROUTER=1`), the results are saved as technique `<technique_name>-routed`,
+    since they do not measure the technique alone."""
+    assert(dataset in DATASET_FILES)
     technique = technique_factory(technique_name, few_shot_prompting, dataset.split('_')[0], service, model, temperature, max_token)
+    technique.streaming = streaming
+    if packing_factor > 1 and not technique.supports_packing:
+        raise ValueError(f"The {technique_name} technique does not support packing")
     
     dataset_df = pd.read_csv(f"datasets/{dataset}.csv")
-    results = []
-    for index, sample in tqdm(dataset_df.iterrows(), total=dataset_df.shape[0]):
-        question = str(sample['question'])
-        try:
-            correct_answer = float(sample['answer'])
-        except Exception as e:
-            print(f"Error parsing the answer to float for question '{question}': {e}")
-            continue
-        category = sample.get('category', 'N/A')  
-        subcategory = sample.get('subcategory', 'N/A') 
-        try: 
-            start_time = time.time()
-            response = technique.query_with_detailed_response(question)
-            latency = time.time() - start_time
-        except Exception as e:
-            print(f"An error occurred while processing the question: {question}")
-            print(f"Error: {e}")
-            continue
-        response['correct_answer'] = correct_answer  
-        response['category'] = category 
-        response['subcategory'] = subcategory  
-        response['latency_in_seconds'] = latency
-        results.append(response)
-        
-        # Sleep for 2 second to avoid rate limits
-        sleep(2)
-        
+    samples = dataset_df.to_dict('records')
+    results = asyncio.run(evaluate_samples(technique, samples, max_concurrency, packing_factor))
+    if packing_factor > 1:
+        technique_name = f"{technique_name}-packed{packing_factor}"
+    if technique.routing:
+        technique_name = f"{technique_name}-routed"
+    save_results(results, technique_name, few_shot_prompting, dataset, service, model)
+
+
+def save_results(results, technique_name, few_shot_prompting, dataset, service, model):
+    """Saves the result rows of one run as a CSV file in evaluation/data."""
     results_df = pd.DataFrame(results)
     few_shot_or_zero_shot = "Few-shot" if few_shot_prompting else "Zero-shot"
     results_df.to_csv(f"evaluation/data/{technique_name}_{few_shot_or_zero_shot}_{dataset}_{service}_{model}.csv", index=False)
     print(f"Results saved to evaluation/data/{technique_name}_{few_shot_or_zero_shot}_{dataset}_{service}_{model}.csv")
 
 
+def batch_custom_id(technique_name, few_shot_prompting, dataset, index, request_name):
+    """Stable identifier of one request of a sweep in batch mode, e.g. 'CoT|Few-shot|arithmetic_100|7|answer'."""
+    few_shot_or_zero_shot = "Few-shot" if few_shot_prompting else "Zero-shot"
+    return f"{technique_name}|{few_shot_or_zero_shot}|{dataset}|{index}|{request_name}"
+
+
+def run_batch_round(runs, service, model, temperature, max_token, results_paths, requests_path):
+    """
+    Runs one round of the offline batch mode for a whole sweep.
+    
+    The responses from the result files of the Batch API are fed through the post-processing of each technique.
+    Every run whose questions can all be answered is saved as CSV in evaluation/data, like `run_evaluation` does.
+    Runs of techniques that do not `supports_batch` (which may depend on their configuration, e.g. Cascade) are skipped.
+    All requests that are still missing (the first round, the selection round of ModelSelection, or failed requests) 
+    are written to `requests_path`, which is submitted as the next batch.
+    
+    Args:
+        runs (list[tuple[str, str, bool]]): The (technique_name, dataset, few_shot_prompting) combinations of the sweep.
+        results_paths (list[str]): The result files of all earlier rounds (empty for the first round).
+        requests_path (str): Output file for the requests of the next round.
+    
+    Returns:
+        int: The number of requests written to `requests_path` (0 if the sweep is complete).
+    """
+    # Group the responses by question, i.e. by the custom_id without the request name
+    responses_by_question = {}
+    for custom_id, result in read_batch_results(results_paths).items():
+        question_id, request_name = custom_id.rsplit("|", 1)
+        responses_by_question.setdefault(question_id, {})[request_name] = result
+    requests = []
+    for technique_name, dataset, few_shot_prompting in runs:
+        assert(dataset in DATASET_FILES)
+        technique = technique_factory(technique_name, few_shot_prompting, dataset.split('_')[0], service, model, temperature, max_token)
+        if not technique.supports_batch:
+            print(f"Skipping the {technique_name} technique, it cannot be answered with Batch API requests.")
+            continue
+        dataset_df = pd.read_csv(f"datasets/{dataset}.csv")
+        results = []
+        run_requests = []
+        for index, sample in dataset_df.iterrows():
+            question = str(sample['question'])
+            try:
+                correct_answer = float(sample['answer'])
+            except Exception as e:
+                print(f"Error parsing the answer to float for question '{question}': {e}")
+                continue
+            # Responses of this question from the earlier rounds
+            responses = responses_by_question.get(batch_custom_id(technique_name, few_shot_prompting, dataset, index, "")[:-1], {})
+            with collect_request_stats() as stats:
+                result = technique.route(question)
+            if result is None:
+                missing = technique.batch_requests(question, responses)
+                if missing:
+                    for request_name, messages in missing.items():
+                        custom_id = batch_custom_id(technique_name, few_shot_prompting, dataset, index, request_name)
+                        run_requests.append(batch_request_line(custom_id, messages, service, model, temperature, max_token))
+                    continue
+                with collect_request_stats() as query_stats:
+                    result = technique.query_from_batch(question, responses)
+                stats.update(query_stats)
+            answer, reasoning, prompt_tokens, completion_tokens = result
+            response = technique.build_detailed_response(question, answer, reasoning, prompt_tokens, completion_tokens, stats=stats)
+            response['correct_answer'] = correct_answer
+            response['category'] = sample.get('category', 'N/A')
+            response['subcategory'] = sample.get('subcategory', 'N/A')
+            response['latency_in_seconds'] = None   # Not meaningful in batch mode
+            record_router_result(response['subcategory'], response)
+            results.append(response)
+        if run_requests:
+            requests.extend(run_requests)
+        else:
+            save_results(results, f"{technique_name}-routed" if technique.routing else technique_name, few_shot_prompting, dataset, service, model)
+    if requests:
+        write_batch_requests(requests_path, requests)
+        print(f"{len(requests)} batch requests saved to {requests_path}. Submit them to the Batch API and run again with the result file.")
+    return len(requests)
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluates all techniques on all datasets.")
+    parser.add_argument("--streaming", action="store_true", help="Stream the responses and stop as soon as the answer was emitted.")
+    parser.add_argument("--batch", action="store_true", help="Use the offline Batch API instead of sending the requests directly.")
+    parser.add_argument("--batch-results", nargs="*", default=[], help="Result files of all earlier batch rounds.")
+    parser.add_argument("--batch-requests", default=None, help="Output file for the requests of the next batch round.")
+    parser.add_argument("--packing", type=int, default=1, help="Number of questions packed into one request by the techniques that support it (Baseline, RolePlaying).")
+    parser.add_argument("--techniques", nargs="+", default=DEFAULT_TECHNIQUES, help="Techniques to evaluate, e.g. SelfConsistency or Cascade, which are not run by default (several sampled requests per question, or the requests of the techniques on the cascade ladder).")
+    parser.add_argument("--datasets", nargs="+", default=["arithmetic_100", "wordProblems_100", "geometry_100"], choices=DATASET_FILES, help="Datasets to evaluate, e.g. arithmetic_100_german.")
+    args = parser.parse_args()
+    
     # Fix the testing parameters
     SERVICE = "azure"
     MODEL = "gpt-35-turbo"
     TEMPERATURE = 0
     MAX_TOKEN = 400
+    MAX_CONCURRENCY = 8     # Number of questions which are processed at the same time
+    TECHNIQUES = args.techniques
+    DATASETS = args.datasets
+    
+    if args.batch:
+        runs = [(technique_name, dataset, few_shot_prompting) for dataset, few_shot_prompting, technique_name in sweep_order(TECHNIQUES, DATASETS)]
+        requests_path = args.batch_requests or f"batch/requests_round{len(args.batch_results) + 1}.jsonl"
+        run_batch_round(runs, SERVICE, MODEL, TEMPERATURE, MAX_TOKEN, args.batch_results, requests_path)
+        sys.exit()
     
-    for technique_name in ["Baseline", "PaL", "CoT", "RolePlaying", "DeclarativeSymPy", "ModelSelection"]:
-        for dataset in ["arithmetic_100", "wordProblems_100", "geometry_100"]:
-            for few_shot_prompting in [True, False]:
-                print(f"Running the evaluation for the {technique_name} {'Few-shot' if few_shot_prompting else 'Zero-shot'} technique on the {dataset} dataset using the {MODEL} model.")
-                run_evaluation(technique_name, few_shot_prompting, dataset, SERVICE, MODEL, TEMPERATURE, MAX_TOKEN)
-                print("Finished.")
\ No newline at end of file
+    for dataset, few_shot_prompting, technique_name in sweep_order(TECHNIQUES, DATASETS):
+        print(f"Running the evaluation for the {technique_name} {'Few-shot' if few_shot_prompting else 'Zero-shot'} technique on the {dataset} dataset using the {MODEL} model.")
+        packing_factor = args.packing if get_technique(technique_name).supports_packing else 1
+        run_evaluation(technique_name, few_shot_prompting, dataset, SERVICE, MODEL, TEMPERATURE, MAX_TOKEN, MAX_CONCURRENCY, args.streaming, packing_factor)
+        print("Finished.")
+    for path, stats in cache_statistics().items():
+        print(f"LLM response cache {path}: {stats['hits']} hits, {stats['misses']} misses, {stats['entries']} entries ({stats['size_bytes']} bytes)")
+    for model_name, endpoints in endpoint_statistics().items():
+        for stats in endpoints:
+            print(f"Endpoint {stats['name']} ({model_name}): {stats['requests']} requests, {stats['errors']} errors, {stats['ejections']} ejections, mean latency {stats['mean_latency_in_seconds'] or 0:.2f} seconds")
+    code_stats = fast_path_statistics()
+    if code_stats['hits'] + code_stats['misses']:
+        print(f"PaL code fast path: {code_stats['hits']} of {code_stats['hits'] + code_stats['misses']} solutions evaluated without execution ({code_stats['hits'] / (code_stats['hits'] + code_stats['misses']):.0%})")
+    execution_stats = execution_cache_statistics()
+    if execution_stats:
+        print(f"PaL execution cache: {execution_stats['hits']} hits, {execution_stats['misses']} misses, {execution_stats['entries']} entries")
+    solver_stats = solver_statistics()
+    if solver_stats['linear'] + solver_stats['sympy']:
+        print(f"Equation systems: {solver_stats['linear']} solved by the linear solver in {solver_stats['linear_seconds']:.2f} seconds, {solver_stats['sympy']} by SymPy in {solver_stats['sympy_seconds']:.2f} seconds ({solver_stats['sympy_timeouts']} timeouts)")
+    for subcategory, stats in router_statistics().items():
+        if stats['routed']:
+            print(f"Arithmetic router ({subcategory}): {stats['routed']} of {stats['questions']} questions answered locally ({stats['routed'] / stats['questions']:.0%}), {stats['router_seconds'] * 1000 / stats['questions']:.3f} ms per question, ~{stats['tokens_saved']} prompt tokens saved")
+    for component, seconds in import_times().items():
+        print(f"Imported {component} in {seconds:.2f} seconds")
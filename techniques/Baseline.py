@@ -4,14 +4,14 @@ from .util import extract_number
 
 class Baseline(TechniqueInterface):
     
+    supports_packing = True
+
     def __init__(self, name: str, few_shot_prompting: bool, dataset: str, service: str, model: str, temperature: float, max_token: int):
         super().__init__(name, few_shot_prompting, dataset, service, model, temperature, max_token)
     
-    def query(self, question: str) -> tuple[float, str, int, int]:
-        response, prompt_tokens, completion_tokens = self.get_llm_response(question)
+    def extract_answer(self, response: str) -> float:
         # Extract the answer from the response
-        answer = extract_number(response)   
-        return answer, response, prompt_tokens, completion_tokens
+        return extract_number(response)
 
     def get_chat_introduction(self) -> str:
         return "Just return the answer to the problem."
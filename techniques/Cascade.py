@@ -0,0 +1,200 @@
+from .TechniqueInterface import TechniqueInterface
+
+import asyncio
+import contextvars
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from llm_inference.request_stats import set_request_stat
+from .registry import get_technique
+
+# Cheap techniques first: Baseline checked against PaL, then ModelSelection
+DEFAULT_LADDER = "Baseline+PaL,ModelSelection"
+
+class Cascade(TechniqueInterface):
+    """
+    Queries a ladder of techniques from cheap to expensive and stops at the first rung whose answer is not in doubt.
+
+    The ladder is configured with the environment variable `CASCADE_LADDER` (or `CASCADE_LADDER_<DATASET>`, e.g.
+    `CASCADE_LADDER_GEOMETRY`, for one dataset): rungs are separated by commas, e.g. "Baseline+PaL,ModelSelection".
+    A rung is a technique, optionally followed by checking techniques after a "+", which are queried at the same time.
+    The answer of a rung is in doubt if it is not a finite number (e.g. `extract_number` found no number or the PaL code
+    failed) or if a checking technique's answer differs by more than `CASCADE_TOLERANCE` (default: 1e-3).
+    The answer of the last rung is always taken. The tokens of all queried techniques are summed up.
+    A technique that answered on an earlier rung is not queried again by a later one: ModelSelection reuses the result
+    of PaL or CoT (see `candidate_techniques`) instead of sending their requests again, and does not count their tokens.
+    """
+
+    def __init__(self, name: str, few_shot_prompting: bool, dataset: str, service: str, model: str, temperature: float, max_token: int):
+        super().__init__(name, few_shot_prompting, dataset, service, model, temperature, max_token)
+        ladder = os.getenv(f"CASCADE_LADDER_{dataset.upper()}") or os.getenv("CASCADE_LADDER", DEFAULT_LADDER)
+        self.tolerance = float(os.getenv("CASCADE_TOLERANCE", "1e-3"))
+        # A technique used on several rungs is created once, so its responses are cached and reused
+        techniques = {}
+        self.rungs = []
+        for rung in ladder.split(","):
+            names = [technique_name.strip() for technique_name in rung.split("+")]
+            if "" in names or "Cascade" in names:
+                raise ValueError(f"Invalid rung {rung!r} in the cascade ladder {ladder!r}")
+            for technique_name in names:
+                if technique_name not in techniques:
+                    techniques[technique_name] = get_technique(technique_name)(name=technique_name, few_shot_prompting=few_shot_prompting, dataset=dataset, service=service, model=model, temperature=temperature, max_token=max_token)
+            self.rungs.append([techniques[technique_name] for technique_name in names])
+        self.techniques = list(techniques.values())
+        # Batch mode needs every technique of the ladder to support it (see `batch_rung`)
+        self.supports_batch = all(technique.supports_batch for technique in self.techniques)
+
+    def query(self, question: str) -> tuple[float, str, int, int]:
+        """ Queries the rungs one after the other until an answer is not in doubt (see `find_doubt`). """
+        prompt_tokens, completion_tokens, doubts, answered = 0, 0, [], {}
+        for index, rung in enumerate(self.get_rungs()):
+            results = self.query_rung(rung, question, answered)
+            prompt_tokens += sum(result[2] for result in results)
+            completion_tokens += sum(result[3] for result in results)
+            doubt = self.find_doubt(results)
+            if doubt is None or index == len(self.rungs) - 1:
+                return self.record_rung(index, doubts, results[0], prompt_tokens, completion_tokens)
+            doubts.append(doubt)
+            answered.update(self.get_answered(rung, results))
+
+    async def query_async(self, question: str) -> tuple[float, str, int, int]:
+        """ Asynchronous version of `query`, see above. The techniques of a rung are gathered. """
+        prompt_tokens, completion_tokens, doubts, answered = 0, 0, [], {}
+        for index, rung in enumerate(self.get_rungs()):
+            results = await asyncio.gather(*(self.query_technique_async(technique, question, answered) for technique in rung))
+            prompt_tokens += sum(result[2] for result in results)
+            completion_tokens += sum(result[3] for result in results)
+            doubt = self.find_doubt(results)
+            if doubt is None or index == len(self.rungs) - 1:
+                return self.record_rung(index, doubts, results[0], prompt_tokens, completion_tokens)
+            doubts.append(doubt)
+            answered.update(self.get_answered(rung, results))
+
+    def get_rungs(self) -> list[list[TechniqueInterface]]:
+        """ Returns the rungs of the ladder, each a list of the answering technique and its checking techniques. """
+        for technique in self.techniques:
+            technique.streaming = self.streaming
+        return self.rungs
+
+    def estimate_request_tokens(self, question: str) -> int:
+        """ The requests of the first rung, the other rungs depend on its answer. """
+        return sum(technique.estimate_request_tokens(question) for technique in self.rungs[0])
+
+    def query_rung(self, rung: list[TechniqueInterface], question: str, answered: dict) -> list[tuple]:
+        """ Queries the techniques of a rung at the same time, in threads with a copy of the context like ModelSelection. """
+        if len(rung) == 1:
+            return [self.query_technique(rung[0], question, answered)]
+        with ThreadPoolExecutor(max_workers=len(rung)) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, self.query_technique, technique, question, answered) for technique in rung]
+            return [future.result() for future in futures]
+
+    def query_technique(self, technique: TechniqueInterface, question: str, answered: dict) -> tuple[float, str, int, int]:
+        """ Queries one technique of a rung. If the query fails, the technique has no answer. """
+        try:
+            candidate_results = self.get_candidate_results(technique, answered)
+            return technique.query(question, candidate_results) if candidate_results else technique.query(question)
+        except Exception:
+            return None, None, 0, 0
+
+    async def query_technique_async(self, technique: TechniqueInterface, question: str, answered: dict) -> tuple[float, str, int, int]:
+        """ Asynchronous version of `query_technique`. """
+        try:
+            candidate_results = self.get_candidate_results(technique, answered)
+            return await (technique.query_async(question, candidate_results) if candidate_results else technique.query_async(question))
+        except Exception:
+            return None, None, 0, 0
+
+    def get_answered(self, rung: list[TechniqueInterface], results: list[tuple]) -> dict:
+        """ Returns the results of the techniques of a rung that got a response, by technique name, for the later rungs. """
+        return {technique.name: result for technique, result in zip(rung, results) if result[1] is not None}
+
+    def get_candidate_results(self, technique: TechniqueInterface, answered: dict) -> dict:
+        """
+        Returns the results of earlier rungs that a technique reuses instead of querying them again, by the names of its
+        branches (e.g. "pal" of ModelSelection, see its `candidate_techniques`).
+        """
+        candidate_techniques = getattr(technique, "candidate_techniques", {})
+        return {branch: answered[name] for branch, name in candidate_techniques.items() if name in answered}
+
+    def find_doubt(self, results: list[tuple]) -> str:
+        """
+        Verifies the answer of a rung.
+
+        Args:
+            results (list[tuple]): (answer, reasoning, prompt tokens, completion tokens) of the answering technique,
+            followed by the ones of the checking techniques.
+
+        Returns:
+            str: None if the answer is not in doubt, otherwise why: "no_answer", "not_a_number" or "disagreement".
+        """
+        answer = results[0][0]
+        if answer is None:
+            return "no_answer"
+        if not isinstance(answer, (int, float)) or not math.isfinite(answer):
+            return "not_a_number"
+        for check in results[1:]:
+            try:
+                if abs(float(check[0]) - answer) <= self.tolerance:
+                    continue
+            except (TypeError, ValueError):
+                pass
+            return "disagreement"
+        return None
+
+    def record_rung(self, index: int, doubts: list[str], result: tuple, prompt_tokens: int, completion_tokens: int) -> tuple[float, str, int, int]:
+        """
+        Records the rung that produced the answer in the row of the question: its index in `cascade_rung` (0 is the
+        cheapest), its techniques in `cascade_technique` and why the rungs before were left in `cascade_doubts`.
+        """
+        set_request_stat("cascade_rung", index)
+        set_request_stat("cascade_technique", "+".join(technique.name for technique in self.rungs[index]))
+        set_request_stat("cascade_doubts", ",".join(doubts))
+        return result[0], result[1], prompt_tokens, completion_tokens
+
+    # ======== BATCH ================
+    # The requests of a technique on rung i at position j are named "i.j.<request of the technique>".
+
+    def get_technique_responses(self, index: int, position: int, responses: dict) -> dict:
+        """ Returns the batch responses of the technique at `position` of rung `index`, with the names it uses. """
+        prefix = f"{index}.{position}."
+        return {request_name[len(prefix):]: response for request_name, response in responses.items() if request_name.startswith(prefix)}
+
+    def batch_rung(self, question: str, responses: dict) -> tuple[dict, int, list]:
+        """
+        Walks the ladder with the batch responses received so far.
+
+        Returns:
+            tuple[dict, int, list]: The missing requests (empty once the question can be answered), the index of the
+            current rung and the results of all queried rungs.
+        """
+        rung_results, answered = [], {}
+        for index, rung in enumerate(self.get_rungs()):
+            missing, results = {}, []
+            for position, technique in enumerate(rung):
+                technique_responses = self.get_technique_responses(index, position, responses)
+                # A reused result counts as a response without tokens (the reasoning of PaL and CoT is their response)
+                for branch, result in self.get_candidate_results(technique, answered).items():
+                    technique_responses.setdefault(branch, (result[1], 0, 0))
+                requests = technique.batch_requests(question, technique_responses)
+                missing.update({f"{index}.{position}.{request_name}": messages for request_name, messages in requests.items()})
+                if not requests:
+                    results.append(technique.query_from_batch(question, technique_responses))
+            if missing:
+                return missing, index, rung_results
+            rung_results.append(results)
+            if self.find_doubt(results) is None:
+                break
+            answered.update(self.get_answered(rung, results))
+        return {}, len(rung_results) - 1, rung_results
+
+    def batch_requests(self, question: str, responses: dict) -> dict:
+        """ Batch mode needs one round per queried rung. """
+        return self.batch_rung(question, responses)[0]
+
+    def query_from_batch(self, question: str, responses: dict) -> tuple[float, str, int, int]:
+        _, index, rung_results = self.batch_rung(question, responses)
+        prompt_tokens = sum(result[2] for results in rung_results for result in results)
+        completion_tokens = sum(result[3] for results in rung_results for result in results)
+        doubts = [self.find_doubt(results) for results in rung_results[:-1]]
+        return self.record_rung(index, doubts, rung_results[-1][0], prompt_tokens, completion_tokens)
@@ -1,17 +1,26 @@
 from .TechniqueInterface import TechniqueInterface
 
+import re
+
 from .util import extract_number
 
+# Holds once a complete number follows the answer prefix, i.e. the number is followed by a non-digit character
+ANSWER_EMITTED = re.compile(r"So the answer is [^\d\n]*?[-+]?[\d,]*\.?\d+(?:[^\d.,]|[.,]\s)")
+
 class CoT(TechniqueInterface):
     
     def __init__(self, name: str, few_shot_prompting: bool, dataset: str, service: str, model: str, temperature: float, max_token: int):
         super().__init__(name, few_shot_prompting, dataset, service, model, temperature, max_token)
     
-    def query(self, question: str) -> tuple[float, str, int, int]:
-        response, prompt_tokens, completion_tokens = self.get_llm_response(question)
+    def extract_answer(self, response: str) -> float:
         # Extract the answer from the response
-        answer = extract_number(response, "So the answer is ")   
-        return answer, response, prompt_tokens, completion_tokens
+        return extract_number(response, "So the answer is ")
+
+    def get_stop_condition(self):
+        return self.answer_emitted
+
+    def answer_emitted(self, response: str) -> bool:
+        return ANSWER_EMITTED.search(response) is not None
 
     def get_chat_introduction(self) -> str:
         return "Let's solve the following math problems. You need to solve these math problems step by step."
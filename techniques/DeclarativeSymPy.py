@@ -1,24 +1,39 @@
 from .TechniqueInterface import TechniqueInterface
 
+import functools
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+from llm_inference.request_stats import set_request_stat
+from .linear_solver import LinearSystemUnsupported, record_solver_stage, solve_linear_system
 from .util import extract_number
 
+ANSWER_EMITTED = re.compile(r"\[\[answer [^\]]*\]\]")
+# Three letters in a row (e.g. "sqrt" or a long variable name), see `has_letter_run`
+LETTER_RUN = re.compile(r"[A-Za-z]{3}")
+
 class DeclarativeSymPy(TechniqueInterface):
     
     def __init__(self, name: str, few_shot_prompting: bool, dataset: str, service: str, model: str, temperature: float, max_token: int):
         super().__init__(name, few_shot_prompting, dataset, service, model, temperature, max_token)
     
-    def query(self, question: str) -> tuple[float, str, int, int]:
-        response, prompt_tokens, completion_tokens = self.get_llm_response(question)
+    def extract_answer(self, response: str) -> float:
         # Extract the answer from the response
         eq_list = re.findall(r'\[\[.*?\]\]', response)
         if len(eq_list) > 0:   
             # Implementation see below         
             tmp = reformat_equations_from_peano(eq_list)
-            return get_final_using_sympy(tmp), response, prompt_tokens, completion_tokens
+            return get_final_using_sympy(tmp)
         else:
-            return extract_number(response), response, prompt_tokens, completion_tokens # Try our best
+            return extract_number(response) # Try our best
+
+    def get_stop_condition(self):
+        return self.answer_emitted
+
+    def answer_emitted(self, response: str) -> bool:
+        # The goal "[[answer x]]" is the last sentence of a solution in the Peano format
+        return ANSWER_EMITTED.search(response) is not None
 
     def get_chat_introduction(self) -> str:
         return CHAT_INTRODUCTION
@@ -41,8 +56,6 @@ class DeclarativeSymPy(TechniqueInterface):
 # =============== IMPLEMENTATION ===============
 # Taken from offical paper github repo: https://github.com/joyheyueya/declarative-math-word-problem
 
-from sympy import solve, sympify, Symbol
-from sympy.parsing.sympy_parser import parse_expr, standard_transformations, implicit_multiplication_application, convert_xor
 import string
 
 
@@ -68,9 +81,34 @@ def reformat_equations_from_peano(eq_list: str) -> str:
     except Exception as e:
         return None
 
+def has_letter_run(equations: str) -> bool:
+    """ Returns whether the equations contain three letters in a row, which are not solved. """
+    if equations.isascii():
+        return LETTER_RUN.search(equations) is not None
+    return any(equations[c].isalpha() and equations[c+1].isalpha() and equations[c+2].isalpha() for c in range(len(equations) - 2))
+
+def find_goal(equation_list: list) -> tuple:
+    """
+    Finds the variable whose value is the answer, from the last equation (e.g. "c = ?").
+    If the goal is an expression (e.g. "a + b = ?"), it is assigned to a new variable.
+
+    Returns:
+        tuple[str, str]: The variable of the goal (None if there is none) and the equation defining it (None if the goal is a variable).
+    """
+    goal = equation_list[-1].split('=')[0].strip()
+    if goal.isalpha() or len(goal) == 2:
+        return goal, None
+    if '=' in equation_list[-1]:
+        for l in list(string.ascii_lowercase) + list(string.ascii_uppercase):
+            if l not in equation_list[-1]:
+                return l, l + ' - (' + goal + ')'
+    return None, None
+
 def get_final_using_sympy(equations):
     """
     Solves mathematics equations provided in a string format using SymPy.
+    Linear systems are solved without SymPy, see `linear_solver.py`. Other systems are solved in a worker process
+    (see `sandbox.py`), which is killed if it does not finish in time; the answer is None then.
 
     Args:
         equations (str): String containing equations separated by commas.
@@ -79,42 +117,87 @@ def get_final_using_sympy(equations):
         float or None: The result of the equations solved, or None if an exception occurs.
     """
     try:
-        transformations = (standard_transformations + (implicit_multiplication_application,) + (convert_xor,))
         if str(equations) is None or str(equations) == 'nan':
             return None
         equation_list = equations.split(',')
-        for eq in equation_list:
-            for c in range(len(eq)):
-                if c < len(eq) - 2:
-                    if eq[c].isalpha() and eq[c+1].isalpha() and eq[c+2].isalpha():
-                        return None
+        if has_letter_run(equations):
+            return None
+        goal_var, goal_source = find_goal(equation_list)
+    except Exception as e:
+        return None
+
+    start = time.perf_counter()
+    try:
+        answer = solve_linear_system(equation_list, goal_var, goal_source)
+        record_solver_stage("linear", time.perf_counter() - start)
+        set_request_stat("linear_fast_path", True)
+        return answer
+    except LinearSystemUnsupported:
+        set_request_stat("linear_fast_path", False)
 
-        goal_var = None
+    from .sandbox import get_sympy_sandbox
+    start = time.perf_counter()
+    answer, _, outcome = get_sympy_sandbox().run(equation_list, goal_var, goal_source)
+    record_solver_stage("sympy", time.perf_counter() - start, outcome)
+    set_request_stat("sympy_outcome", outcome)
+    return answer
+
+def get_final_using_sympy_batch(equations_list: list, max_workers: int = None) -> list:
+    """
+    Solves many equation systems, e.g. to re-score recorded responses. Each distinct system is solved once,
+    and the systems that need SymPy are solved concurrently by the workers of the SymPy sandbox,
+    which reuse the sub-equations they have parsed before (see `parse_equation`).
+
+    Args:
+        equations_list (list[str]): Equations as passed to `get_final_using_sympy`.
+        max_workers (int, optional): Number of systems solved at the same time.
+
+    Returns:
+        list[float or None]: The result of each system.
+    """
+    distinct = list(dict.fromkeys(equations for equations in equations_list if isinstance(equations, str)))
+    with ThreadPoolExecutor(max_workers) as executor:
+        answers = dict(zip(distinct, executor.map(get_final_using_sympy, distinct)))
+    return [answers[equations] if isinstance(equations, str) else get_final_using_sympy(equations) for equations in equations_list]
+
+def warm_up_sympy():
+    """ Imports SymPy and solves a small system, such that a worker of the SymPy sandbox is ready for the first request. """
+    solve_using_sympy(['a = 2', 'b = a^2 + 1', 'b = ?'], 'b', None)
+
+@functools.lru_cache(maxsize=None)
+def get_transformations() -> tuple:
+    """ Returns the transformations of `parse_expr`, which allow implicit multiplication and `^` for powers. """
+    from sympy.parsing.sympy_parser import standard_transformations, implicit_multiplication_application, convert_xor
+    return standard_transformations + (implicit_multiplication_application,) + (convert_xor,)
+
+@functools.lru_cache(maxsize=4096)
+def parse_equation(expression: str):
+    """ Parses an expression with SymPy. The result is cached, since the same equations occur in many responses. """
+    from sympy import sympify
+    from sympy.parsing.sympy_parser import parse_expr
+    return sympify(parse_expr(expression, transformations=get_transformations()))
+
+def solve_using_sympy(equation_list: list, goal_var: str, goal_source: str):
+    """
+    Solves the equations of `get_final_using_sympy` with SymPy, adding them one by one until the goal is determined.
+    It has no time limit, hence it runs in the SymPy sandbox.
+    """
+    # SymPy takes about a second to import, hence it is only imported once equations are solved
+    from sympy import solve, Symbol
+    try:
         goal_expression_list = []
-            
-        if equation_list[-1].split('=')[0].strip().isalpha() or len(equation_list[-1].split('=')[0].strip()) == 2:
-            goal_var = equation_list[-1].split('=')[0].strip()
-        elif '=' in equation_list[-1]:
-            for l in list(string.ascii_lowercase) + list(string.ascii_uppercase):
-                if l not in equation_list[-1]:
-                    goal_var = l
-                    break
-            if goal_var is not None:
-                goal_expression = goal_var + ' - (' + equation_list[-1].split('=')[0].strip() + ')'
-                goal_expression = parse_expr(goal_expression, transformations=transformations)
-                goal_expression = sympify(goal_expression)
-                try:
-                    return float(solve(goal_expression)[0])
-                except Exception as e:
-                    pass
-                goal_expression_list.append(goal_expression)
-            else:
-                return None
+
+        if goal_source is not None:
+            goal_expression = parse_equation(goal_source)
+            try:
+                return float(solve(goal_expression)[0])
+            except Exception as e:
+                pass
+            goal_expression_list.append(goal_expression)
 
         if len(equation_list) == 1:
             try:
-                goal_expression = parse_expr(equation_list[0].split('=')[0], transformations=transformations)
-                return float(sympify(goal_expression))
+                return float(parse_equation(equation_list[0].split('=')[0]))
             except Exception as e:
                 return None
 
@@ -127,17 +210,17 @@ def get_final_using_sympy(equations):
                 try:    
                     sub_eqs_split = sub_eqs.split('=')
                     sub_eqs = sub_eqs_split[0].strip() + ' - (' + sub_eqs_split[1].strip() + ')'
-                    sub_eqs = parse_expr(sub_eqs, transformations=transformations)
-                    sub_eqs = sympify(sub_eqs)
+                    sub_eqs = parse_equation(sub_eqs)
                 except Exception as e:
                     return None
                 goal_expression_list.append(sub_eqs)
 
                 try:
+                    solution = solve(goal_expression_list)
                     try:
-                        return float(solve(goal_expression_list)[Symbol(goal_var)])
+                        return float(solution[Symbol(goal_var)])
                     except Exception as e:
-                        return float(solve(goal_expression_list)[0][Symbol(goal_var)])
+                        return float(solution[0][Symbol(goal_var)])
                 except Exception as e:
                     pass
 
@@ -1,53 +1,265 @@
 from .TechniqueInterface import TechniqueInterface
 
+import asyncio
+import contextvars
+import math
+import os
 import random
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from .util import create_prompt_gpt35
+from .util import PromptPrefix, compile_prompt_prefix_gpt35
+from llm_inference.request_stats import set_request_stat, tag_requests
 from .PaL import PaL
 from .CoT import CoT
 
+SELECTION_GATE_MODES = ("off", "on", "shadow")
+COT_ANSWER_PREFIX = "So the answer is "
+
 class ModelSelection(TechniqueInterface):
     
+    # The names of the techniques that answer the "cot" and "pal" branches, see `candidate_results` of `query`
+    candidate_techniques = {"cot": "CoT", "pal": "PaL"}
+    
     def __init__(self, name: str, few_shot_prompting: bool, dataset: str, service: str, model: str, temperature: float, max_token: int):
         super().__init__(name, few_shot_prompting, dataset, service, model, temperature, max_token)
+        # The candidates are created once and answer all questions
+        self.cot_technique = CoT(name="CoT", few_shot_prompting=few_shot_prompting, dataset=dataset, service=service, model=model, temperature=temperature, max_token=max_token)
+        self.pal_technique = PaL(name="PaL", few_shot_prompting=few_shot_prompting, dataset=dataset, service=service, model=model, temperature=temperature, max_token=max_token)
+        # "on" answers clear cases without the selection request, "shadow" only records what the gate would have answered
+        self.gate_mode = os.getenv("MODEL_SELECTION_GATE", "off")
+        if self.gate_mode not in SELECTION_GATE_MODES:
+            raise ValueError(f"MODEL_SELECTION_GATE must be one of {SELECTION_GATE_MODES}, not {self.gate_mode!r}")
     
-    def query(self, question: str) -> tuple[float, str, int, int]:
+    def query(self, question: str, candidate_results: dict = None) -> tuple[float, str, int, int]:
         """ 
-        1. Query CoT for solutions
-        2. Query PAL for solutions
-        3. Query model selection answers
+        1. Query CoT and PaL for solutions at the same time
+        2. Query model selection answers
         
         Note that we only query selection answers when CoT and PAL answers are different. Otherwise, we directly use CoT or PAL answers.
+        If the selection gate is on, clear cases are decided without the selection request (see `gate_selection`).
+        The latency and tokens of each request are recorded separately (see `record_branch`).
+        
+        Parameters:
+            question (str): The math question.
+            candidate_results (dict): Results of the candidates that were queried already, by branch ("cot" or "pal"),
+                e.g. by an earlier rung of Cascade. They are not queried again and their tokens are not counted again.
         """
-        # Query CoT
-        cot_technique = CoT(name="CoT", few_shot_prompting=self.few_shot_prompting, dataset=self.dataset, service=self.service, model=self.model, temperature=self.temperature, max_token=self.max_token)
+        results = self.reuse_candidate_results(candidate_results)
+        branches = self.get_missing_branches(results)
+        # The branches run in threads with a copy of the context, such that their requests count towards this question
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = {branch: executor.submit(contextvars.copy_context().run, self.query_branch, branch, technique, question) for branch, technique in branches}
+            results.update({branch: future.result() for branch, future in futures.items()})
+        cot_result, pal_result = results["cot"], results["pal"]
+        # Do selection
+        selection_result, gated_choice = None, None
+        if self.needs_selection(cot_result, pal_result):
+            gated_choice = self.apply_gate(cot_result, pal_result)
+            if gated_choice is None:
+                start = time.perf_counter()
+                try:
+                    selection_result = self.query_selection(question, cot_result[1], pal_result[1])
+                    self.record_branch("selection", time.perf_counter() - start, selection_result[1], selection_result[2])
+                except Exception as e:
+                    pass    # select_answer falls back to PaL
+        return self.select_answer(cot_result, pal_result, selection_result, gated_choice)
+    
+    async def query_async(self, question: str, candidate_results: dict = None) -> tuple[float, str, int, int]:
+        """ Asynchronous version of `query`, see above. PaL executes its code while the CoT request may still be in flight. """
+        results = self.reuse_candidate_results(candidate_results)
+        branches = self.get_missing_branches(results)
+        branch_results = await asyncio.gather(*(self.query_branch_async(branch, technique, question) for branch, technique in branches))
+        results.update({branch: result for (branch, _), result in zip(branches, branch_results)})
+        cot_result, pal_result = results["cot"], results["pal"]
+        # Do selection
+        selection_result, gated_choice = None, None
+        if self.needs_selection(cot_result, pal_result):
+            gated_choice = self.apply_gate(cot_result, pal_result)
+            if gated_choice is None:
+                start = time.perf_counter()
+                try:
+                    selection_result = await self.query_selection_async(question, cot_result[1], pal_result[1])
+                    self.record_branch("selection", time.perf_counter() - start, selection_result[1], selection_result[2])
+                except Exception as e:
+                    pass    # select_answer falls back to PaL
+        return self.select_answer(cot_result, pal_result, selection_result, gated_choice)
+    
+    def get_candidates(self) -> tuple[CoT, PaL]:
+        """ Returns the CoT and PaL techniques that generate the candidate answers. """
+        self.cot_technique.streaming = self.streaming
+        return self.cot_technique, self.pal_technique
+    
+    def reuse_candidate_results(self, candidate_results: dict) -> dict:
+        """ Returns the results of candidates that were queried already (see `query`) without their tokens, which were counted when they were queried. """
+        return {branch: (result[0], result[1], 0, 0) for branch, result in (candidate_results or {}).items()}
+    
+    def get_missing_branches(self, results: dict) -> list[tuple[str, TechniqueInterface]]:
+        """ Returns the branches ("cot", "pal") and their techniques that have no result yet. """
+        cot_technique, pal_technique = self.get_candidates()
+        return [(branch, technique) for branch, technique in [("cot", cot_technique), ("pal", pal_technique)] if branch not in results]
+    
+    def estimate_request_tokens(self, question: str) -> int:
+        """ The CoT and PaL requests, the selection request depends on their answers. """
+        return self.cot_technique.estimate_request_tokens(question) + self.pal_technique.estimate_request_tokens(question)
+    
+    def query_branch(self, branch: str, technique: TechniqueInterface, question: str) -> tuple[float, str, int, int]:
+        """ Queries one of the candidates. If the query fails, the candidate has no answer. """
+        start = time.perf_counter()
         try:
-            cot_response, cot_reasoning, cot_prompt_tokens, cot_completion_tokens = cot_technique.query(question)
-        except:
-            cot_response, cot_reasoning, cot_prompt_tokens, cot_completion_tokens = None, None, 0, 0
-        # Query PaL
-        pal_technique = PaL(name="PaL", few_shot_prompting=self.few_shot_prompting, dataset=self.dataset, service=self.service, model=self.model, temperature=self.temperature, max_token=self.max_token)
+            result = technique.query(question)
+        except Exception:
+            result = None, None, 0, 0
+        self.record_branch(branch, time.perf_counter() - start, result[2], result[3])
+        return result
+    
+    async def query_branch_async(self, branch: str, technique: TechniqueInterface, question: str) -> tuple[float, str, int, int]:
+        """ Asynchronous version of `query_branch`. """
+        start = time.perf_counter()
         try:
-            pal_response, pal_reasoning, pal_prompt_tokens, pal_completion_tokens = pal_technique.query(question)
+            result = await technique.query_async(question)
+        except Exception:
+            result = None, None, 0, 0
+        self.record_branch(branch, time.perf_counter() - start, result[2], result[3])
+        return result
+    
+    def record_branch(self, branch: str, seconds: float, prompt_tokens: int, completion_tokens: int):
+        """ Records the latency and tokens of a branch ("cot", "pal" or "selection") in the row of the question, e.g. `cot_latency_in_seconds`. """
+        set_request_stat(f"{branch}_latency_in_seconds", seconds)
+        set_request_stat(f"{branch}_prompt_tokens", prompt_tokens)
+        set_request_stat(f"{branch}_completion_tokens", completion_tokens)
+    
+    def batch_requests(self, question: str, responses: dict) -> dict:
+        """
+        Batch mode needs two rounds: first the CoT and PaL requests, then the selection request 
+        for the questions where their answers differ.
+        """
+        cot_technique, pal_technique = self.get_candidates()
+        requests = {}
+        if "cot" not in responses:
+            requests["cot"] = cot_technique.get_messages(question)
+        if "pal" not in responses:
+            requests["pal"] = pal_technique.get_messages(question)
+        if requests:
+            return requests
+        cot_result, pal_result = self.get_batch_candidate_results(responses)
+        if self.needs_selection(cot_result, pal_result) and "selection" not in responses:
+            if self.apply_gate(cot_result, pal_result, record=False) is None:
+                return {"selection": self.get_selection_messages(question, cot_result[1], pal_result[1])}
+        return {}
+    
+    def query_from_batch(self, question: str, responses: dict) -> tuple[float, str, int, int]:
+        cot_result, pal_result = self.get_batch_candidate_results(responses)
+        gated_choice = self.apply_gate(cot_result, pal_result) if self.needs_selection(cot_result, pal_result) else None
+        return self.select_answer(cot_result, pal_result, responses.get("selection"), gated_choice)
+    
+    def get_batch_candidate_results(self, responses: dict) -> tuple[tuple, tuple]:
+        """ Post-processes the CoT and PaL batch responses like `query` does. """
+        cot_technique, pal_technique = self.get_candidates()
+        cot_response, cot_prompt_tokens, cot_completion_tokens = responses["cot"]
+        pal_response, pal_prompt_tokens, pal_completion_tokens = responses["pal"]
+        cot_result = cot_technique.extract_answer(cot_response), cot_response, cot_prompt_tokens, cot_completion_tokens
+        pal_result = pal_technique.extract_answer(pal_response), pal_response, pal_prompt_tokens, pal_completion_tokens
+        return cot_result, pal_result
+    
+    def needs_selection(self, cot_result: tuple, pal_result: tuple) -> bool:
+        """ Returns True if both CoT and PaL returned an answer, but the answers are different. """
+        cot_response, pal_response = cot_result[0], pal_result[0]
+        if cot_response is None or pal_response is None:
+            return False
+        try:    # Do a save check
+            if abs(float(cot_response) - float(pal_response)) < 1e-3:   
+                return False
         except:
-            pal_response, pal_reasoning, pal_prompt_tokens, pal_completion_tokens = None, None, 0, 0
-        # Do selection
+            pass
+        return True
+    
+    def gate_selection(self, cot_result: tuple, pal_result: tuple) -> tuple[str, str]:
+        """
+        Decides locally which of two different answers is correct if the responses make it clear, such that only
+        ambiguous cases need the selection request. The signals are checked in this order:
+        
+        - An answer that is not a finite number loses (e.g. PaL code that returned `inf`).
+        - A CoT response without the answer prefix "So the answer is " loses, its answer is just the last number in the text.
+        - If the CoT answer has decimals and PaL's answer rounded to as many decimals is the CoT answer, both agree and
+          the unrounded PaL answer wins.
+        
+        Args:
+            cot_result (tuple): (answer, reasoning, prompt tokens, completion tokens) of CoT.
+            pal_result (tuple): (answer, reasoning, prompt tokens, completion tokens) of PaL.
+        
+        Returns:
+            tuple[str, str]: The choice "(A)" (CoT), "(B)" (PaL) or None if the case is ambiguous, and the signal that
+            decided it ("pal_not_finite", "cot_not_finite", "cot_no_answer_prefix", "rounding" or "escalated").
+        """
+        try:
+            cot_answer, pal_answer = float(cot_result[0]), float(pal_result[0])
+        except (TypeError, ValueError):
+            return None, "escalated"
+        if not math.isfinite(pal_answer):
+            return "(A)", "pal_not_finite"
+        if not math.isfinite(cot_answer):
+            return "(B)", "cot_not_finite"
+        cot_response = cot_result[1] or ""
+        if COT_ANSWER_PREFIX not in cot_response:
+            return "(B)", "cot_no_answer_prefix"
+        decimals = self.count_answer_decimals(cot_response)
+        if decimals > 0 and round(pal_answer, decimals) == cot_answer:
+            return "(B)", "rounding"
+        return None, "escalated"
+    
+    def count_answer_decimals(self, cot_response: str) -> int:
+        """ Returns the number of decimals of the CoT answer as it is written after the answer prefix, see `extract_number`. """
+        post_prefix_substring = cot_response[cot_response.index(COT_ANSWER_PREFIX) + len(COT_ANSWER_PREFIX):]
+        numbers = re.findall(r"[-+]?[\d,]*\.?\d+", post_prefix_substring)
+        if not numbers or "." not in numbers[0]:
+            return 0
+        return len(numbers[0].split(".")[1])
+    
+    def apply_gate(self, cot_result: tuple, pal_result: tuple, record: bool = True) -> str:
+        """
+        Runs the selection gate for two different answers, depending on the environment variable `MODEL_SELECTION_GATE`:
+        "off" (default) always sends the selection request, "on" only sends it if `gate_selection` escalates, and
+        "shadow" always sends it but records what the gate would have answered.
+        The decision is recorded in the `selection_gate` column and the gate's answer in the `gate_answer` column.
+        
+        Returns:
+            str: The choice that replaces the selection request, or None if the selection request has to be sent.
+        """
+        if self.gate_mode == "off":
+            return None
+        choice, signal = self.gate_selection(cot_result, pal_result)
+        if record:
+            set_request_stat("selection_gate", signal)
+            if choice is not None:
+                set_request_stat("gate_answer", cot_result[0] if choice == "(A)" else pal_result[0])
+        return choice if self.gate_mode == "on" else None
+    
+    def select_answer(self, cot_result: tuple, pal_result: tuple, selection_result: tuple, gated_choice: str = None) -> tuple[float, str, int, int]:
+        """
+        Combines the CoT and PaL results (and the selection response, if one was queried) into the final result.
+        
+        Args:
+            cot_result (tuple): (answer, reasoning, prompt tokens, completion tokens) of CoT.
+            pal_result (tuple): (answer, reasoning, prompt tokens, completion tokens) of PaL.
+            selection_result (tuple): (response, prompt tokens, completion tokens) of the selection query, or None.
+            gated_choice (str): The choice "(A)" or "(B)" of the selection gate, if it replaced the selection query.
+        """
+        cot_response, cot_reasoning, cot_prompt_tokens, cot_completion_tokens = cot_result
+        pal_response, pal_reasoning, pal_prompt_tokens, pal_completion_tokens = pal_result
         if cot_response is not None and pal_response is not None:
-            check = False
-            try:    # Do a save check
-                if abs(float(cot_response) - float(pal_response)) < 1e-3:   
-                    check = True
-            except:
-                pass
-            if check:
+            if not self.needs_selection(cot_result, pal_result):
                 # Answers are the same, We return CoT reasoning (PaL reasoning would be an option as well)
                 return cot_response, cot_reasoning, cot_prompt_tokens+pal_prompt_tokens, cot_completion_tokens+pal_completion_tokens
             else:
                 # We have different answers from CoT and PaL. We need to query selection.
                 try: 
-                    selection_response, selection_prompt_tokens, selection_completion_tokens = self.query_selection(question, cot_reasoning, pal_reasoning)
-                    selection_choice = self.extract_choice(selection_response)
+                    if gated_choice is not None:
+                        selection_choice, selection_prompt_tokens, selection_completion_tokens = gated_choice, 0, 0
+                    else:
+                        selection_response, selection_prompt_tokens, selection_completion_tokens = selection_result
+                        selection_choice = self.extract_choice(selection_response)
                     if selection_choice == '(A)':
                         return cot_response, cot_reasoning, cot_prompt_tokens+pal_prompt_tokens+selection_prompt_tokens, cot_completion_tokens+pal_completion_tokens+selection_completion_tokens
                     elif selection_choice == '(B)':
@@ -89,25 +301,37 @@ class ModelSelection(TechniqueInterface):
             raise ValueError("Unsupported dataset type")
     
     # ======== SELECTION ================   
-    def query_selection(self, question: str, cot_solution: str, pal_solution: str):
+    def get_selection_messages(self, question: str, cot_solution: str, pal_solution: str) -> list:
         """
-        This function is used to query OpenAI for selection solutions.
+        Builds the conversation that asks the LLM which of the two solutions is correct.
         """
         question_extended = question + "\n\n" + "(A)" + "\n" + cot_solution + "\n\n" + "(B)" + "\n" + "\n\n" + pal_solution + "\n\n" + "Which of the above two choices can correctly answer the math problem?"
-        selection_message = create_prompt_gpt35(
+        return self.get_prompt_prefix().build(question_extended)
+
+    def compile_prompt_prefix(self) -> PromptPrefix:
+        # The conversation of ModelSelection itself is the selection request
+        return compile_prompt_prefix_gpt35(
             few_shot_prompting=self.few_shot_prompting,
             system_prompt=SELECT_SYSTEM,
             introduction=self.get_chat_introduction(),
             question_prelude=self.get_question_prelude(),
             few_shot_examples=self.get_few_shot_examples(),
             few_shot_answers=self.get_few_shot_solutions(),
-            question=question_extended
         )
-        try:
-            selection_solution, prompt_tokens, completion_tokens = self.client.make_request(messages=selection_message)
-        except Exception as e:
-            selection_solution = None, 0, 0
-        return selection_solution, prompt_tokens, completion_tokens
+    
+    def query_selection(self, question: str, cot_solution: str, pal_solution: str):
+        """
+        This function is used to query OpenAI for selection solutions.
+        """
+        selection_message = self.get_selection_messages(question, cot_solution, pal_solution)
+        with tag_requests(technique=self.name, few_shot_prompting=self.few_shot_prompting, question=question, request="selection"):
+            return self.client.make_request(messages=selection_message)
+    
+    async def query_selection_async(self, question: str, cot_solution: str, pal_solution: str):
+        """ Asynchronous version of `query_selection`. """
+        selection_message = self.get_selection_messages(question, cot_solution, pal_solution)
+        with tag_requests(technique=self.name, few_shot_prompting=self.few_shot_prompting, question=question, request="selection"):
+            return await self.client.make_request_async(messages=selection_message)
     
     def extract_choice(self, selection: str):
         if selection.startswith('Both') or selection.startswith('Neither'):
@@ -7,11 +7,9 @@ class PaL(TechniqueInterface):
     def __init__(self, name: str, few_shot_prompting: bool, dataset: str, service: str, model: str, temperature: float, max_token: int):
         super().__init__(name, few_shot_prompting, dataset, service, model, temperature, max_token)
     
-    def query(self, question: str) -> tuple[float, str, int, int]:
-        pal_code, prompt_tokens, completion_tokens = self.get_llm_response(question)
+    def extract_answer(self, pal_code: str) -> float:
         # Execute the PaL Code
-        answer = execute_solution_function(pal_code)
-        return answer, pal_code, prompt_tokens, completion_tokens
+        return execute_solution_function(pal_code)
 
     def get_chat_introduction(self) -> str:
         return "Let's use python to solve math problems. You need to write python code to answer these math questions."
@@ -1,41 +1,41 @@
 from .TechniqueInterface import TechniqueInterface
 
 from .util import extract_number
-from .util import create_prompt_gpt35
-from .shared_prompts import get_few_shot_examples, get_system_prompt
+from .util import PromptPrefix
+from .shared_prompts import get_few_shot_examples
 
 class RolePlaying(TechniqueInterface):
     
+    supports_packing = True
+
     def __init__(self, name: str, few_shot_prompting: bool, dataset: str, service: str, model: str, temperature: float, max_token: int):
         # assert few_shot_prompting == False, "RolePlaying technique only supports zero-shot prompting"
         super().__init__(name, few_shot_prompting, dataset, service, model, temperature, max_token)
     
-    def query(self, question: str) -> tuple[float, str, int, int]:
-        # We can't reuse the get_llm_response method, therefore we need to reimplement it here
+    def compile_prompt_prefix(self) -> PromptPrefix:
+        # We can't reuse the default prompt building, therefore we need to reimplement it here
         role_setting = "From now on, you are an excellent math teacher and always teach your students math problems correctly. And I am one of your students."
         reply = "That's great to hear! As your math teacher, I'll do my best to explain mathematical concepts correctly so that you can understand them easily. Feel free to ask any math problems or questions you have, and I'll be glad to assist you. Let's dive into the world of mathematics and explore its wonders together!"
+        # Add role
+        conversation = [
+                    {"role": "user", "content": role_setting},
+                    {"role": "assistant", "content": reply}, ]
         if not self.few_shot_prompting:
-            conversation = [
-                        {"role": "user", "content": role_setting},
-                        {"role": "assistant", "content": reply}, 
-                        {"role": "user", "content": question}]
-            response, prompt_tokens, completion_tokens = self.client.make_request(conversation)
-        else:
-            # Add role
-            conversation = [
-                        {"role": "user", "content": role_setting},
-                        {"role": "assistant", "content": reply}, ]
-            # Add few-shots
-            conversation.append({"role": "user", "content": self.get_chat_introduction() + "\n" + "Here is one example how to do it:" + "\n\n" + self.get_question_prelude() + get_few_shot_examples(self.dataset)[0] + "\n\n" + self.get_few_shot_solutions()[0] + "\n\n" + "Now it's your turn."})
-            # Add remaining four examples and answers to the conversation
-            for i in range(1, len(get_few_shot_examples(self.dataset))):        
-                conversation.append({"role": "user", "content": self.get_question_prelude() + " " + get_few_shot_examples(self.dataset)[i]})
-                conversation.append({"role": "assistant", "content": self.get_few_shot_solutions()[i]})
-            conversation.append({"role": "user", "content": self.get_question_prelude() + question})
-            response, prompt_tokens, completion_tokens = self.client.make_request(conversation)
+            return PromptPrefix(conversation, "")
+        few_shot_examples = get_few_shot_examples(self.dataset)
+        few_shot_solutions = self.get_few_shot_solutions()
+        question_prelude = self.get_question_prelude()
+        # Add few-shots
+        conversation.append({"role": "user", "content": self.get_chat_introduction() + "\n" + "Here is one example how to do it:" + "\n\n" + question_prelude + few_shot_examples[0] + "\n\n" + few_shot_solutions[0] + "\n\n" + "Now it's your turn."})
+        # Add remaining four examples and answers to the conversation
+        for i in range(1, len(few_shot_examples)):        
+            conversation.append({"role": "user", "content": question_prelude + " " + few_shot_examples[i]})
+            conversation.append({"role": "assistant", "content": few_shot_solutions[i]})
+        return PromptPrefix(conversation, question_prelude)
+
+    def extract_answer(self, response: str) -> float:
         # Extract the answer from the response
-        answer = extract_number(response)  
-        return answer, response, prompt_tokens, completion_tokens
+        return extract_number(response)
 
     def get_chat_introduction(self) -> str:
         return "Just return the answer to the problem."
@@ -0,0 +1,117 @@
+from .TechniqueInterface import TechniqueInterface
+
+import asyncio
+import json
+import math
+import os
+
+from llm_inference.request_stats import set_request_stat, tag_requests
+from llm_inference.tokens import count_tokens
+from .registry import get_technique
+
+class SelfConsistency(TechniqueInterface):
+    """
+    Samples several solutions of a base technique and returns the answer most of them agree on.
+
+    The samples are requested with one request (the `n` parameter of the API, see `LLMInterface.make_request_n`), such
+    that the prompt is only paid for once. If the first `SELF_CONSISTENCY_FIRST_BATCH` samples (default: 3) agree,
+    the answer is taken right away, otherwise a second request samples the rest of the `SELF_CONSISTENCY_SAMPLES`
+    (default: 5). The base technique is set with `SELF_CONSISTENCY_TECHNIQUE` (default: CoT, e.g. PaL or
+    DeclarativeSymPy), whose `extract_answer` derives the answer of each sample. The samples are drawn with
+    `SELF_CONSISTENCY_TEMPERATURE` (default: 0.7) and answers within `SELF_CONSISTENCY_TOLERANCE` (default: 1e-3)
+    count as the same vote.
+    """
+
+    # The Batch API requests are sent with the temperature of the sweep and a single sample
+    supports_batch = False
+
+    def __init__(self, name: str, few_shot_prompting: bool, dataset: str, service: str, model: str, temperature: float, max_token: int):
+        self.samples = int(os.getenv("SELF_CONSISTENCY_SAMPLES", "5"))
+        self.first_batch = max(1, min(self.samples, int(os.getenv("SELF_CONSISTENCY_FIRST_BATCH", "3"))))
+        self.tolerance = float(os.getenv("SELF_CONSISTENCY_TOLERANCE", "1e-3"))
+        temperature = float(os.getenv("SELF_CONSISTENCY_TEMPERATURE", "0.7"))
+        super().__init__(name, few_shot_prompting, dataset, service, model, temperature, max_token)
+        base_name = os.getenv("SELF_CONSISTENCY_TECHNIQUE", "CoT")
+        base_class = get_technique(base_name)
+        if base_class.query is not TechniqueInterface.query:
+            raise ValueError(f"SelfConsistency needs a technique with a single request, not {base_name}")
+        self.base_technique = base_class(name=base_name, few_shot_prompting=few_shot_prompting, dataset=dataset, service=service, model=model, temperature=temperature, max_token=max_token)
+
+    def query(self, question: str) -> tuple[float, str, int, int]:
+        """ Samples the first batch, and the rest of the samples only if the first batch is not unanimous. """
+        messages = self.base_technique.get_messages(question)
+        with tag_requests(technique=self.base_technique.name, few_shot_prompting=self.few_shot_prompting, question=question, request="samples"):
+            batches = [self.client.make_request_n(messages, self.first_batch)]
+            answers = self.extract_answers(batches[0][0])
+            if self.samples > self.first_batch and not self.is_unanimous(answers):
+                batches.append(self.client.make_request_n(messages, self.samples - self.first_batch))
+                answers += self.extract_answers(batches[1][0])
+        return self.vote(answers, batches)
+
+    async def query_async(self, question: str) -> tuple[float, str, int, int]:
+        """ Asynchronous version of `query`. The answers are extracted in a thread (e.g. PaL executes the code of every sample). """
+        messages = self.base_technique.get_messages(question)
+        with tag_requests(technique=self.base_technique.name, few_shot_prompting=self.few_shot_prompting, question=question, request="samples"):
+            batches = [await self.client.make_request_n_async(messages, self.first_batch)]
+            answers = await asyncio.to_thread(self.extract_answers, batches[0][0])
+            if self.samples > self.first_batch and not self.is_unanimous(answers):
+                batches.append(await self.client.make_request_n_async(messages, self.samples - self.first_batch))
+                answers += await asyncio.to_thread(self.extract_answers, batches[1][0])
+        return self.vote(answers, batches)
+
+    def estimate_request_tokens(self, question: str) -> int:
+        """ The request of the first batch. """
+        return self.base_technique.estimate_request_tokens(question)
+
+    def extract_answers(self, responses: list[str]) -> list:
+        """ Returns the answer of every sample, None if the base technique found no number. """
+        answers = []
+        for response in responses:
+            try:
+                answer = self.base_technique.extract_answer(response) if response is not None else None
+            except Exception:
+                answer = None
+            answers.append(answer if isinstance(answer, (int, float)) and math.isfinite(answer) else None)
+        return answers
+
+    def count_votes(self, answers: list) -> list[tuple[float, list[int]]]:
+        """ Groups the answers within the tolerance of the first answer of a group, in sampling order. Returns (answer, sample indices) per group. """
+        groups = []
+        for index, answer in enumerate(answers):
+            if answer is None:
+                continue
+            for value, indices in groups:
+                if abs(answer - value) <= self.tolerance:
+                    indices.append(index)
+                    break
+            else:
+                groups.append((answer, [index]))
+        return groups
+
+    def is_unanimous(self, answers: list) -> bool:
+        return None not in answers and len(self.count_votes(answers)) == 1
+
+    def vote(self, answers: list, batches: list[tuple]) -> tuple[float, str, int, int]:
+        """
+        Returns the majority answer (ties go to the answer sampled first) with the reasoning of its first sample, and
+        the tokens of all requests. The row of the question records the votes per answer in `vote_distribution`,
+        the number of samples and requests in `samples` and `sample_requests`, whether the answer was taken after the
+        first batch in `stopped_after_first_batch`, and the completion tokens of every sample in `sample_completion_tokens`
+        (the API only reports the total, so they are counted with the tokenizer).
+        """
+        responses = [response for batch in batches for response in batch[0]]
+        groups = self.count_votes(answers)
+        distribution = {str(value): len(indices) for value, indices in groups}
+        if None in answers:
+            distribution["None"] = answers.count(None)
+        set_request_stat("vote_distribution", json.dumps(distribution))
+        set_request_stat("samples", len(responses))
+        set_request_stat("sample_requests", len(batches))
+        set_request_stat("stopped_after_first_batch", len(batches) == 1)
+        set_request_stat("sample_completion_tokens", json.dumps([count_tokens(response or "") for response in responses]))
+        prompt_tokens = sum(batch[1] for batch in batches)
+        completion_tokens = sum(batch[2] for batch in batches)
+        if not groups:
+            return None, responses[0] if responses else None, prompt_tokens, completion_tokens
+        value, indices = max(groups, key=lambda group: len(group[1]))
+        return value, responses[indices[0]], prompt_tokens, completion_tokens
@@ -1,8 +1,27 @@
 from llm_inference.llm_factory import get_llm_service
-from .util import create_prompt_gpt35
+from llm_inference.request_stats import collect_request_stats, set_request_stat, tag_requests
+from llm_inference.tokens import estimate_prompt_tokens
+from .arithmetic_router import route_question
+from .util import PromptPrefix, compile_prompt_prefix_gpt35
 from .shared_prompts import get_few_shot_examples, get_system_prompt
 
 from abc import abstractmethod
+import asyncio
+import os
+import re
+import threading
+import time
+
+# Compiled prompt prefixes, keyed by (technique class, dataset, few_shot_prompting)
+_prompt_prefixes = {}
+_prompt_prefixes_lock = threading.Lock()
+
+# Request stats that count tokens of a request, which are split among the questions of a packed request like its tokens
+PACKED_TOKEN_STATS = ("cached_prompt_tokens", "cache_hit_prompt_tokens", "cache_hit_completion_tokens")
+
+# One answer of a packed response, e.g. "Answer 3: 42". The label is required, such that a decimal answer ("3.75"),
+# a numbered line of working ("2. 4 + 5 = 9") or a repeated question ("Question 3: ...") is not taken as an answer.
+PACKED_ANSWER = re.compile(r"^\s*Answer\s*(\d+)\s*[.):]\s*(.+?)\s*$", re.MULTILINE | re.IGNORECASE)
 
 class TechniqueInterface:
     """
@@ -20,14 +39,32 @@ class TechniqueInterface:
         temperature (float): Decides the randomness in the generation of model responses, affecting creativity.
         max_token (int): Upper limit on the response size measured in tokens.
         client: An API client configured to communicate with the specified LLM service.
+        streaming (bool): If True, responses are streamed and closed as soon as the stop condition of the technique holds.
+        routing (bool): If True, pure arithmetic questions are answered locally (see `route`). Off unless `ARITHMETIC_ROUTER=1`.
 
     Methods:
+        get_messages(question: str) -> list:
+            Builds the conversation that is sent to the LLM for the given question.
         get_llm_response(question: str) -> tuple[float, str, int, int]:
             Directly handles sending the formalized query to the LLM and receiving the response.
+        get_stop_condition() -> Callable[[str], bool]:
+            Returns a predicate telling when a streamed response contains the answer (None to never stop early).
         query(question: str) -> tuple[float, str, int, int]:
             Processes the question to adapt it for the LLM querying, utilizing specific technique characteristics.
+        query_async(question: str) -> tuple[float, str, int, int]:
+            Asynchronous version of `query`, used by the concurrent scheduler in `run.py`.
+        route(question: str) -> tuple[float, str, int, int]:
+            Answers pure arithmetic questions without the LLM, in front of `query`.
         query_with_detailed_response(question: str) -> dict:
             Wraps the query method to provide detailed response information including metadata.
+        query_packed_with_detailed_response(questions: list[str]) -> list[dict]:
+            Answers several questions with one request, for techniques that `supports_packing`.
+        batch_requests(question: str, responses: dict) -> dict:
+            Returns the requests that are still needed to answer the question in batch mode.
+        query_from_batch(question: str, responses: dict) -> tuple[float, str, int, int]:
+            Same as `query`, but uses the responses returned by the Batch API.
+        extract_answer(response: str) -> float:
+            Abstract method for deriving the final answer from the raw LLM response.
         get_chat_introduction() -> str:
             Abstract method for returning an introduction text to the conversation.
         get_question_prelude() -> str:
@@ -36,6 +73,11 @@ class TechniqueInterface:
             Abstract method for retrieving pre-determined solutions for configured few-shot prompts.
     """
 
+    # True for techniques whose response is just the answer, such that several questions can be packed into one request
+    supports_packing = False
+    # False for techniques that cannot be answered with the requests of the Batch API (see `batch_requests`)
+    supports_batch = True
+
     def __init__(self, name: str, few_shot_prompting: bool, dataset: str, service: str, model: str, temperature: float, max_token: int):
         """
         Initializes attributes and configures the LLM client for querying.
@@ -49,65 +91,296 @@ class TechniqueInterface:
         self.max_token = max_token
         self.dataset = dataset
         self.client = get_llm_service(service, model, temperature, max_token)
+        self.streaming = False
+        self.routing = os.getenv("ARITHMETIC_ROUTER", "0") == "1"
     
-    def get_llm_response(self, question: str) -> tuple[str, str, int, int]:
+    def get_messages(self, question: str) -> list:
         """
-        Sends a specified question to the configured LLM service and returns the raw response.
-
-        This method is common to all techniques and provides the basic functionality to
-        interact with the LLM, handling prompt creation and response retrieval.
+        Builds the conversation for the specified question, i.e. the messages sent to the LLM.
         
         NOTE: If your LLM service provider differs from Azure or OpenAI, you may need to customize or override
-        this method to accommodate your provider's specific API requirements and response formats. This might involve
-        altering how prompts are constructed or how responses are parsed.
+        this method to accommodate your provider's specific API requirements. This might involve
+        altering how prompts are constructed.
         
         Parameters:
             question (str): The math question to send to the model.
         
         Returns:
-            tuple[str, str, int, int]: A tuple containing the raw answer, reasoning (if any), 
-            prompt tokens, and completion tokens.
+            list: The messages formatted for input to the language model.
         """
         # NOTE: If you sure that this function works for your provider, comment this check out.
-        if self.service not in ["azure", "openai"]:
+        if self.service not in ["azure", "openai", "replay"]:
             raise ValueError("You may have to adapt the function to your service provider.")
         
-        messages = create_prompt_gpt35(
+        return self.get_prompt_prefix().build(question)
+
+    def get_prompt_prefix(self) -> PromptPrefix:
+        """
+        Returns the compiled part of the conversation that precedes the question. It is compiled once per
+        technique, dataset and shot mode (see `compile_prompt_prefix`) and shared by all instances.
+        """
+        key = (type(self), self.dataset, self.few_shot_prompting)
+        with _prompt_prefixes_lock:
+            if key not in _prompt_prefixes:
+                _prompt_prefixes[key] = self.compile_prompt_prefix()
+            return _prompt_prefixes[key]
+
+    def compile_prompt_prefix(self) -> PromptPrefix:
+        """
+        Compiles the part of the conversation that precedes the question.
+        Techniques that need a custom conversation override this method (see `RolePlaying.py`).
+        """
+        return compile_prompt_prefix_gpt35(
             few_shot_prompting=self.few_shot_prompting,
             system_prompt = get_system_prompt(self.dataset), 
             introduction = self.get_chat_introduction(), 
             question_prelude = self.get_question_prelude(), 
-            question = question, 
             few_shot_examples = get_few_shot_examples(self.dataset), 
             few_shot_answers = self.get_few_shot_solutions()
         )
-        return self.client.make_request(messages)
     
-    @abstractmethod
+    def get_llm_response(self, question: str) -> tuple[str, int, int]:
+        """
+        Sends a specified question to the configured LLM service and returns the raw response.
+
+        This method is common to all techniques and provides the basic functionality to
+        interact with the LLM, handling prompt creation (see `get_messages`) and response retrieval.
+        If streaming is enabled and the technique has a stop condition, the response is closed as 
+        soon as the answer was emitted (see `LLMInterface.make_request_until`).
+        
+        Parameters:
+            question (str): The math question to send to the model.
+        
+        Returns:
+            tuple[str, int, int]: A tuple containing the raw answer, prompt tokens, and completion tokens.
+        """
+        messages = self.get_messages(question)
+        stop_condition = self.get_stop_condition()
+        with tag_requests(technique=self.name, few_shot_prompting=self.few_shot_prompting, question=question):
+            if self.streaming and stop_condition is not None:
+                return self.client.make_request_until(messages, stop_condition)
+            return self.client.make_request(messages)
+    
+    async def get_llm_response_async(self, question: str) -> tuple[str, int, int]:
+        """ Asynchronous version of `get_llm_response`. """
+        messages = self.get_messages(question)
+        stop_condition = self.get_stop_condition()
+        with tag_requests(technique=self.name, few_shot_prompting=self.few_shot_prompting, question=question):
+            if self.streaming and stop_condition is not None:
+                return await self.client.make_request_until_async(messages, stop_condition)
+            return await self.client.make_request_async(messages)
+    
+    def get_stop_condition(self):
+        """
+        Returns a predicate on the response received so far, which holds once the rest of the response
+        is not needed anymore (e.g. the final answer was emitted). Returns None if the whole response is needed.
+        """
+        return None
+    
     def query(self, question: str) -> tuple[float, str, int, int]:
         """
-        Abstract method that must be implemented by each technique class. This method should
-        utilize the response from get_llm_response and apply specific post-processing to derive the
-        final result according to the technique's purpose, like executing code or extracting numeric values.        
+        Queries the LLM and applies the technique specific post-processing (see `extract_answer`) 
+        to derive the final result, like executing code or extracting numeric values.
+        Techniques that need more than one request (e.g. ModelSelection) override this method.
+        
         Parameters:
             question (str): The math question to send to the model.
         
         Returns:
             tuple[float, str, int, int]: A tuple containing the float answer, reasoning, prompt tokens, and completion tokens.
         """
-        raise NotImplementedError
+        response, prompt_tokens, completion_tokens = self.get_llm_response(question)
+        return self.extract_answer(response), response, prompt_tokens, completion_tokens
+    
+    async def query_async(self, question: str) -> tuple[float, str, int, int]:
+        """
+        Asynchronous version of `query`. The post-processing is the same, but runs in a thread,
+        such that executing code (PaL) or solving equations (DeclarativeSymPy) does not block the other questions.
+        Techniques overriding `query` have to override this method as well.
+        """
+        response, prompt_tokens, completion_tokens = await self.get_llm_response_async(question)
+        return await asyncio.to_thread(self.extract_answer, response), response, prompt_tokens, completion_tokens
+    
+    def route(self, question: str) -> tuple[float, str, int, int]:
+        """
+        Answers a pure arithmetic question (e.g. `88254×26228=`) exactly without the LLM, see `arithmetic_router.py`.
+        The row of the question records whether it was routed (`routed`), the time the router took
+        (`router_latency_in_seconds`) and, if routed, the estimated prompt tokens that were not sent (`router_tokens_saved`).
+        
+        Returns:
+            tuple[float, str, int, int]: The answer, the evaluated expression as reasoning, and 0 tokens,
+            or None if the question has to be answered by `query`.
+        """
+        if not self.routing:
+            return None
+        start = time.perf_counter()
+        routed = route_question(question)
+        set_request_stat("routed", routed is not None)
+        set_request_stat("router_latency_in_seconds", time.perf_counter() - start)
+        if routed is None:
+            return None
+        set_request_stat("router_tokens_saved", self.estimate_request_tokens(question))
+        return routed[0], routed[1], 0, 0
+    
+    def estimate_request_tokens(self, question: str) -> int:
+        """ Estimates the prompt tokens that answering the question takes. Techniques sending other requests than `get_messages` override this method. """
+        return estimate_prompt_tokens(self.get_messages(question))
     
     def query_with_detailed_response(self, question: str) -> dict:
         """
         Executes a query using the implemented `query` method, adding detailed response information.
         
+        If the query fails (e.g. because the LLM service is still unavailable after all retries), the row is kept
+        with the answer None and the error message, such that the question counts as an error instead of being dropped.
+        Pure arithmetic questions are answered by `route` instead of `query`.
+        
         Parameters:
             question (str): The math question to send to the model.
         
         Returns:
             dict: A dictionary containing detailed query and response metadata, useful for analysis and comparison.
         """
-        answer, reasoning, prompt_tokens, completion_tokens = self.query(question)  
+        with collect_request_stats() as stats:
+            try:
+                answer, reasoning, prompt_tokens, completion_tokens = self.route(question) or self.query(question)
+                error = None
+            except Exception as e:
+                answer, reasoning, prompt_tokens, completion_tokens, error = None, None, 0, 0, str(e)
+        return self.build_detailed_response(question, answer, reasoning, prompt_tokens, completion_tokens, error, stats)
+    
+    async def query_with_detailed_response_async(self, question: str) -> dict:
+        """ Asynchronous version of `query_with_detailed_response`. """
+        with collect_request_stats() as stats:
+            try:
+                answer, reasoning, prompt_tokens, completion_tokens = self.route(question) or await self.query_async(question)
+                error = None
+            except Exception as e:
+                answer, reasoning, prompt_tokens, completion_tokens, error = None, None, 0, 0, str(e)
+        return self.build_detailed_response(question, answer, reasoning, prompt_tokens, completion_tokens, error, stats)
+    
+    # ======== PACKING ================
+    # The few-shot prefix is much longer than a question and its answer. Techniques that `supports_packing` can
+    # answer K questions with one request, which amortizes the prefix over K questions.
+
+    def get_packed_messages(self, questions: list[str]) -> list:
+        """ Builds the conversation that asks for the answers to all `questions` as a labeled list. """
+        packed_question = f"Answer each of the following {len(questions)} questions. Reply with one line per question in the form 'Answer <number>: <answer>'.\n"
+        packed_question += "\n".join(f"Question {index}: {question}" for index, question in enumerate(questions, start=1))
+        return self.get_messages(packed_question)
+
+    def parse_packed_answers(self, response: str, count: int) -> list:
+        """
+        Extracts the labeled answers of a packed response (see `extract_answer`). Answers that are missing,
+        not a number or given more than once are None, such that the question is asked again on its own.
+        """
+        answers = {}
+        for match in PACKED_ANSWER.finditer(response or ""):
+            index = int(match.group(1))
+            if 1 <= index <= count:
+                answers.setdefault(index, []).append(self.extract_answer(match.group(2)))
+        parsed = []
+        for index in range(1, count + 1):
+            candidates = answers.get(index, [])
+            answer = candidates[0] if len(candidates) == 1 else None
+            parsed.append(answer if isinstance(answer, float) else None)
+        return parsed
+
+    def build_packed_responses(self, questions: list[str], response: str, prompt_tokens: int, completion_tokens: int, error: str, stats: dict):
+        """
+        Builds the rows of the questions of a packed request, each with its share of the tokens.
+        
+        Returns:
+            tuple[list, list]: The rows (None for questions without answer) and the indices of the questions that have to be asked again.
+        """
+        answers = self.parse_packed_answers(response, len(questions)) if error is None else [None] * len(questions)
+        rows, missing = [], []
+        for index, (question, answer) in enumerate(zip(questions, answers)):
+            if answer is None:
+                missing.append(index)
+                rows.append(None)
+                continue
+            row = self.build_detailed_response(question, answer, response, prompt_tokens / len(questions), completion_tokens / len(questions), stats=self.get_packed_share(stats, len(questions)))
+            row["packing_factor"] = len(questions)
+            rows.append(row)
+        return rows, missing
+
+    def get_packed_share(self, stats: dict, count: int) -> dict:
+        """ Returns the request stats of a packed request for one of its `count` questions, with its share of the token stats. """
+        return {name: value / count if name in PACKED_TOKEN_STATS else value for name, value in stats.items()}
+
+    def add_packed_share(self, row: dict, count: int, prompt_tokens: int, completion_tokens: int, stats: dict) -> dict:
+        """ Adds the share of a packed request to the row of a question that had to be asked again on its own. """
+        row["prompt_tokens"] += prompt_tokens / count
+        row["completion_tokens"] += completion_tokens / count
+        for name, value in self.get_packed_share(stats, count).items():
+            if name in PACKED_TOKEN_STATS:
+                row[name] = row.get(name, 0) + value
+        row["packing_factor"] = count
+        row["requeried"] = True
+        return row
+
+    def split_routed(self, questions: list[str]) -> tuple[dict, list]:
+        """ Answers the questions that `route` answers. Returns their rows by index and the indices of the other questions. """
+        rows, remaining = {}, []
+        for index, question in enumerate(questions):
+            if self.routing and route_question(question) is not None:
+                rows[index] = self.query_with_detailed_response(question)
+            else:
+                remaining.append(index)
+        return rows, remaining
+
+    def query_packed_with_detailed_response(self, questions: list[str]) -> list[dict]:
+        """
+        Answers all `questions` with one request and returns one row per question, like `query_with_detailed_response`.
+        The tokens of the request are split evenly among the questions. Questions whose answer is missing or ambiguous
+        are asked again on their own. Pure arithmetic questions are answered by `route` and left out of the request.
+        """
+        rows, remaining = self.split_routed(questions)
+        if remaining:
+            rows.update(zip(remaining, self.query_packed([questions[index] for index in remaining])))
+        return [rows[index] for index in range(len(questions))]
+
+    async def query_packed_with_detailed_response_async(self, questions: list[str]) -> list[dict]:
+        """ Asynchronous version of `query_packed_with_detailed_response`. """
+        rows, remaining = self.split_routed(questions)
+        if remaining:
+            rows.update(zip(remaining, await self.query_packed_async([questions[index] for index in remaining])))
+        return [rows[index] for index in range(len(questions))]
+
+    def query_packed(self, questions: list[str]) -> list[dict]:
+        """ Answers all `questions` with one request, see `query_packed_with_detailed_response`. """
+        with collect_request_stats() as stats:
+            with tag_requests(technique=self.name, few_shot_prompting=self.few_shot_prompting, request="packed"):
+                try:
+                    response, prompt_tokens, completion_tokens = self.client.make_request(self.get_packed_messages(questions))
+                    error = None
+                except Exception as e:
+                    response, prompt_tokens, completion_tokens, error = None, 0, 0, str(e)
+        rows, missing = self.build_packed_responses(questions, response, prompt_tokens, completion_tokens, error, stats)
+        for index in missing:
+            rows[index] = self.add_packed_share(self.query_with_detailed_response(questions[index]), len(questions), prompt_tokens, completion_tokens, stats)
+        return rows
+
+    async def query_packed_async(self, questions: list[str]) -> list[dict]:
+        """ Asynchronous version of `query_packed`. """
+        with collect_request_stats() as stats:
+            with tag_requests(technique=self.name, few_shot_prompting=self.few_shot_prompting, request="packed"):
+                try:
+                    response, prompt_tokens, completion_tokens = await self.client.make_request_async(self.get_packed_messages(questions))
+                    error = None
+                except Exception as e:
+                    response, prompt_tokens, completion_tokens, error = None, 0, 0, str(e)
+        rows, missing = self.build_packed_responses(questions, response, prompt_tokens, completion_tokens, error, stats)
+        requeried = await asyncio.gather(*(self.query_with_detailed_response_async(questions[index]) for index in missing))
+        for index, row in zip(missing, requeried):
+            rows[index] = self.add_packed_share(row, len(questions), prompt_tokens, completion_tokens, stats)
+        return rows
+
+    def build_detailed_response(self, question: str, answer: float, reasoning: str, prompt_tokens: int, completion_tokens: int, error: str = None, stats: dict = None) -> dict:
+        """
+        Combines the result of a query with the metadata of the technique into one row of the results.
+        `stats` are the counters recorded by the LLM services while answering the question (e.g. the number of retries).
+        """
         data = {
             "technique": self.name,
             "few_shot_prompting": self.few_shot_prompting,
@@ -120,9 +393,44 @@ class TechniqueInterface:
             "temperature": self.temperature,
             "prompt_tokens": prompt_tokens,
             "completion_tokens": completion_tokens,
+            "error": error,
         }
+        data.update(stats or {})
         return data
     
+    def batch_requests(self, question: str, responses: dict) -> dict:
+        """
+        Returns the requests that are still needed to answer the question in batch mode (see `run.py`).
+        Techniques that need several requests per question override this method to request them in several rounds.
+        
+        Parameters:
+            question (str): The math question.
+            responses (dict): The responses of earlier rounds, mapping the name of a request to (response, prompt tokens, completion tokens).
+        
+        Returns:
+            dict: Maps the name of each missing request to its messages. Empty if the question can be answered.
+        """
+        if "answer" in responses:
+            return {}
+        return {"answer": self.get_messages(question)}
+    
+    def query_from_batch(self, question: str, responses: dict) -> tuple[float, str, int, int]:
+        """
+        Same as `query`, but uses the responses returned by the Batch API instead of sending requests.
+        Must only be called once `batch_requests` returns no further requests.
+        """
+        response, prompt_tokens, completion_tokens = responses["answer"]
+        return self.extract_answer(response), response, prompt_tokens, completion_tokens
+    
+    @abstractmethod
+    def extract_answer(self, response: str) -> float:
+        """
+        Abstract method that must be implemented by each technique class (unless it overrides `query`).
+        Derives the final float answer from the raw LLM response, e.g. by extracting the last number 
+        or by executing the generated code.
+        """
+        raise NotImplementedError
+    
     @abstractmethod
     def get_chat_introduction(self) -> str:
         """ Returns a customized introduction for the chat session. """
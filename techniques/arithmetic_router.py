@@ -0,0 +1,106 @@
+"""
+Router in front of every technique that answers pure arithmetic questions locally instead of sending them to the LLM.
+
+Many arithmetic questions are bare expressions like `88254×26228=` or `Calculate -4450 divided by 178.`. The LLM
+pays tokens for them and gets large multiplications wrong, whereas they are exact to evaluate. `route_question`
+recognizes such questions (in English and German) and evaluates them with exact rational arithmetic, using the parser
+of the linear solver. All other questions are left to the technique (see `TechniqueInterface.route`).
+"""
+import functools
+import re
+import threading
+
+from .linear_solver import LinearSystemUnsupported, parse_linear
+
+# Phrases in front of an expression, e.g. "What is 5 times -34?" or "Berechnen Sie 1 - (4 - 8 - -8)."
+QUESTION_PREFIX = re.compile(r"^(?:what is|what's|calculate|evaluate|compute|work out|was ist|was ergibt|berechnen sie|berechne|rechne|bewerten sie|bewerte)\s+", re.IGNORECASE)
+QUESTION_SUFFIX = re.compile(r"[\s=?.]+$")
+WORD_OPERATORS = [
+    (re.compile(r"\s+(?:divided by|geteilt durch)\s+", re.IGNORECASE), " / "),
+    (re.compile(r"\s+(?:times|multiplied by|mal)\s+", re.IGNORECASE), " * "),
+    (re.compile(r"\s+plus\s+", re.IGNORECASE), " + "),
+    (re.compile(r"\s+minus\s+", re.IGNORECASE), " - "),
+]
+SYMBOL_OPERATORS = str.maketrans({"×": "*", "·": "*", "⋅": "*", "÷": "/", "−": "-"})
+# A number with decimal commas or thousands separators, e.g. "0,5" or "1,000,000"
+SEPARATED_NUMBER = re.compile(r"\d+(?:[.,]\d+)+")
+THOUSANDS_GROUPS = re.compile(r"\d{1,3}(?:,\d{3}){2,}")
+# A German thousands separator, e.g. "1.500" (1500), which reads as a decimal point in English
+DOT_GROUPS = re.compile(r"[1-9]\d{0,2}(?:\.\d{3})+")
+EXPRESSION = re.compile(r"[\d\s.+\-*/()^]*\d[\d\s.+\-*/()^]*")
+
+_router_statistics = {}
+_router_statistics_lock = threading.Lock()
+
+
+class AmbiguousNumber(Exception):
+    """ Raised for a number whose separator may be a decimal separator or a thousands separator, e.g. "1,500" or "1.500". """
+
+
+def _normalize_number(match: re.Match) -> str:
+    number = match.group(0)
+    if "," not in number:
+        if DOT_GROUPS.fullmatch(number):
+            raise AmbiguousNumber()
+        return number
+    if THOUSANDS_GROUPS.fullmatch(number):
+        return number.replace(",", "")
+    if number.count(",") == 1 and "." not in number and len(number.split(",")[1]) != 3:
+        return number.replace(",", ".")     # German decimal comma
+    raise AmbiguousNumber()
+
+
+def normalize_expression(question: str) -> str:
+    """
+    Returns the arithmetic expression of a question in Python syntax (with `^` for powers), or None if the question is
+    not a pure arithmetic expression. Multiplication and division signs (×, ÷), the unicode minus, the operator words
+    "divided by", "times", "plus" and "minus" (and their German counterparts) and German decimal commas are supported.
+    Numbers whose separator is ambiguous between English and German, like "1,500" or "1.500", are not routed.
+    """
+    expression = QUESTION_SUFFIX.sub("", question.strip())
+    expression = QUESTION_PREFIX.sub("", expression)
+    for pattern, operator in WORD_OPERATORS:
+        expression = pattern.sub(operator, expression)
+    expression = expression.translate(SYMBOL_OPERATORS)
+    try:
+        expression = SEPARATED_NUMBER.sub(_normalize_number, expression)
+    except AmbiguousNumber:
+        return None
+    if not EXPRESSION.fullmatch(expression):
+        return None
+    return expression.strip()
+
+
+@functools.lru_cache(maxsize=4096)
+def route_question(question: str):
+    """
+    Answers a pure arithmetic question exactly.
+
+    Returns:
+        tuple[float, str]: The answer and the evaluated expression, or None if the question has to be answered by the LLM.
+    """
+    expression = normalize_expression(question)
+    if expression is None:
+        return None
+    try:
+        _, value = parse_linear(expression, {})     # The expression has no variables
+        return float(value), expression
+    except (LinearSystemUnsupported, OverflowError):
+        return None
+
+
+def record_router_result(subcategory: str, row: dict):
+    """ Counts a result row of `run.py` (see `TechniqueInterface.route`) towards the statistics of its subcategory. """
+    with _router_statistics_lock:
+        stats = _router_statistics.setdefault(subcategory, {"questions": 0, "routed": 0, "router_seconds": 0.0, "tokens_saved": 0})
+        stats["questions"] += 1
+        stats["router_seconds"] += row.get("router_latency_in_seconds") or 0.0
+        if row.get("routed"):
+            stats["routed"] += 1
+            stats["tokens_saved"] += row.get("router_tokens_saved") or 0
+
+
+def router_statistics() -> dict:
+    """ Returns per subcategory how many questions were seen and routed, the time spent in the router and the estimated tokens saved. """
+    with _router_statistics_lock:
+        return {subcategory: dict(stats) for subcategory, stats in _router_statistics.items()}
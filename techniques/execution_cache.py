@@ -0,0 +1,128 @@
+"""
+Cache of the results of executed PaL code (see `util.execute_solution_function`).
+
+The same program is executed again and again: when a run is repeated, when ModelSelection runs PaL and when
+questions repeat. Results are keyed by a hash of the executed code with whitespace and comments removed, such that
+these executions are skipped. The cache keeps the most recently used results in memory and can persist them on disk.
+"""
+import hashlib
+import io
+import json
+import os
+import sys
+import threading
+import tokenize
+from collections import OrderedDict
+
+# Changes whenever the way PaL code is executed changes, such that results persisted before are not used anymore
+EXECUTION_CACHE_VERSION = 1
+
+
+def normalize_code(source: str) -> str:
+    """
+    Returns the tokens of `source` without comments and blank lines, one per line. Two programs with the same normalized
+    code behave the same. Code that cannot be tokenized is returned unchanged.
+    """
+    try:
+        tokens = tokenize.generate_tokens(io.StringIO(source).readline)
+        return "\n".join(f"{token.type}:{token.string}" for token in tokens if token.type not in (tokenize.COMMENT, tokenize.NL))
+    except (tokenize.TokenError, SyntaxError):
+        return source
+
+
+def execution_key(*parts: str) -> str:
+    """
+    Returns a stable hash of the parts that determine the result of an execution.
+    The Python version is part of the key, since the same code may behave differently in another version.
+    """
+    payload = json.dumps([EXECUTION_CACHE_VERSION, list(sys.version_info[:2]), *parts], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ExecutionCache:
+    """
+    Least recently used results of executed code, optionally persisted in a SQLite database.
+
+    A result is the answer (a float or None) and the outcome of the execution ("completed", "timeout" or "crashed").
+    Timeouts depend on the load of the machine, hence they are only kept in memory. The cache is thread-safe.
+    """
+    def __init__(self, max_entries: int, path: str = None):
+        """
+        Parameters:
+            max_entries (int): Number of results kept in memory.
+            path (str): Location of the SQLite database, or None to keep the results in memory only.
+        """
+        self.max_entries = max_entries
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._connection = None
+        if path:
+            import sqlite3
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._connection = sqlite3.connect(path, check_same_thread=False)
+            self._connection.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, answer TEXT, outcome TEXT)")
+            self._connection.commit()
+
+    def _remember(self, key: str, result: tuple):
+        self._entries[key] = result
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, key: str):
+        """ Returns the cached (answer, outcome) tuple, or None on a miss. """
+        with self._lock:
+            result = self._entries.get(key)
+            if result is None and self._connection is not None:
+                row = self._connection.execute("SELECT answer, outcome FROM results WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    # The answer is stored as text, since SQLite stores a NaN as NULL
+                    result = (float(row[0]) if row[0] is not None else None, row[1])
+            if result is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._remember(key, result)
+            return result
+
+    def put(self, key: str, answer, outcome: str):
+        """ Stores the result of an execution. """
+        with self._lock:
+            self._remember(key, (answer, outcome))
+            if self._connection is not None and outcome != "timeout":
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO results VALUES (?, ?, ?)", (key, repr(answer) if answer is not None else None, outcome))
+                self._connection.commit()
+
+    def stats(self) -> dict:
+        """ Returns the hit/miss counters and the number of results in memory. """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+
+_execution_cache = None
+_execution_cache_lock = threading.Lock()
+
+def get_execution_cache():
+    """
+    Returns the process-wide execution cache, or None if it is disabled. It is configured with the environment variables
+    `PAL_EXECUTION_CACHE_SIZE` (results kept in memory, default: 10000; 0 disables the cache) and
+    `PAL_EXECUTION_CACHE_PATH` (SQLite database the results are persisted in, default: not persisted).
+    """
+    global _execution_cache
+    with _execution_cache_lock:
+        if _execution_cache is None:
+            max_entries = int(os.getenv("PAL_EXECUTION_CACHE_SIZE", "10000"))
+            if max_entries <= 0:
+                return None
+            _execution_cache = ExecutionCache(max_entries, os.getenv("PAL_EXECUTION_CACHE_PATH") or None)
+        return _execution_cache
+
+def execution_cache_statistics() -> dict:
+    """ Returns the statistics of the execution cache, or an empty dict if it was not used. """
+    with _execution_cache_lock:
+        return _execution_cache.stats() if _execution_cache is not None else {}
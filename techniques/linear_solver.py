@@ -0,0 +1,220 @@
+"""
+Fast path of `DeclarativeSymPy.get_final_using_sympy` for linear equation systems.
+
+Almost all systems written in the Peano format are chains of definitions (`d = b * c`, `e = a - d`) or small linear
+systems. These are solved here with exact rational Gaussian elimination, whereas SymPy is only needed for the
+remaining systems. Variables whose values are already determined are substituted into later equations, such that
+definitions like `A = pi * r^2` are linear once `r` is known.
+
+The fast path reproduces how `get_final_using_sympy` solves a system: the equations are added one by one and the
+answer is the value of the goal as soon as it is determined. Systems it cannot decide exactly raise `LinearSystemUnsupported`.
+"""
+import ast
+import functools
+import math
+import re
+import threading
+from fractions import Fraction
+
+# Names SymPy parses as single symbols: a letter (except the SymPy constants and functions E, I, N, O, Q and S)
+# or a letter followed by an underscore and a suffix. Other names are split into products by `parse_expr`.
+VARIABLE_NAME = re.compile(r"[A-DF-HJ-MPRT-Za-z]|[A-Za-z]_[A-Za-z0-9_]*")
+MAX_EXACT_EXPONENT = 64
+
+_solver_statistics = {"linear": 0, "sympy": 0, "linear_seconds": 0.0, "sympy_seconds": 0.0, "sympy_timeouts": 0}
+_solver_statistics_lock = threading.Lock()
+
+
+class LinearSystemUnsupported(Exception):
+    """ Raised if a system is not linear (given the values known so far) or cannot be decided exactly. """
+
+
+def _linear_combination(left: tuple, right: tuple, factor) -> tuple:
+    """ Returns left + factor * right of two linear forms (coefficients, constant). """
+    coefficients = dict(left[0])
+    for name, coefficient in right[0].items():
+        coefficient = coefficients.get(name, 0) + factor * coefficient
+        if coefficient == 0:
+            coefficients.pop(name, None)
+        else:
+            coefficients[name] = coefficient
+    return coefficients, left[1] + factor * right[1]
+
+
+def _scale(form: tuple, factor) -> tuple:
+    if factor == 0:
+        return {}, 0 * form[1]
+    return {name: factor * coefficient for name, coefficient in form[0].items()}, factor * form[1]
+
+
+def _constant(form: tuple):
+    if form[0]:
+        raise LinearSystemUnsupported()     # Product, quotient or power of unknowns
+    return form[1]
+
+
+def _power(base, exponent):
+    if isinstance(base, Fraction) and isinstance(exponent, Fraction) and exponent.denominator == 1 and abs(exponent) <= MAX_EXACT_EXPONENT:
+        if base == 0 and exponent < 0:
+            raise LinearSystemUnsupported()
+        return base ** int(exponent)
+    if base < 0 and not float(exponent).is_integer():
+        raise LinearSystemUnsupported()     # Complex result
+    return float(base) ** float(exponent)
+
+
+def _linear_form(node, values: dict) -> tuple:
+    """ Returns the linear form (coefficients of the unknowns, constant) of an expression, substituting the known `values`. """
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        return {}, Fraction(repr(node.value))
+    if isinstance(node, ast.Name):
+        if node.id == "pi":
+            return {}, math.pi
+        if not VARIABLE_NAME.fullmatch(node.id):
+            raise LinearSystemUnsupported()
+        if node.id in values:
+            return {}, values[node.id]
+        return {node.id: Fraction(1)}, Fraction(0)
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.UAdd, ast.USub)):
+        operand = _linear_form(node.operand, values)
+        return operand if isinstance(node.op, ast.UAdd) else _scale(operand, -1)
+    if isinstance(node, ast.BinOp):
+        left, right = _linear_form(node.left, values), _linear_form(node.right, values)
+        if isinstance(node.op, (ast.Add, ast.Sub)):
+            return _linear_combination(left, right, 1 if isinstance(node.op, ast.Add) else -1)
+        if isinstance(node.op, ast.Mult):
+            return _scale(right, _constant(left)) if not left[0] else _scale(left, _constant(right))
+        if isinstance(node.op, ast.Div):
+            divisor = _constant(right)
+            if divisor == 0:
+                raise LinearSystemUnsupported()
+            return _scale(left, 1 / divisor if isinstance(divisor, float) else 1 / Fraction(divisor))
+        if isinstance(node.op, ast.Pow):
+            return {}, _power(_constant(left), _constant(right))
+        if isinstance(node.op, (ast.FloorDiv, ast.Mod)):
+            # SymPy's floor(a / b) and Mod(a, b) are only reproduced exactly for rational numbers
+            dividend, divisor = _constant(left), _constant(right)
+            if not isinstance(dividend, Fraction) or not isinstance(divisor, Fraction) or divisor == 0:
+                raise LinearSystemUnsupported()
+            return {}, Fraction(dividend // divisor) if isinstance(node.op, ast.FloorDiv) else dividend % divisor
+    raise LinearSystemUnsupported()
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_expression(expression: str) -> ast.AST:
+    return ast.parse(expression.strip().replace('^', '**'), mode="eval").body
+
+
+def parse_linear(expression: str, values: dict) -> tuple:
+    """
+    Parses an expression in SymPy syntax (with `^` for powers) into a linear form, see `_linear_form`.
+
+    Raises:
+        LinearSystemUnsupported: If the expression is not linear in the unknowns or uses anything but numbers, variables,
+        `pi` and arithmetic operators, e.g. functions or implicit multiplication.
+    """
+    try:
+        tree = _parse_expression(expression)
+    except (SyntaxError, ValueError):
+        raise LinearSystemUnsupported()
+    try:
+        coefficients, constant = _linear_form(tree, values)
+    except (ArithmeticError, ValueError, TypeError):
+        raise LinearSystemUnsupported()
+    if any(not isinstance(coefficient, Fraction) for coefficient in coefficients.values()):
+        raise LinearSystemUnsupported()     # Elimination with inexact coefficients cannot decide which variables are determined
+    if isinstance(constant, float) and not math.isfinite(constant):
+        raise LinearSystemUnsupported()
+    return coefficients, constant
+
+
+class LinearSystem:
+    """
+    Linear equations (`form == 0`) in reduced row echelon form, to which equations are added one by one.
+    A variable is determined if its row has no other unknowns, its value is then in `values`.
+    """
+    def __init__(self):
+        self.rows = {}          # Pivot variable -> linear form with coefficient 1 for the pivot
+        self.values = {}
+        self.inconsistent = False
+
+    def add(self, form: tuple):
+        for pivot, row in self.rows.items():
+            if pivot in form[0]:
+                form = _linear_combination(form, row, -form[0][pivot])
+        if not form[0]:
+            if isinstance(form[1], float):
+                raise LinearSystemUnsupported()     # Cannot decide whether 0 = constant holds
+            self.inconsistent = self.inconsistent or form[1] != 0
+            return
+        pivot = next(iter(form[0]))
+        form = _scale(form, 1 / form[0][pivot])
+        for other, row in self.rows.items():
+            if pivot in row[0]:
+                self.rows[other] = _linear_combination(row, form, -row[0][pivot])
+        self.rows[pivot] = form
+        self.values = {name: -row[1] for name, row in self.rows.items() if len(row[0]) == 1}
+
+
+def _to_float(value) -> float:
+    try:
+        return float(value)
+    except OverflowError:
+        raise LinearSystemUnsupported()
+
+
+def solve_linear_system(equation_list: list, goal_var: str, goal_source: str):
+    """
+    Solves the equations of `get_final_using_sympy` if they are linear, with the same result.
+
+    Parameters:
+        equation_list (list[str]): The equations, the last one is the goal (e.g. "c = ?").
+        goal_var (str): The variable of the goal, see `DeclarativeSymPy.find_goal`.
+        goal_source (str): The equation defining the goal if the goal is an expression, or None.
+
+    Returns:
+        float or None: The value of the goal, or None if it is not determined or the system is inconsistent.
+
+    Raises:
+        LinearSystemUnsupported: If the system has to be solved by SymPy.
+    """
+    system = LinearSystem()
+    if goal_source is not None:
+        form = parse_linear(goal_source, system.values)
+        if list(form[0]) == [goal_var]:
+            return _to_float(-form[1])
+        system.add(form)
+    if len(equation_list) == 1:
+        form = parse_linear(equation_list[0].split('=')[0], {})
+        return _to_float(form[1]) if not form[0] else None
+    if goal_var is None:
+        return None
+    if not VARIABLE_NAME.fullmatch(goal_var):
+        raise LinearSystemUnsupported()
+    for equation in equation_list[:-1]:
+        if '?' in equation:
+            continue
+        sides = equation.split('=')
+        if len(sides) < 2:
+            return None
+        system.add(parse_linear(sides[0].strip() + ' - (' + sides[1].strip() + ')', system.values))
+        if system.inconsistent:
+            return None
+        if goal_var in system.values:
+            return _to_float(system.values[goal_var])
+    return None
+
+
+def record_solver_stage(stage: str, seconds: float, outcome: str = "completed"):
+    """ Counts a system solved by the `stage` "linear" or "sympy", which took `seconds` and ended with `outcome` (see `Sandbox.run`). """
+    with _solver_statistics_lock:
+        _solver_statistics[stage] += 1
+        _solver_statistics[stage + "_seconds"] += seconds
+        if outcome == "timeout":
+            _solver_statistics[stage + "_timeouts"] += 1
+
+
+def solver_statistics() -> dict:
+    """ Returns how many equation systems were solved by the linear fast path and by SymPy, the time spent in each and the SymPy timeouts. """
+    with _solver_statistics_lock:
+        return dict(_solver_statistics)
@@ -0,0 +1,21 @@
+"""
+Registry of the available techniques. A technique module is only imported when the technique is first used.
+
+To add a new technique, register its class here (see README.md).
+"""
+from llm_inference.registry import LazyRegistry
+
+techniques = LazyRegistry("technique")
+techniques.register("Baseline", "techniques.Baseline:Baseline")
+techniques.register("PaL", "techniques.PaL:PaL")
+techniques.register("CoT", "techniques.CoT:CoT")
+techniques.register("RolePlaying", "techniques.RolePlaying:RolePlaying")
+techniques.register("DeclarativeSymPy", "techniques.DeclarativeSymPy:DeclarativeSymPy")
+techniques.register("ModelSelection", "techniques.ModelSelection:ModelSelection")
+techniques.register("Cascade", "techniques.Cascade:Cascade")
+techniques.register("SelfConsistency", "techniques.SelfConsistency:SelfConsistency")
+
+
+def get_technique(name: str):
+    """ Returns the class of the technique registered as `name`. Raises a ValueError if it is unknown. """
+    return techniques.get(name)
@@ -0,0 +1,270 @@
+"""
+Process pools that execute model-written code (see `PaL.py`) and solve model-written equations with SymPy
+(see `DeclarativeSymPy.py`), such that a runaway task can be killed and concurrent tasks do not share `sys.stdout`.
+
+Each worker process runs one task at a time under CPU time and memory limits, and captures everything the
+task prints. If a task does not finish within the wall-clock timeout, its worker is killed and replaced.
+Workers are also replaced after a number of tasks, such that state leaked by a task does not accumulate.
+
+The workers are started with the forkserver start method (spawn where it is not available). Both import the main
+module of the evaluation process again (as `__mp_main__`): the fork server when it starts, and every worker, also the
+ones that replace killed or recycled workers. A script that uses a sandbox therefore needs an
+`if __name__ == "__main__":` guard around what it runs (like `run.py`), otherwise every new worker runs the script
+again, and its top level should be cheap to import.
+"""
+import atexit
+import contextlib
+import io
+import multiprocessing
+import os
+import queue
+import threading
+
+try:
+    import resource     # Not available on Windows, the limits are not enforced there
+except ImportError:
+    resource = None
+
+
+def _limit_memory(memory_mb: int):
+    """ Limits the address space of the worker to its current size plus `memory_mb`. """
+    if resource is None or not os.path.exists("/proc/self/statm"):
+        return
+    with open("/proc/self/statm") as statm:
+        current_bytes = int(statm.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    limit = current_bytes + memory_mb * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _limit_cpu_time(cpu_seconds: int):
+    """ Lets the worker use `cpu_seconds` more CPU time, the kernel kills it (SIGXCPU) once it exceeds them. """
+    if resource is None:
+        return
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    used = int(usage.ru_utime + usage.ru_stime)
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    resource.setrlimit(resource.RLIMIT_CPU, (used + cpu_seconds + 1, hard))
+
+
+def _worker_main(connection, function, initializer, cpu_seconds: int, memory_mb: int):
+    """ Calls `function` with the arguments received on `connection` and sends back (answer, captured stdout). """
+    if initializer is not None:
+        initializer()
+    _limit_memory(memory_mb)
+    connection.send(None)   # Ready
+    while True:
+        try:
+            arguments = connection.recv()
+        except EOFError:
+            return
+        _limit_cpu_time(cpu_seconds)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            try:
+                answer = function(*arguments)
+            except BaseException:   # E.g. a MemoryError or a snippet calling exit()
+                answer = None
+        connection.send((answer, output.getvalue()))
+
+
+class _Worker:
+    def __init__(self, context, function, initializer, cpu_seconds: int, memory_mb: int):
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_connection, function, initializer, cpu_seconds, memory_mb), daemon=True)
+        self.process.start()
+        child_connection.close()
+        self.ready = False
+        self.tasks = 0
+
+    def wait_until_ready(self, timeout: float) -> bool:
+        """ Waits until the worker has started (e.g. imported SymPy), such that the startup does not count towards the timeout of a task. """
+        if not self.ready and self.connection.poll(timeout):
+            self.connection.recv()
+            self.ready = True
+        return self.ready
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+
+class Sandbox:
+    """
+    Pool of worker processes that run tasks (e.g. PaL snippets), see the module docstring.
+    
+    The workers are started up front, such that a task does not pay for starting a process.
+    `run` may be called from several threads at the same time, each call occupies one worker.
+    """
+    # Time a worker may take to start, e.g. to import SymPy on a busy machine
+    STARTUP_TIMEOUT = 60
+
+    def __init__(self, function, initializer=None, workers: int = 4, timeout: float = 3.0, cpu_seconds: int = 3, memory_mb: int = 512, max_tasks_per_worker: int = 100):
+        """
+        Parameters:
+            function: Module-level function that runs a task in a worker, it is called with the arguments of `run`.
+            initializer: Module-level function that is called once when a worker starts, e.g. to import slow modules.
+            workers (int): Number of worker processes.
+            timeout (float): Wall-clock time (in seconds) after which a task is killed.
+            cpu_seconds (int): CPU time limit of a task.
+            memory_mb (int): Memory limit of a worker, in addition to its memory after the initializer.
+            max_tasks_per_worker (int): Number of tasks after which a worker is replaced.
+        """
+        # forkserver forks the workers from a server process instead of copying the (large) evaluation process, but the
+        # server and each worker import the main module again, see the module docstring
+        start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        self.context = multiprocessing.get_context(start_method)
+        self.function = function
+        self.initializer = initializer
+        self.timeout = timeout
+        self.cpu_seconds = cpu_seconds
+        self.memory_mb = memory_mb
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self.timeouts = 0
+        self.crashes = 0
+        self.recycled = 0
+        self._idle = queue.Queue()
+        self._workers = set()
+        self._lock = threading.Lock()
+        for _ in range(workers):
+            self._idle.put(self._start_worker())
+
+    def _start_worker(self) -> _Worker:
+        worker = _Worker(self.context, self.function, self.initializer, self.cpu_seconds, self.memory_mb)
+        with self._lock:
+            self._workers.add(worker)
+        return worker
+
+    def _discard(self, worker: _Worker):
+        worker.kill()
+        with self._lock:
+            self._workers.discard(worker)
+
+    def _replace(self, worker: _Worker, alive: bool = False) -> _Worker:
+        """
+        Starts a new worker instead of `worker`. If the new worker cannot be started, a worker that is `alive`
+        (e.g. one that is recycled) is kept, otherwise the pool shrinks by one worker and the error is raised.
+        """
+        try:
+            replacement = self._start_worker()
+        except Exception:
+            if alive:
+                print("Could not start a sandbox worker, the worker is kept instead of being recycled.")
+                worker.tasks = 0    # Tries to recycle it again after another `max_tasks_per_worker` tasks
+                return worker
+            self._discard(worker)
+            with self._lock:
+                remaining = len(self._workers)
+            print(f"Could not replace a sandbox worker, {remaining} workers are left.")
+            raise
+        self._discard(worker)
+        return replacement
+
+    def _acquire(self) -> _Worker:
+        """ Waits for an idle worker. Raises a RuntimeError if the pool has no workers left (see `_replace`). """
+        while True:
+            try:
+                return self._idle.get(timeout=1.0)
+            except queue.Empty:
+                with self._lock:
+                    if not self._workers:
+                        raise RuntimeError("The sandbox has no workers left.")
+
+    def _release(self, worker: _Worker, healthy: bool):
+        """ Returns a worker to the pool. Only a worker that is known to be alive is put back, all others are replaced. """
+        if healthy and worker.tasks < self.max_tasks_per_worker:
+            self._idle.put(worker)
+            return
+        replacement = self._replace(worker, alive=healthy)
+        if healthy and replacement is not worker:
+            with self._lock:
+                self.recycled += 1
+        self._idle.put(replacement)
+
+    def run(self, *arguments) -> tuple:
+        """
+        Runs a task in a worker, e.g. executes a PaL response (see `util.run_solution_code`).
+        
+        Returns:
+            tuple[float, str, str]: The answer (None if the task failed, timed out or exceeded a limit), the captured output
+            and the outcome: "completed" (including tasks that failed with an exception), "timeout" or "crashed" (the worker
+            was killed, e.g. by the CPU time or memory limit).
+        
+        Raises:
+            Exception: If the worker died and no new worker could be started, or RuntimeError if the pool has no workers left.
+        """
+        worker = self._acquire()
+        healthy = False
+        try:
+            if not worker.wait_until_ready(self.STARTUP_TIMEOUT):
+                raise EOFError()
+            worker.connection.send(arguments)
+            if worker.connection.poll(self.timeout):
+                answer, output = worker.connection.recv()
+                worker.tasks += 1
+                healthy = True
+                return answer, output, "completed"
+            with self._lock:
+                self.timeouts += 1
+            return None, "", "timeout"
+        except (EOFError, OSError):     # The worker was killed, e.g. by the CPU time limit
+            with self._lock:
+                self.crashes += 1
+            return None, "", "crashed"
+        finally:
+            # Raises if a dead worker cannot be replaced, the pool then shrinks instead of keeping the dead worker
+            self._release(worker, healthy)
+
+    def close(self):
+        """ Stops all workers. """
+        with self._lock:
+            workers, self._workers = self._workers, set()
+        for worker in workers:
+            worker.kill()
+
+
+def _start_sandbox(function, initializer, prefix: str, workers: int, timeout: float, memory_mb: int, max_tasks_per_worker: int) -> Sandbox:
+    """ Starts a sandbox configured with the environment variables `{prefix}_WORKERS`, `{prefix}_TIMEOUT`, ... """
+    sandbox = Sandbox(
+        function,
+        initializer,
+        workers=int(os.getenv(f"{prefix}_WORKERS", str(workers))),
+        timeout=float(os.getenv(f"{prefix}_TIMEOUT", str(timeout))),
+        cpu_seconds=int(os.getenv(f"{prefix}_CPU_SECONDS", str(int(timeout)))),
+        memory_mb=int(os.getenv(f"{prefix}_MEMORY_MB", str(memory_mb))),
+        max_tasks_per_worker=int(os.getenv(f"{prefix}_MAX_TASKS", str(max_tasks_per_worker))),
+    )
+    atexit.register(sandbox.close)
+    return sandbox
+
+
+_sandbox = None
+_sympy_sandbox = None
+_sandbox_lock = threading.Lock()
+
+def get_sandbox() -> Sandbox:
+    """
+    Returns the process-wide sandbox for PaL code, which is started on first use. It is configured with the environment variables
+    `PAL_SANDBOX_WORKERS` (default: number of CPUs), `PAL_SANDBOX_TIMEOUT` (3 seconds), `PAL_SANDBOX_CPU_SECONDS` (3),
+    `PAL_SANDBOX_MEMORY_MB` (512) and `PAL_SANDBOX_MAX_TASKS` (100 snippets per worker).
+    """
+    global _sandbox
+    with _sandbox_lock:
+        if _sandbox is None:
+            from .util import run_solution_code
+            _sandbox = _start_sandbox(run_solution_code, None, "PAL_SANDBOX", os.cpu_count() or 4, 3, 512, 100)
+        return _sandbox
+
+def get_sympy_sandbox() -> Sandbox:
+    """
+    Returns the process-wide sandbox that solves equations with SymPy (see `DeclarativeSymPy.solve_using_sympy`), which is
+    started on first use. Its workers import SymPy when they start. It is configured with the environment variables
+    `SYMPY_SANDBOX_WORKERS` (default: 4 or the number of CPUs if less), `SYMPY_SANDBOX_TIMEOUT` (10 seconds),
+    `SYMPY_SANDBOX_CPU_SECONDS` (10), `SYMPY_SANDBOX_MEMORY_MB` (1024) and `SYMPY_SANDBOX_MAX_TASKS` (1000 systems per worker).
+    """
+    global _sympy_sandbox
+    with _sandbox_lock:
+        if _sympy_sandbox is None:
+            from .DeclarativeSymPy import solve_using_sympy, warm_up_sympy
+            _sympy_sandbox = _start_sandbox(solve_using_sympy, warm_up_sympy, "SYMPY_SANDBOX", min(4, os.cpu_count() or 4), 10, 1024, 1000)
+        return _sympy_sandbox
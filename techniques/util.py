@@ -1,29 +1,51 @@
-from typing import List
-from openai.types.chat import ChatCompletionMessageParam
+from typing import List, TYPE_CHECKING
 
+import ast
+import builtins
+import functools
+import io
+import math
+import operator
 import re
-import func_timeout
 import sys
-import io
+import threading
+
+from llm_inference.request_stats import set_request_stat
+from llm_inference.tokens import estimate_prompt_tokens
+from .execution_cache import execution_key, get_execution_cache, normalize_code
+
+if TYPE_CHECKING:   # openai is only needed for the type hints, importing it is slow
+    from openai.types.chat import ChatCompletionMessageParam
 
 
-def create_prompt_gpt35(few_shot_prompting: bool, system_prompt: str, introduction: str, question_prelude: str, question: str, few_shot_examples: List[str], few_shot_answers: List[str]) -> ChatCompletionMessageParam:
+class PromptPrefix:
     """
-    This function creates the prompt for the GPT-3.5 and GPT-4 model. It adds the system prompt, 
-    the introduction, the question prelude, the question and the few shot examples and answers to the conversation.
+    The part of a conversation that is the same for every question of a (technique, dataset, shot mode), compiled once.
+    
+    The messages are shared by all conversations built from the prefix and must not be modified. Keeping the prefix
+    byte-identical across requests also lets the provider reuse its prompt cache.
+    """
+    def __init__(self, messages: list, question_prelude: str):
+        """
+        Args:
+            messages (list): The messages before the question.
+            question_prelude (str): The text that precedes the question in the final user message.
+        """
+        self.messages = tuple(messages)
+        self.question_prelude = question_prelude
+        self.prompt_tokens = estimate_prompt_tokens(self.messages)
+
+    def build(self, question: str) -> list:
+        """ Returns the conversation for `question`, i.e. the prefix followed by the final user message. """
+        return [*self.messages, {"role": "user", "content": self.question_prelude + question}]
 
-    Args:
-        few_shot_prompting (bool): If True, the few shot examples and answers are added to the conversation.
-        system_prompt (str): The system prompt that is added once at the beginning of the conversation
-        introduction (str): The introduction, i.e. how to solve it
-        question_prelude (str): Introduces the question, e.g. "Question: " or "Answer the following question in Python: "
-        question (str): The question that has to be answered
-        few_shot_examples (List[str]): List of few shot examples
-        few_shot_answers (List[str]): List of answers corresponding to the few shot examples
 
+def compile_prompt_prefix_gpt35(few_shot_prompting: bool, system_prompt: str, introduction: str, question_prelude: str, few_shot_examples: List[str], few_shot_answers: List[str]) -> PromptPrefix:
+    """
+    Compiles the part of the GPT-3.5 and GPT-4 prompt that precedes the question (see `create_prompt_gpt35`).
+    
     Returns:
-        ChatCompletionMessageParam: Prompt for the GPT-3.5 and GPT-4 model
-        NOTE: For other models, you (may) have to build the prompts differently
+        PromptPrefix: The compiled prefix, `build(question)` returns the complete prompt.
     """
     if few_shot_prompting:
         assert len(few_shot_examples) == len(few_shot_answers), "Few shot examples and answers should be of the same length"
@@ -36,90 +58,298 @@ def create_prompt_gpt35(few_shot_prompting: bool, system_prompt: str, introducti
         for i in range(1, len(few_shot_examples)):        
             messages.append({"role": "user", "content": question_prelude + " " + few_shot_examples[i]})
             messages.append({"role": "assistant", "content": few_shot_answers[i]})
-        # Prepare the final question that has to be answeted
-        messages.append({"role": "user", "content": question_prelude + question})
+        # The final question that has to be answered is appended by `build`
+        return PromptPrefix(messages, question_prelude)
     else:
-        messages = []
-        # Add system prompt
-        messages.append({"role": "system", "content": system_prompt})
-        # Add introduction as user prompt and Prepare the final question that has to be answeted
-        messages.append({"role": "user", "content": introduction + "\n" + question_prelude + question})
-    return messages
+        # Add system prompt, the introduction is part of the user prompt with the final question
+        return PromptPrefix([{"role": "system", "content": system_prompt}], introduction + "\n" + question_prelude)
+
+
+def create_prompt_gpt35(few_shot_prompting: bool, system_prompt: str, introduction: str, question_prelude: str, question: str, few_shot_examples: List[str], few_shot_answers: List[str]) -> "ChatCompletionMessageParam":
+    """
+    This function creates the prompt for the GPT-3.5 and GPT-4 model. It adds the system prompt, 
+    the introduction, the question prelude, the question and the few shot examples and answers to the conversation.
+    Techniques build their prompts from a `PromptPrefix` that is compiled once instead (see `TechniqueInterface.get_prompt_prefix`).
+
+    Args:
+        few_shot_prompting (bool): If True, the few shot examples and answers are added to the conversation.
+        system_prompt (str): The system prompt that is added once at the beginning of the conversation
+        introduction (str): The introduction, i.e. how to solve it
+        question_prelude (str): Introduces the question, e.g. "Question: " or "Answer the following question in Python: "
+        question (str): The question that has to be answered
+        few_shot_examples (List[str]): List of few shot examples
+        few_shot_answers (List[str]): List of answers corresponding to the few shot examples
+
+    Returns:
+        ChatCompletionMessageParam: Prompt for the GPT-3.5 and GPT-4 model
+        NOTE: For other models, you (may) have to build the prompts differently
+    """
+    prefix = compile_prompt_prefix_gpt35(few_shot_prompting, system_prompt, introduction, question_prelude, few_shot_examples, few_shot_answers)
+    return prefix.build(question)
 
 
 
-# Code is taken from here: https://github.com/XuZhao0/Model-Selection-Reasoning/blob/main/src/tool.py
-# However, quite is modified to fit the needs of this project
+# ======== FAST PATH FOR PAL CODE ================
+# Most PaL responses are straight-line arithmetic: assignments of numeric expressions, `math` functions and a return.
+# These are evaluated directly on the AST, which is much faster than running them in the sandbox.
+
+class FastPathUnsupported(Exception):
+    """ Raised if a snippet uses anything outside the subset of the fast path. """
+
+
+FAST_PATH_BINARY_OPERATORS = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv, ast.Mod: operator.mod, ast.Pow: operator.pow,
+}
+FAST_PATH_UNARY_OPERATORS = {ast.UAdd: operator.pos, ast.USub: operator.neg}
+FAST_PATH_BUILTINS = {"abs": abs, "round": round, "min": min, "max": max, "int": int, "float": float}
+FAST_PATH_MATH_FUNCTIONS = {
+    "sqrt", "pow", "exp", "log", "log10", "log2", "sin", "cos", "tan", "asin", "acos", "atan", "atan2", "radians", "degrees",
+    "floor", "ceil", "fabs", "factorial", "gcd", "hypot", "comb", "perm", "isqrt", "trunc",
+}
+FAST_PATH_MATH_CONSTANTS = {"pi", "e", "tau"}
+FAST_PATH_MAX_BITS = 4096   # Larger integers (e.g. 10**10**10) are left to the sandbox, which can kill the computation
+
+_fast_path_statistics = {"hits": 0, "misses": 0}
+_fast_path_statistics_lock = threading.Lock()   # Updated by the threads of ModelSelection and Cascade
+
+
+def _fast_path_value(node, variables: dict):
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        return node.value
+    if isinstance(node, ast.Name) and node.id in variables:
+        return variables[node.id]
+    if isinstance(node, ast.BinOp) and type(node.op) in FAST_PATH_BINARY_OPERATORS:
+        left, right = _fast_path_value(node.left, variables), _fast_path_value(node.right, variables)
+        if isinstance(node.op, ast.Pow) and isinstance(left, int) and isinstance(right, int) and abs(right) * max(left.bit_length(), 1) > FAST_PATH_MAX_BITS:
+            raise FastPathUnsupported()
+        result = FAST_PATH_BINARY_OPERATORS[type(node.op)](left, right)
+        if isinstance(result, int) and result.bit_length() > FAST_PATH_MAX_BITS:
+            raise FastPathUnsupported()
+        return result
+    if isinstance(node, ast.UnaryOp) and type(node.op) in FAST_PATH_UNARY_OPERATORS:
+        return FAST_PATH_UNARY_OPERATORS[type(node.op)](_fast_path_value(node.operand, variables))
+    if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == "math" and variables.get("math") is math:
+        if node.attr in FAST_PATH_MATH_CONSTANTS:
+            return getattr(math, node.attr)
+    if isinstance(node, ast.Call) and not node.keywords:
+        function = None
+        if isinstance(node.func, ast.Name) and node.func.id in FAST_PATH_BUILTINS and node.func.id not in variables:
+            function = FAST_PATH_BUILTINS[node.func.id]
+        elif (isinstance(node.func, ast.Attribute) and isinstance(node.func.value, ast.Name) and node.func.value.id == "math"
+                and variables.get("math") is math and node.func.attr in FAST_PATH_MATH_FUNCTIONS):
+            function = getattr(math, node.func.attr)
+        if function is not None:
+            arguments = [_fast_path_value(argument, variables) for argument in node.args]
+            if function in (math.factorial, math.comb, math.perm) and any(abs(argument) > 1000 for argument in arguments):
+                raise FastPathUnsupported()
+            return function(*arguments)
+    raise FastPathUnsupported()
+
+
+def evaluate_solution_fast(code_string: str):
+    """
+    Evaluates the `solution()` of a PaL response without executing it, if the function only consists of
+    a docstring, imports of `math`, assignments of numeric expressions and a final `return <variable>`.
+    The body is evaluated in order, like `run_solution_code` runs it (without its last line, at the top level, after
+    `import math`), and the answer is the value of the returned variable, which has to be the one named in the last
+    `return` of the response.
+    
+    Returns:
+        The same result as `run_solution_code` (a float or None).
+    
+    Raises:
+        FastPathUnsupported: If the response uses anything outside this subset; it has to be executed instead.
+    """
+    if 'def solution():' not in code_string:
+        raise FastPathUnsupported()
+    try:
+        code, code_return = extract_solution_function(code_string)
+        module = ast.parse(code)
+    except (IndexError, SyntaxError, ValueError):
+        raise FastPathUnsupported()
+    if len(module.body) != 1 or not isinstance(module.body[0], ast.FunctionDef):
+        raise FastPathUnsupported()
+    *body, last = module.body[0].body
+    # `run_solution_code` drops the last line of the function, which has to be the return of the answer.
+    # Names of its own local variables would be overwritten by them, these are left to the executed code.
+    if (not isinstance(last, ast.Return) or not isinstance(last.value, ast.Name) or last.value.id != code_return
+            or last.end_lineno != len(code.split('\n')) or code_return in ('x', 'code_return', 'locals_', 'solution', 'executed_code')):
+        raise FastPathUnsupported()
+    variables = {"math": math}
+    try:
+        for statement in body:
+            if isinstance(statement, ast.Expr) and isinstance(statement.value, ast.Constant) and isinstance(statement.value.value, str):
+                continue    # Docstring
+            elif isinstance(statement, ast.Import) and [(alias.name, alias.asname) for alias in statement.names] == [("math", None)]:
+                continue
+            elif isinstance(statement, ast.Assign) and len(statement.targets) == 1 and isinstance(statement.targets[0], ast.Name):
+                variables[statement.targets[0].id] = _fast_path_value(statement.value, variables)
+            elif isinstance(statement, ast.AugAssign) and isinstance(statement.target, ast.Name) and type(statement.op) in FAST_PATH_BINARY_OPERATORS:
+                binary = ast.BinOp(left=ast.Name(id=statement.target.id, ctx=ast.Load()), op=statement.op, right=statement.value)
+                variables[statement.target.id] = _fast_path_value(binary, variables)
+            else:
+                raise FastPathUnsupported()
+        ans = _fast_path_value(last.value, variables)
+        return float(ans) if ans is not None else None
+    except (ArithmeticError, ValueError, TypeError):
+        return None     # The executed code fails as well
+
+
+def fast_path_statistics() -> dict:
+    """ Returns how many PaL responses were evaluated by the fast path (hits) and how many had to be executed (misses). """
+    with _fast_path_statistics_lock:
+        return dict(_fast_path_statistics)
+
+
 def execute_solution_function(code_string: str):
     """
     Executes Python code that may define and return the result of a function named 'solution'
     or execute standalone code if 'solution' function is not present.
     If there is no function called solution(), this method assumes the result is printed to the console.
-    The function compiles the code in a restricted environment and attempts to call 'solution()'.
+    
+    Simple arithmetic is evaluated directly (see `evaluate_solution_fast`), everything else runs in a worker process
+    of the sandbox (see `sandbox.py`), which kills it after a timeout and limits its CPU time and memory.
+    Results are cached (see `execution_cache.py`), such that the same code is not executed again.
     
     Args:
         code (str): A string of Python code which should contain a function definition called 'solution'.
     
     Returns:
         The return value of the 'solution()' function if it exists, or the result of the evaluated code.
-        Returns None if the function does not exist, if an error occurs during its execution,
+        Returns None if the function does not exist, if an error occurs during its execution, if it times out
         or if the code does not adhere to safety constraints.
     """
+    cache = get_execution_cache()
+    key = solution_execution_key(code_string) if cache is not None else None
+    if key is not None:
+        cached = cache.get(key)
+        set_request_stat("code_cache_hit", cached is not None)
+        if cached is not None:
+            return cached[0]
+    try:
+        answer, outcome = evaluate_solution_fast(code_string), "completed"
+        with _fast_path_statistics_lock:
+            _fast_path_statistics["hits"] += 1
+        set_request_stat("code_fast_path", True)
+    except FastPathUnsupported:
+        with _fast_path_statistics_lock:
+            _fast_path_statistics["misses"] += 1
+        set_request_stat("code_fast_path", False)
+        from .sandbox import get_sandbox
+        answer, _, outcome = get_sandbox().run(code_string)
+    if key is not None:
+        cache.put(key, answer, outcome)
+    return answer
+
+
+def solution_execution_key(code_string: str) -> str:
+    """
+    Returns the key of the result of `run_solution_code` in the execution cache. Two responses have the same key
+    if the same code is executed, apart from whitespace and comments.
+    """
+    if 'def solution():' in code_string:
+        try:
+            function_code, code_return = extract_solution_function(code_string)
+        except IndexError:
+            return execution_key("invalid")
+        return execution_key("solution", normalize_code(function_code), normalize_code(inline_solution_code(function_code)), code_return)
+    return execution_key("script", normalize_code(extract_code_block(code_string)))
+
+
+def extract_solution_function(code_string: str) -> tuple[str, str]:
+    """
+    Finds the code of the last `def solution():` in a PaL response, i.e. the definition and all indented lines after it.
+    
+    Returns:
+        tuple[str, str]: The code of the function and the expression after its last `return`.
+    
+    Raises:
+        IndexError: If the response does not contain a line `def solution():`.
+    """
+    # === find code snippets between def solution(): and return ===
+    code_list = code_string.strip().split('\n')
+
+    new_code_list = []
+    all_codes = []
+    code_return = 'ans'
+
+    for i in range(len(code_list)):
+        if code_list[i].strip() == 'def solution():':
+            new_code_list.append(code_list[i])
+            for j in range(i+1, len(code_list)):
+                if code_list[j].startswith('    '):
+                    new_code_list.append(code_list[j])
+                if 'return ' in code_list[j]:
+                    code_return = code_list[j].split('return ')[1].strip()
+            all_codes.append('\n'.join(new_code_list))
+            new_code_list = []
+    return all_codes[-1], code_return
+
+
+def inline_solution_code(function_code: str) -> str:
+    """ Returns the body of the function found by `extract_solution_function` without its last line (the return), dedented. """
+    return 'import math\n' + 'import datetime\n' + '\n'.join([xx[4:] for xx in function_code.strip().split('\n')[1:-1]])
+
+
+def extract_code_block(code_string: str) -> str:
+    """ Returns the first markdown code block (or triple-quoted block) of a response without a `solution()`, or the whole response. """
+    # Extract code blocks from string using both markdown triple quotes with 'python' and without.
+    triple_quote_blocks = re.findall(r"```(?:python)?(.*?)```", code_string, flags=re.DOTALL)
+    if not triple_quote_blocks:
+        triple_quote_blocks = re.findall(r"'''(?:python)?(.*?)'''", code_string, flags=re.DOTALL)
+    return triple_quote_blocks[0] if triple_quote_blocks else code_string
+
+
+@functools.lru_cache(maxsize=256)
+def compile_code(source: str):
+    """ Compiles code for `run_solution_code`, such that a sandbox worker compiles a snippet it executes again only once. """
+    return compile(source, "<string>", "exec")
+
+
+def snippet_globals() -> dict:
+    """
+    Returns a fresh global namespace for executing a snippet of `run_solution_code`. It only holds the names the code
+    was executed with originally (the module globals `re`, `sys`, `io` and `List`), not the modules imported here
+    since, such that e.g. a helper function using `math` fails like it did when the recorded results were made. The
+    top-level names of a snippet go to a separate local namespace, hence its functions do not see them either (e.g. a
+    top-level `import math`).
+    """
+    return {"__builtins__": builtins, "__name__": __name__, "List": List, "re": re, "sys": sys, "io": io}
+
+
+# Code is taken from here: https://github.com/XuZhao0/Model-Selection-Reasoning/blob/main/src/tool.py
+# However, quite is modified to fit the needs of this project
+def run_solution_code(code_string: str):
+    """
+    Executes the code of `execute_solution_function` in the current process, without any time limit.
+    Only call it in a sandbox worker (see `sandbox.py`), which captures the output and enforces the limits.
+    """
     def execute(x, code_return):
         try:
-            exec(x)
-            locals_ = locals()
-            solution = locals_.get('solution', None)
-            if solution is not None:
-                return solution()
-            else:
-                executed_code = 'import math\n' + 'import datetime\n' + \
-                    '\n'.join([xx[4:]
-                                for xx in x.strip().split('\n')[1:-1]])
-                exec(executed_code)
-                locals_ = locals()
-                return locals_.get(code_return, None)
+            # The original executor looked `solution` up in `locals()` after `exec(x)`, which never found it, since
+            # `solution` is also a local variable of `execute`. Hence it always ran the inlined body instead.
+            exec(compile_code(x), snippet_globals(), {})
+            locals_ = {}
+            exec(compile_code(inline_solution_code(x)), snippet_globals(), locals_)
+            return locals_.get(code_return, None)
 
         except Exception as exp:
-            print('Executing code error', exp)
+            print('Executing code error', exp, file=sys.stderr)
             return None
 
-    # === find code snippets between def solution(): and return ===
     try:
         if 'def solution():' in code_string:
-            code_list = code_string.strip().split('\n')
-
-            new_code_list = []
-            all_codes = []
-            code_return = 'ans'
-
-            for i in range(len(code_list)):
-                if code_list[i].strip() == 'def solution():':
-                    new_code_list.append(code_list[i])
-                    for j in range(i+1, len(code_list)):
-                        if code_list[j].startswith('    '):
-                            new_code_list.append(code_list[j])
-                        if 'return ' in code_list[j]:
-                            code_return = code_list[j].split('return ')[1].strip()
-                    all_codes.append('\n'.join(new_code_list))
-                    new_code_list = []
-            new_code = all_codes[-1]
-            ans = func_timeout.func_timeout(
-                3, execute, args=(new_code, code_return,))
-            ans = ans if ans is not None else ans
+            new_code, code_return = extract_solution_function(code_string)
+            ans = execute(new_code, code_return)
         else:
-            # Extract code blocks from string using both markdown triple quotes with 'python' and without.
-            triple_quote_blocks = re.findall(r"```(?:python)?(.*?)```", code_string, flags=re.DOTALL)
-            if not triple_quote_blocks:
-                triple_quote_blocks = re.findall(r"'''(?:python)?(.*?)'''", code_string, flags=re.DOTALL)
-            # Concatenate all extracted blocks for execution.
-            code_to_execute = triple_quote_blocks[0] if triple_quote_blocks else code_string
-            # Capture output printed to the console during execution.
+            code_to_execute = extract_code_block(code_string)
+            # Capture output printed to the console during execution (the sandbox worker only runs one snippet at a time).
             old_stdout = sys.stdout
             redirected_output = sys.stdout = io.StringIO()
             try:
                 # Executing the concatenated code blocks
-                exec(code_to_execute, globals(), locals())
+                exec(compile_code(code_to_execute), snippet_globals(), {})
             finally:  # Ensure that stdout is reset back to original
                 sys.stdout = old_stdout
             printed_output = redirected_output.getvalue()
@@ -0,0 +1,74 @@
+import math
+import os
+
+import pandas as pd
+import pytest
+
+from techniques.arithmetic_router import normalize_expression, route_question
+
+DATASETS = os.path.join(os.path.dirname(__file__), "..", "datasets")
+
+
+def load_questions(dataset):
+    df = pd.read_csv(os.path.join(DATASETS, f"{dataset}.csv"))
+    return list(zip(df["question"].astype(str), df["answer"]))
+
+
+@pytest.mark.parametrize("dataset", ["arithmetic_100", "arithmetic_100_german"])
+def test_routed_answers_match_eval(dataset):
+    routed = 0
+    for question, answer in load_questions(dataset):
+        result = route_question(question)
+        if result is None:
+            continue
+        routed += 1
+        value, expression = result
+        assert math.isclose(value, eval(expression.replace("^", "**")), rel_tol=1e-9, abs_tol=1e-12), question
+        assert math.isclose(value, float(answer), rel_tol=1e-9, abs_tol=1e-9), question
+    assert routed > 0
+
+
+@pytest.mark.parametrize("dataset", ["wordProblems_100", "geometry_100", "wordProblems_100_german", "geometry_100_german"])
+def test_other_datasets_are_not_routed(dataset):
+    assert all(route_question(question) is None for question, _ in load_questions(dataset))
+
+
+@pytest.mark.parametrize("question, answer", [
+    ("88254×26228=", 2314725912),
+    ("What is 5 times -34?", -170),
+    ("Calculate -4450 divided by 178.", -25),
+    ("12 ÷ 4 − 1 =", 2),
+    ("Was ist 0,5 mal 3?", 1.5),
+    ("Berechnen Sie 2,25 geteilt durch 0,5.", 4.5),
+    ("Was ist 7 minus 10?", -3),
+    ("1,000,000 / 4 =", 250000),
+    ("0.100 * 3 =", 0.3),
+])
+def test_routed_questions(question, answer):
+    assert math.isclose(route_question(question)[0], answer)
+
+
+@pytest.mark.parametrize("question", [
+    "Was ist 1.500 mal 2?",         # German thousands separator, 3000 in German
+    "What is 1,500 times 2?",       # English thousands separator, 1.5 * 2 in German
+    "Berechnen Sie -13 - 40.103.",
+    "12.345.678 + 1 =",
+    "1.500,5 + 1 =",
+])
+def test_ambiguous_separators_are_not_routed(question):
+    assert route_question(question) is None
+
+
+@pytest.mark.parametrize("question", [
+    "What is the remainder when 17 is divided by 5?",
+    "Round 3.14159 to two decimals.",
+    "What is sqrt(16)?",
+    "1 / 0 =",
+])
+def test_other_questions_are_not_routed(question):
+    assert route_question(question) is None
+
+
+def test_normalize_expression():
+    assert normalize_expression("Was ist 0,5 mal 2?") == "0.5 * 2"
+    assert normalize_expression("Was ist 1.500 mal 2?") is None
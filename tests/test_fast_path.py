@@ -0,0 +1,98 @@
+import glob
+import math
+import os
+
+import pandas as pd
+import pytest
+
+from techniques.sandbox import Sandbox
+from techniques.util import FastPathUnsupported, evaluate_solution_fast, run_solution_code
+
+DATA = os.path.join(os.path.dirname(__file__), "..", "evaluation", "data")
+
+
+def load_pal_solutions():
+    solutions = []
+    for path in sorted(glob.glob(os.path.join(DATA, "PaL_*.csv"))):
+        solutions += [reasoning for reasoning in pd.read_csv(path)["reasoning"] if isinstance(reasoning, str)]
+    return list(dict.fromkeys(solutions))
+
+
+def load_recorded_pal_answers():
+    recorded = {}
+    for path in sorted(glob.glob(os.path.join(DATA, "PaL_*.csv"))):
+        data = pd.read_csv(path)
+        for reasoning, answer in zip(data["reasoning"], pd.to_numeric(data["answer"], errors="coerce")):
+            if isinstance(reasoning, str):
+                recorded[reasoning] = None if math.isnan(answer) else float(answer)
+    return recorded
+
+
+@pytest.fixture(scope="module")
+def sandbox():
+    sandbox = Sandbox(run_solution_code, workers=2, timeout=10, cpu_seconds=10)
+    yield sandbox
+    sandbox.close()
+
+
+def same_answer(fast, executed):
+    if fast is None or executed is None:
+        return fast is None and executed is None
+    if isinstance(executed, (int, float)) and math.isnan(executed):
+        return math.isnan(fast)
+    return math.isclose(fast, executed, rel_tol=1e-12, abs_tol=1e-12)
+
+
+def test_sandbox_reproduces_recorded_answers(sandbox):
+    recorded = load_recorded_pal_answers()
+    assert len(recorded) > 400
+    for solution, answer in recorded.items():
+        assert same_answer(sandbox.run(solution)[0], answer), solution
+
+
+@pytest.mark.parametrize("solution, answer", [
+    # Helper functions only see the module globals the code was originally executed with
+    ("```python\ndef area(r):\n    return math.pi * r ** 2\n\nprint(area(1))\n```", None),
+    ("```python\nimport math\n\ndef area(r):\n    return math.pi * r ** 2\n\nprint(area(1))\n```", None),
+    ("```python\nimport math\nprint(math.floor(2.5))\n```", 2.0),
+    # The body of solution() runs inlined at the top level, after `import math`
+    ("def solution():\n    ans = math.sqrt(16)\n    return ans", 4.0),
+    ("def solution():\n    def square(x):\n        return math.sqrt(x) ** 2\n    ans = square(4)\n    return ans", None),
+])
+def test_snippets_run_with_the_original_globals(sandbox, solution, answer):
+    assert same_answer(sandbox.run(solution)[0], answer)
+
+
+def test_fast_path_matches_sandbox_on_recorded_solutions(sandbox):
+    evaluated = 0
+    for solution in load_pal_solutions():
+        try:
+            fast = evaluate_solution_fast(solution)
+        except FastPathUnsupported:
+            continue
+        evaluated += 1
+        executed, _, outcome = sandbox.run(solution)
+        assert outcome == "completed"
+        assert same_answer(fast, executed), solution
+    assert evaluated > 100
+
+
+@pytest.mark.parametrize("solution", [
+    "def solution():\n    a = 7\n    b = a // 2\n    c = a % 2\n    ans = b * 10 + c\n    return ans",
+    "def solution():\n    import math\n    r = 3\n    ans = math.pi * r ** 2\n    return ans",
+    "def solution():\n    \"\"\"Docstring\"\"\"\n    x = 1\n    x += 2.5\n    ans = round(x * 3, 1)\n    return ans",
+    "def solution():\n    a = 0\n    ans = 1 / a\n    return ans",
+])
+def test_fast_path_matches_sandbox(sandbox, solution):
+    assert same_answer(evaluate_solution_fast(solution), sandbox.run(solution)[0])
+
+
+@pytest.mark.parametrize("solution", [
+    "def solution():\n    ans = 10 ** 10 ** 10\n    return ans",     # Left to the sandbox, which can kill it
+    "def solution():\n    ans = 0\n    for i in range(3):\n        ans += i\n    return ans",
+    "def solution():\n    x = 2\n    return x * 2",
+    "print(1 + 1)",
+])
+def test_unsupported_solutions_are_executed(solution):
+    with pytest.raises(FastPathUnsupported):
+        evaluate_solution_fast(solution)
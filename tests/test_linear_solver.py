@@ -0,0 +1,80 @@
+import glob
+import math
+import os
+import re
+
+import pandas as pd
+import pytest
+
+from techniques.DeclarativeSymPy import find_goal, has_letter_run, reformat_equations_from_peano, solve_using_sympy
+from techniques.linear_solver import LinearSystemUnsupported, solve_linear_system
+
+DATA = os.path.join(os.path.dirname(__file__), "..", "evaluation", "data")
+
+
+def load_equation_systems():
+    """ Returns the systems of the recorded DeclarativeSymPy responses, prepared like `get_final_using_sympy` does. """
+    systems = []
+    for path in sorted(glob.glob(os.path.join(DATA, "DeclarativeSymPy_*.csv"))):
+        for reasoning in pd.read_csv(path)["reasoning"]:
+            if not isinstance(reasoning, str):
+                continue
+            equations = reformat_equations_from_peano(re.findall(r'\[\[.*?\]\]', reasoning))
+            if equations and not has_letter_run(equations):
+                systems.append(equations)
+    return list(dict.fromkeys(systems))
+
+
+def solve_both(equations):
+    """ Returns the answers of the linear solver and of SymPy, or None if the linear solver does not support the system. """
+    equation_list = equations.split(',')
+    goal_var, goal_source = find_goal(equation_list)
+    try:
+        linear = solve_linear_system(equation_list, goal_var, goal_source)
+    except LinearSystemUnsupported:
+        return None
+    return linear, solve_using_sympy(equation_list, goal_var, goal_source)
+
+
+def same_answer(linear, sympy):
+    if linear is None or sympy is None:
+        return linear is None and sympy is None
+    return math.isclose(linear, sympy, rel_tol=1e-9, abs_tol=1e-9)
+
+
+def test_linear_solver_matches_sympy_on_recorded_systems():
+    solved = 0
+    for equations in load_equation_systems():
+        answers = solve_both(equations)
+        if answers is None:
+            continue
+        solved += 1
+        assert same_answer(*answers), equations
+    assert solved > 100
+
+
+@pytest.mark.parametrize("equations", [
+    "a = 3, b = a * 4, c = b - a, c = ?",
+    "x + y = 10, x - y = 2, x = ?",
+    "r = 2, A = pi * r^2, A = ?",
+    "a = 7, b = a // 2, c = a % 3, b + c = ?",
+    "a = 1/3, b = a * 3, b = ?",
+    "a + b = 4, a = ?",             # Not determined
+    "a = 1, a = 2, a = ?",          # Inconsistent
+    "a = 2^10, b = a / 0.5, b = ?",
+])
+def test_linear_solver_matches_sympy(equations):
+    answers = solve_both(equations)
+    assert answers is not None
+    assert same_answer(*answers)
+
+
+@pytest.mark.parametrize("equations", [
+    "a = 4, b = sqrt(a), b = ?",
+    "a * b = 6, a = 2, c = a * b * b, c = ?",
+    "2a = 4, a = ?",                # Implicit multiplication
+])
+def test_nonlinear_systems_are_left_to_sympy(equations):
+    equation_list = equations.split(',')
+    with pytest.raises(LinearSystemUnsupported):
+        solve_linear_system(equation_list, *find_goal(equation_list))